@@ -1,6 +1,7 @@
 # type: ignore
 
 from typing import Dict, List, Any, Union
+import os
 import numpy as np
 
 # default simulation items
@@ -8,6 +9,8 @@ DEFAULT_NUM_OF_FILES: int = 1000
 DEFAULT_CACHE_SIZE: int = 20
 DEFAULT_USER_NUM: int = 3
 DEFAULT_REQUEST_NUM: int = 5
+# files cached by the regional cache shared by a group of users
+DEFAULT_REGIONAL_CACHE_SIZE: int = 100
 
 DEFAULT_ALPHA: Union[float, int] = 1.0005
 DEFAULT_BETA: Union[float, int] = 1.0005
@@ -19,6 +22,15 @@ DEFAULT_NUMBER_OF_ALPHA: int = 10
 DEFAULT_ZIPF: float = 1.0005
 DEFAULT_SIMULATIONS_PER_TICK: int = 10
 
+# multiprocessing
+DEFAULT_NUM_OF_WORKERS: int = os.cpu_count() or 1
+# ranges of work units sent to each worker, more balances load better
+CHUNKS_PER_WORKER: int = 4
+# upper bound on the units a worker buffers before writing them out
+MAX_UNITS_PER_CHUNK: int = 2**16
+# upper bound on the result entries read at once when aggregating
+RESULT_READ_CHUNK_ENTRIES: int = 2**22
+
 POSSIBLE_SWEEPS: Dict[str, Dict[str, Any]] = {
     "ALPHA": {
         "type": List[Union[int, float]],
@@ -32,8 +44,23 @@ POSSIBLE_SWEEPS: Dict[str, Dict[str, Any]] = {
         "can_be_negative": False,
         "name": "num_of_requests",
     },
+    "A": {"type": List[Union[int, float]], "can_be_negative": False, "name": "a"},
+    "NUM_OF_FILES": {"type": List[int], "can_be_negative": False, "name": "num_of_files"},
+    "REGIONAL_CACHE_SIZE": {
+        "type": List[int],
+        "can_be_negative": False,
+        "name": "regional_cache_size",
+    },
+    "REGIONAL_ALPHA": {
+        "type": List[Union[int, float]],
+        "can_be_negative": True,
+        "name": "regional_alpha",
+    },
 }
 
+# N-dimensional sweep designs
+POSSIBLE_DESIGNS: List[str] = ["factorial", "latin_hypercube", "points"]
+
 DEFAULT_SWEEP_X: Dict = POSSIBLE_SWEEPS["ALPHA"]
 DEFAULT_SWEEP_Y: Dict = POSSIBLE_SWEEPS["CACHE_SIZE"]
 
@@ -44,9 +71,41 @@ DEFAULT_SWEEP_RANGE_Y: DEFAULT_SWEEP_Y["type"] = list(range(-5, 6)) if DEFAULT_S
 
 DEFAULT_FORMULA: str = "{{p_r(m)^{1\\over\\alpha}}\\over" + "{\\sum_{n=1}^{m}{p_r(n)^{1\\over\\alpha}}}}"
 
+# requests read at once when streaming access logs
+TRACE_CHUNK_SIZE: int = 2**20
+
+# simulation engine of Driver.drive, see core.plan.ENGINES
+DEFAULT_ENGINE: str = "evaluate"
+# requests drawn at once by the online cache policies
+POLICY_STEPS_PER_BLOCK: int = 1024
+
+# head-tail distributions of large catalogs, ranks stored densely and
+# geometric buckets approximating the remaining tail
+DEFAULT_HEAD_SIZE: int = 2**16
+DEFAULT_TAIL_BUCKETS: int = 4096
+
+# users x files elements sampled at once when replaying traces
+REPLAY_BATCH_ELEMENTS: int = 2**24
+
+# floating point precision of distributions, "float64" or "float32"
+PRECISIONS: List[str] = ["float64", "float32"]
+PRECISION: str = "float64"
+# entries summed at once in float64 by the reduced precision cumulative sum
+SAFE_CUMSUM_CHUNK: int = 2**20
+
+# per-stage timers and counters, cheap enough to leave on
+PROFILING_ENABLED: bool = True
+# upper bound on the timeline events a process records for Chrome traces
+MAX_PROFILE_EVENTS: int = 2**20
+
 # other function variables
 USE_NUMPY_ZIPF: bool = False
 STRICT_EVALUATION: bool = False
+# generated request distributions and their alias tables kept per process
+DISTRIBUTION_CACHE_SIZE: int = 8
+# share of the request distribution in importance sampling proposals, the
+# likelihood ratio of any request is at most its inverse
+IMPORTANCE_MIXTURE: float = 0.1
 
 # LaTeX config
 REPLACEMENTS: Dict[str, str] = {
@@ -54,3 +113,23 @@ REPLACEMENTS: Dict[str, str] = {
     "\\cdot": "*",
     "\\times": "*",
 }
+
+# adaptive refinement
+DEFAULT_ADAPTIVE_COARSE_POINTS: int = 5
+DEFAULT_ADAPTIVE_MAX_POINTS: int = 200
+DEFAULT_ADAPTIVE_THRESHOLD: float = 0.05
+
+# users x files elements sampled at once when evaluating user populations
+POPULATION_BATCH_ELEMENTS: int = 2**24
+
+# users x files elements sampled at once when simulating delivery groups
+DELIVERY_BATCH_ELEMENTS: int = 2**24
+
+# users x files elements sampled at once when simulating hierarchy groups
+HIERARCHY_BATCH_ELEMENTS: int = 2**24
+
+# compiled formula artifacts, reused by later runs of this checkout without
+# importing sympy, empty to disable
+FORMULA_CACHE_DIR: str = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), ".formula_cache"
+)
@@ -0,0 +1,273 @@
+"""
+Adaptive grid refinement for two-axis sweeps
+
+Rather than simulating every cell of a dense grid, a coarse grid is simulated
+first and only the cells whose corners disagree (large gradient) or whose corner
+estimates are noisy (high uncertainty) are split into quarters, every such cell
+of a round at once. The evaluated points form a non-uniform result set which
+can be resampled onto a regular grid.
+"""
+import numpy as np
+from typing import Callable, Dict, List, Tuple, Union
+
+from exceptions import InvalidParametersException
+
+# (x0, x1, y0, y1) as indexes into the scaled coordinates of AdaptiveResult
+Cell = Tuple[float, float, float, float]
+
+
+def _to_scale(values: np.ndarray, scale: str) -> np.ndarray:
+    if scale == "log":
+        if np.any(values <= 0):
+            raise InvalidParametersException(
+                "Logarithmic refinement requires a strictly positive range"
+            )
+        return np.log10(values)
+    return values.astype(np.float64)
+
+
+def _from_scale(values: np.ndarray, scale: str) -> np.ndarray:
+    if scale == "log":
+        return 10 ** values
+    return values
+
+
+class AdaptiveResult(object):
+    """
+    Non-uniform sweep results, one entry per evaluated (x, y) point
+    """
+
+    def __init__(
+        self,
+        scale_x: str,
+        scale_y: str,
+        integer_x: bool = False,
+        integer_y: bool = False,
+    ) -> None:
+        self.scale_x = scale_x
+        self.scale_y = scale_y
+        self.integer_x = integer_x
+        self.integer_y = integer_y
+        # scaled coordinates -> (mean, standard error)
+        self._values: Dict[Tuple[float, float], Tuple[float, float]] = {}
+        self.leaves: List[Cell] = []
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def __contains__(self, point: Tuple[float, float]) -> bool:
+        return point in self._values
+
+    def add(self, point: Tuple[float, float], mean: float, error: float) -> None:
+        self._values[point] = (mean, error)
+
+    def value(self, point: Tuple[float, float]) -> Tuple[float, float]:
+        return self._values[point]
+
+    @property
+    def points(self) -> np.ndarray:
+        """
+        :return: (n, 2) array of evaluated points in parameter units
+        """
+        scaled = np.array(list(self._values.keys()), dtype=np.float64).reshape(-1, 2)
+        return np.stack(
+            [
+                _from_scale(scaled[:, 0], self.scale_x),
+                _from_scale(scaled[:, 1], self.scale_y),
+            ],
+            axis=1,
+        )
+
+    @property
+    def values(self) -> np.ndarray:
+        """
+        :return: (n,) array of mean results, ordered as points
+        """
+        return np.array([mean for mean, _ in self._values.values()])
+
+    @property
+    def errors(self) -> np.ndarray:
+        """
+        :return: (n,) array of standard errors, ordered as points
+        """
+        return np.array([error for _, error in self._values.values()])
+
+    def resample(
+        self,
+        range_x: Union[List[Union[int, float]], np.ndarray],
+        range_y: Union[List[Union[int, float]], np.ndarray],
+    ) -> np.ndarray:
+        """
+        Bilinear resampling of the refined cells onto a regular grid
+        :param range_x: x values of the target grid
+        :param range_y: y values of the target grid
+        :return: y,x matrix suitable for pcolormesh
+        """
+        grid_x, grid_y = np.meshgrid(
+            _to_scale(np.asarray(range_x), self.scale_x),
+            _to_scale(np.asarray(range_y), self.scale_y),
+        )
+        output = np.full(grid_x.shape, np.nan)
+
+        for x0, x1, y0, y1 in self.leaves:
+            inside = (
+                (grid_x >= x0) & (grid_x <= x1) & (grid_y >= y0) & (grid_y <= y1)
+            )
+            if not inside.any():
+                continue
+            tx = (grid_x[inside] - x0) / (x1 - x0) if x1 > x0 else 0.0
+            ty = (grid_y[inside] - y0) / (y1 - y0) if y1 > y0 else 0.0
+            v00 = self._values[(x0, y0)][0]
+            v10 = self._values[(x1, y0)][0]
+            v01 = self._values[(x0, y1)][0]
+            v11 = self._values[(x1, y1)][0]
+            output[inside] = (
+                v00 * (1 - tx) * (1 - ty)
+                + v10 * tx * (1 - ty)
+                + v01 * (1 - tx) * ty
+                + v11 * tx * ty
+            )
+
+        return output
+
+
+def _midpoint(low: float, high: float, scale: str, integer: bool) -> float:
+    middle = (low + high) / 2
+    if integer:
+        # keep integer parameters on integer values, compared in parameter units
+        value = np.round(_from_scale(np.array([middle]), scale))[0]
+        middle = float(_to_scale(np.array([value]), scale)[0])
+    return middle
+
+
+def _cell_score(result: AdaptiveResult, cell: Cell, spread: float) -> float:
+    corners = [result.value(point) for point in _corners(cell)]
+    means = [mean for mean, _ in corners]
+    errors = [error for _, error in corners]
+    gradient = (max(means) - min(means)) / spread
+    uncertainty = max(errors) / spread
+    return max(gradient, uncertainty)
+
+
+def _corners(cell: Cell) -> List[Tuple[float, float]]:
+    x0, x1, y0, y1 = cell
+    return [(x0, y0), (x1, y0), (x0, y1), (x1, y1)]
+
+
+def refine(
+    simulate: Callable[[List[Tuple[float, float]]], np.ndarray],
+    range_x: Union[List[Union[int, float]], np.ndarray],
+    range_y: Union[List[Union[int, float]], np.ndarray],
+    coarse_points: int,
+    max_points: int,
+    threshold: float,
+    scale_x: str = "linear",
+    scale_y: str = "linear",
+) -> AdaptiveResult:
+    """
+    Adaptive refinement of a two-axis sweep
+    :param simulate: callable taking a list of (x, y) parameter values and
+        returning an (n, trials) array of results for each point, called once
+        per round of refinement
+    :param range_x: x values, only the extremes are used for the coarse grid
+    :param range_y: y values, only the extremes are used for the coarse grid
+    :param coarse_points: number of coarse points per axis
+    :param max_points: budget of evaluated points, coarse grid included
+    :param threshold: relative gradient/uncertainty (fraction of the observed
+        value spread) above which a cell is subdivided
+    :param scale_x: "linear" or "log" subdivision of the x axis
+    :param scale_y: "linear" or "log" subdivision of the y axis
+    :return: AdaptiveResult containing every evaluated point
+    """
+    if coarse_points < 2:
+        raise InvalidParametersException("Refinement requires at least 2x2 points")
+    if coarse_points ** 2 > max_points:
+        raise InvalidParametersException("Coarse grid exceeds the point budget")
+
+    range_x = np.asarray(range_x)
+    range_y = np.asarray(range_y)
+    integer_x = range_x.dtype.kind in "iu"
+    integer_y = range_y.dtype.kind in "iu"
+    result = AdaptiveResult(scale_x, scale_y, integer_x, integer_y)
+
+    scaled_x = _to_scale(range_x, scale_x)
+    scaled_y = _to_scale(range_y, scale_y)
+    axis_x = np.linspace(scaled_x.min(), scaled_x.max(), coarse_points)
+    axis_y = np.linspace(scaled_y.min(), scaled_y.max(), coarse_points)
+    if integer_x:
+        axis_x = np.unique(
+            _to_scale(np.round(_from_scale(axis_x, scale_x)), scale_x)
+        )
+    if integer_y:
+        axis_y = np.unique(
+            _to_scale(np.round(_from_scale(axis_y, scale_y)), scale_y)
+        )
+
+    def evaluate_points(points: List[Tuple[float, float]]) -> None:
+        points = [point for point in dict.fromkeys(points) if point not in result]
+        if not points:
+            return
+        parameters = [
+            (
+                _from_scale(np.array([x]), scale_x)[0].item(),
+                _from_scale(np.array([y]), scale_y)[0].item(),
+            )
+            for x, y in points
+        ]
+        if integer_x:
+            parameters = [(int(round(x)), y) for x, y in parameters]
+        if integer_y:
+            parameters = [(x, int(round(y))) for x, y in parameters]
+        trials = np.atleast_2d(np.asarray(simulate(parameters), dtype=np.float64))
+        for point, row in zip(points, trials):
+            error = row.std(ddof=1) / np.sqrt(len(row)) if len(row) > 1 else 0.0
+            result.add(point, row.mean(), error)
+
+    evaluate_points([(float(x), float(y)) for y in axis_y for x in axis_x])
+    cells: List[Cell] = [
+        (float(axis_x[i]), float(axis_x[i + 1]), float(axis_y[j]), float(axis_y[j + 1]))
+        for j in range(len(axis_y) - 1)
+        for i in range(len(axis_x) - 1)
+    ]
+
+    while True:
+        spread = np.ptp(result.values) or 1.0
+        scores = [_cell_score(result, cell, spread) for cell in cells]
+        order = np.argsort(scores)[::-1]
+        # every cell above threshold that can still be split, highest scoring
+        # first while the budget allows, evaluated together in one batch
+        splits: Dict[int, Tuple[List[float], List[float]]] = {}
+        new_points: Dict[Tuple[float, float], None] = {}
+        exhausted = False
+        for index in order:
+            if scores[index] <= threshold:
+                break
+            x0, x1, y0, y1 = cells[index]
+            xs = sorted({x0, _midpoint(x0, x1, scale_x, integer_x), x1})
+            ys = sorted({y0, _midpoint(y0, y1, scale_y, integer_y), y1})
+            if len(xs) == 2 and len(ys) == 2:
+                continue
+            points = [
+                (x, y) for y in ys for x in xs
+                if (x, y) not in result and (x, y) not in new_points
+            ]
+            if len(result) + len(new_points) + len(points) > max_points:
+                exhausted = True
+                break
+            new_points.update(dict.fromkeys(points))
+            splits[int(index)] = (xs, ys)
+        if not splits:
+            break
+
+        evaluate_points(list(new_points))
+        cells = [cell for index, cell in enumerate(cells) if index not in splits] + [
+            (xs[i], xs[i + 1], ys[j], ys[j + 1])
+            for xs, ys in splits.values()
+            for j in range(len(ys) - 1)
+            for i in range(len(xs) - 1)
+        ]
+        if exhausted:
+            break
+
+    result.leaves = cells
+    return result
@@ -0,0 +1,149 @@
+"""
+Delivery load of a group of users sharing a broadcast link
+
+Every user of a group holds its own cache placement and requests its own
+files. Misses are served over one shared link, either uncoded (each missed
+file sent once, multicast to every user missing it) or with coded multicast,
+where one transmission XORs files that each receiving user can decode using
+the contents of its own cache. Placements and requests of the whole group are
+sampled in batches of users and looked up by (user, file) keys, so a group
+costs a handful of array operations rather than one simulation per user, and
+no (users x files) matrix is held at once.
+"""
+import numpy as np
+from typing import Any, Callable, Dict, Tuple
+
+from config import DELIVERY_BATCH_ELEMENTS
+from core.evaluator import setup_distributions
+from utils.sampling import sample_without_replacement
+
+DELIVERY_MODES = ["uncoded", "coded"]
+
+
+def sample_group(
+    file_prob_dist: np.ndarray,
+    cache_choice_prob_dist: np.ndarray,
+    cache_size: int,
+    num_files_requested: int,
+    num_users: int,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Sampling placements and requests of a group, like evaluate() per user,
+    DELIVERY_BATCH_ELEMENTS users x files sampling keys at a time
+    :param file_prob_dist: np.ndarray containing probability of file request
+    :param cache_choice_prob_dist: np.ndarray containing probability of file caching
+    :param cache_size: files cached per user
+    :param num_files_requested: files requested per user
+    :param num_users: users in the group
+    :return: (users, cache) np.ndarray of cached files and (users, requests)
+        np.ndarray of requested files
+    """
+    batch_users = max(1, DELIVERY_BATCH_ELEMENTS // max(1, len(file_prob_dist)))
+    cached, requested = [], []
+    for start in range(0, num_users, batch_users):
+        batch = min(batch_users, num_users - start)
+        cached.append(
+            sample_without_replacement(cache_choice_prob_dist, cache_size, batch)
+        )
+        requested.append(
+            sample_without_replacement(file_prob_dist, num_files_requested, batch)
+        )
+    return np.concatenate(cached), np.concatenate(requested)
+
+
+def _user_keys(files: np.ndarray, num_of_files: int) -> np.ndarray:
+    """
+    :param files: (users, n) np.ndarray of files
+    :param num_of_files: number of files
+    :return: (users, n) np.ndarray of keys unique per (user, file)
+    """
+    rows = np.arange(len(files), dtype=np.int64)[:, None]
+    return rows * num_of_files + files.astype(np.int64)
+
+
+def _greedy_clique_cover(compatible: np.ndarray) -> int:
+    """
+    Greedy clique cover of the file compatibility graph, highest degree
+    first. Each clique is one coded transmission.
+    :param compatible: (files, files) symmetric boolean matrix
+    :return: number of cliques
+    """
+    order = np.argsort(-compatible.sum(axis=1), kind="stable")
+    position = np.empty(len(order), dtype=np.int64)
+    position[order] = np.arange(len(order))
+    uncovered = np.ones(len(compatible), dtype=bool)
+    cliques = 0
+    for demand in order:
+        if not uncovered[demand]:
+            continue
+        uncovered[demand] = False
+        candidates = compatible[demand] & uncovered
+        while candidates.any():
+            member = int(np.argmin(np.where(candidates, position, len(order))))
+            uncovered[member] = False
+            candidates &= compatible[member]
+            candidates[member] = False
+        cliques += 1
+    return cliques
+
+
+def delivery_load(
+    cached: np.ndarray, requested: np.ndarray, num_of_files: int
+) -> Dict[str, int]:
+    """
+    Transmissions needed to serve a group's misses over a shared link
+    :param cached: (users, cache) np.ndarray of cached files
+    :param requested: (users, requests) np.ndarray of requested files
+    :param num_of_files: number of files
+    :return: dict of total "misses", "uncoded" and "coded" transmissions
+    """
+    rows = np.arange(len(requested))[:, None]
+    cached_keys = _user_keys(cached, num_of_files).ravel()
+    missed = ~np.isin(_user_keys(requested, num_of_files), cached_keys)
+    files, demands = np.unique(requested[missed], return_counts=True)
+
+    # users missing each file, every such file is one (multicast) demand. Two
+    # files can be XORed when every user missing one caches the other.
+    missing = np.zeros((len(files), len(cached)), dtype=np.int64)
+    missing_users = np.broadcast_to(rows, requested.shape)[missed]
+    missing[np.searchsorted(files, requested[missed]), missing_users] = 1
+    uncached_keys = _user_keys(
+        np.broadcast_to(files, (len(cached), len(files))), num_of_files
+    )
+    uncached = (~np.isin(uncached_keys, cached_keys)).astype(np.int64)
+    decodable = (missing @ uncached) == 0
+    compatible = decodable & decodable.T
+
+    return {
+        "misses": int(demands.sum()),
+        "uncoded": len(files),
+        "coded": _greedy_clique_cover(compatible),
+    }
+
+
+def _delivery_engine(mode: str) -> Callable[[Dict[str, Any], int], int]:
+    def delivery_cell(arguments: Dict[str, Any], trial: int) -> int:
+        """
+        Delivery engine, one group of num_users users of one cell of a sweep
+        :param arguments: cell arguments
+        :param trial: unused, users are simulated together
+        :return: transmissions over the shared link
+        """
+        file_request_distribution, caching_dist, _ = setup_distributions(
+            **arguments
+        )
+        cached, requested = sample_group(
+            file_request_distribution,
+            caching_dist,
+            arguments["cache_size"],
+            arguments["num_of_requests"],
+            arguments["num_users"],
+        )
+        return delivery_load(cached, requested, len(file_request_distribution))[mode]
+
+    return delivery_cell
+
+
+DELIVERY_ENGINES: Dict[str, Callable[[Dict[str, Any], int], int]] = {
+    f"delivery_{mode}": _delivery_engine(mode) for mode in DELIVERY_MODES
+}
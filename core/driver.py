@@ -1,9 +1,10 @@
 """
 Main driver for simulation, to be used by CLI and UI
 """
+import time
 import numpy as np
 import multiprocessing as mp
-from typing import List, Union, Dict, Any
+from typing import List, Union, Dict, Any, Tuple, Optional
 
 from config import (
     DEFAULT_SWEEP_RANGE_X,
@@ -12,17 +13,43 @@ from config import (
     DEFAULT_SWEEP_Y,
     DEFAULT_NUM_OF_FILES,
     DEFAULT_CACHE_SIZE,
+    DEFAULT_REGIONAL_CACHE_SIZE,
     DEFAULT_USER_NUM,
     DEFAULT_REQUEST_NUM,
     DEFAULT_ALPHA,
     DEFAULT_BETA,
+    DEFAULT_ZIPF,
+    DEFAULT_ADAPTIVE_COARSE_POINTS,
+    DEFAULT_ADAPTIVE_MAX_POINTS,
+    DEFAULT_ADAPTIVE_THRESHOLD,
+    DEFAULT_NUM_OF_WORKERS,
+    DEFAULT_ENGINE,
+    PRECISION,
+    PROFILING_ENABLED,
+    CHUNKS_PER_WORKER,
     POSSIBLE_SWEEPS
 )
-from exceptions import InvalidParametersException
+from exceptions import InvalidParametersException, WorkerError
 
 from utils.generate_distribution_curves import generate_distribution_curve
-from core.evaluator import setup_and_simulate
+from core.plan import (
+    ENGINE_COLUMNS,
+    USER_BATCHED_ENGINES,
+    WEIGHTED_ENGINES,
+    SweepPlan,
+    _init_worker,
+    _run_units,
+)
+from core.results import ResultBundle, ResultTensor
+from utils.dtypes import smallest_uint_dtype
+from core.adaptive import AdaptiveResult, refine
+from core.sweep import SweepResult, SweepSpec
+from core.replay import ReplayTrace
+from core.epochs import EpochDistribution, simulate_epochs
+from core.population import PopulationResult, PopulationSpec, evaluate_population
 from utils.parse_formula import evaluate_string_to_valid_formula_str
+from utils.profiling import Profile, collect, timer
+from utils.profiling import configure as profiling_configure
 
 
 class Driver(object):
@@ -37,16 +64,53 @@ class Driver(object):
         self.range_y = DEFAULT_SWEEP_RANGE_Y
         self.num_of_files = DEFAULT_NUM_OF_FILES
         self.cache_size = DEFAULT_CACHE_SIZE
+        # regional tier of the hierarchy engines, the edge formula if None
+        self.regional_cache_size = DEFAULT_REGIONAL_CACHE_SIZE
+        self.regional_formula: Optional[str] = None
         self.number_of_files_requested = DEFAULT_REQUEST_NUM
         self.num_of_users = DEFAULT_USER_NUM
         self.alpha = DEFAULT_ALPHA
         self.beta = DEFAULT_BETA
+        self.a = DEFAULT_ZIPF
+        self.num_of_workers = DEFAULT_NUM_OF_WORKERS
+        # result bundle directory written during a run, kept in memory if None
+        self.result_path: Optional[str] = None
+        self.results: Optional[ResultTensor] = None
+        self.seed: Optional[int] = None
+        # "evaluate" or an online cache policy, see core.plan.ENGINES
+        self.engine = DEFAULT_ENGINE
+        # x,y matrix of the variance of each estimate of the last drive,
+        # weighted engines (e.g. "importance", see core.importance) only
+        self.variance: Optional[np.ndarray] = None
+        # x,y matrix of each column of the last drive, engines reporting several
+        # (e.g. the tiers of "hierarchy", see core.plan.ENGINE_COLUMNS) only
+        self.columns: Optional[Dict[str, np.ndarray]] = None
+        # "float64" or "float32" distributions, see config.PRECISIONS
+        self.precision = PRECISION
+        # per-stage timers merged from every worker of the last run
+        self.profile: Optional[Profile] = None
+        # record individual events as well, for Profile.write_chrome_trace
+        self.profile_timeline = False
+        # i.i.d. requests, repeats included, for the "evaluate" engine
+        self.with_replacement = False
+        # request distribution replacing the generated Zipf one, e.g. a trace
+        self.file_request_distribution: Optional[np.ndarray] = None
 
         self.file_distribution: np.ndarray = np.array([])
 
     def _update_distribution(self, *args, **kwargs) -> None:
         self.file_distribution = generate_distribution_curve(*args, **kwargs)
 
+    def use_request_distribution(self, file_request_distribution: np.ndarray) -> None:
+        """
+        Simulating against a given request distribution, such as one built by
+        utils.traces.trace_request_distribution, instead of a generated Zipf
+        :param file_request_distribution: np.ndarray p_r in descending order
+        """
+        self.file_request_distribution = np.asarray(file_request_distribution)
+        self.file_dist = self.file_request_distribution
+        self.num_of_files = len(self.file_request_distribution)
+
     def _update_simulation_args(
         self,
         x_axis: Dict[str, Any],
@@ -71,19 +135,42 @@ class Driver(object):
         :return: x,y matrix of TOTAL caching misses
         """
 
-        # generate file distribution
-        self.file_dist: np.ndarray = generate_distribution_curve(
-            self.num_of_files, automatic=True
-        )
-
-        trials: List[np.ndarray] = []
-        for i in range(self.num_of_users):
-            trials.append(self.drive(formula=formula, generate_new_dist=False))
+        # generate file distribution, never dense for head-tail catalogs
+        if self.file_request_distribution is None and self.engine != "head_tail":
+            self.file_dist: np.ndarray = generate_distribution_curve(
+                self.num_of_files, automatic=True
+            )
 
-            bars_left_to_complete = int(20*i/self.num_of_users)
-            print(f":{bars_left_to_complete * '#'}{(20 - bars_left_to_complete) * '-'}: {(100 * i/self.num_of_users):.2f}%")
+        # every user is a trial of the same plan, simulated in a single pass,
+        # unless the engine already simulates all users together
+        batched = self.engine in USER_BATCHED_ENGINES
+        plan = SweepPlan.from_grid(
+            evaluate_string_to_valid_formula_str(formula),
+            self._default_arguments(),
+            self.x_axis["name"],
+            self.range_x,
+            self.y_axis["name"],
+            self.range_y,
+            trials=(1 if batched else self.num_of_users) * self._num_columns(),
+            seed=self.seed,
+            engine=self.engine,
+        )
 
-        return sum(trials)
+        self.results = self._run_plan(
+            plan,
+            self.result_path,
+            show_progress=True,
+            dtype=smallest_uint_dtype(
+                plan.maximum("num_of_requests") * self.num_of_users
+            ) if batched else None,
+        )
+        # totals over independent users, their variances add up
+        self.variance = (
+            self.results.variance_trials() * plan.trials
+        ).reshape(len(self.range_y), len(self.range_x)) if (
+            self.engine in WEIGHTED_ENGINES
+        ) else None
+        return self._column_totals((len(self.range_y), len(self.range_x)))
 
     def drive(self, formula: str, generate_new_dist: bool = False) -> np.ndarray:
         """
@@ -95,63 +182,453 @@ class Driver(object):
         # evaluate the formula
         formula = evaluate_string_to_valid_formula_str(formula)
 
-        if generate_new_dist:
+        if generate_new_dist and self.file_request_distribution is None:
             # generate file distribution
             self.file_dist: np.ndarray = generate_distribution_curve(
                 self.num_of_files, automatic=True,
             )
 
-        # pre-populate a matrix of arguments
-        default_arguments: Dict[str, Any] = {
-            "formula": formula,
+        # one compact plan replaces a matrix of argument dicts
+        plan = SweepPlan.from_grid(
+            formula,
+            self._engine_arguments(),
+            self.x_axis["name"],
+            self.range_x,
+            self.y_axis["name"],
+            self.range_y,
+            # weighted estimates need several users for their variance
+            trials=(
+                self.num_of_users if self.engine in WEIGHTED_ENGINES else 1
+            ) * self._num_columns(),
+            seed=self.seed,
+            engine=self.engine,
+        )
+
+        # for now, return the length of caching purposes
+        self.results = self._run_plan(plan, self.result_path)
+        shape = (len(self.range_y), len(self.range_x))
+        if self.engine in WEIGHTED_ENGINES:
+            # one user's expected misses, averaged over num_of_users estimates
+            trials = self.results.shape[1]
+            self.variance = (self.results.variance_trials() / trials).reshape(shape)
+            return (self.results.sum_trials() / trials).reshape(shape)
+        self.variance = None
+        return self._column_totals(shape)
+
+    def _num_columns(self) -> int:
+        return len(ENGINE_COLUMNS.get(self.engine, [None]))
+
+    def _column_totals(self, shape: Tuple[int, int]) -> np.ndarray:
+        """
+        Totals of the last results, split into self.columns for engines
+        reporting several columns
+        :param shape: y,x shape of the grid
+        :return: x,y matrix of the totals, of the last column if several
+        """
+        names = ENGINE_COLUMNS.get(self.engine)
+        if names is None:
+            self.columns = None
+            return self.results.sum_trials().reshape(shape)
+        totals = self.results.sum_trials(len(names))
+        self.columns = {
+            name: totals[:, column].reshape(shape)
+            for column, name in enumerate(names)
+        }
+        return self.columns[names[-1]]
+
+    def _last_column(self, array: np.ndarray) -> np.ndarray:
+        """
+        :param array: cells,trials matrix of results of self.engine
+        :return: cells,trials matrix of the last column of each unit, e.g.
+            the requests reaching the origin of "hierarchy"
+        """
+        columns = self._num_columns()
+        return array[:, columns - 1::columns]
+
+    def _engine_arguments(self) -> Dict[str, Any]:
+        """
+        :return: the driver's arguments, engines simulating all users of a cell
+            together simulating a single user per trial
+        """
+        arguments = self._default_arguments()
+        if self.engine in USER_BATCHED_ENGINES:
+            arguments["num_users"] = 1
+        return arguments
+
+    def _default_arguments(self) -> Dict[str, Any]:
+        arguments: Dict[str, Any] = {
             "alpha": self.alpha,
             "beta": self.beta,
             "cache_size": self.cache_size,
             "num_users": self.num_of_users,
-            # "file_request_distribution": self.file_dist,
             "num_of_requests": self.number_of_files_requested,
             "num_of_files": self.num_of_files,
+            "a": self.a,
+            "regional_cache_size": self.regional_cache_size,
+            "precision": self.precision,
         }
-        argument_matrix: List[List[Dict[str, Any]]] = []
-        for _ in self.range_y:
-            # shallow copy the arguments
-            argument_matrix.append([default_arguments.copy() for _ in self.range_x])
+        if self.regional_formula is not None:
+            arguments["regional_formula"] = evaluate_string_to_valid_formula_str(
+                self.regional_formula
+            )
+        if self.with_replacement:
+            arguments["with_replacement"] = True
+        if self.file_request_distribution is not None:
+            # shared once with each worker through the plan
+            arguments["file_request_distribution"] = self.file_request_distribution
+        return arguments
 
-        # then, sweep for each range
-        for index_y, value_y in enumerate(self.range_y):
-            for index_x, value_x in enumerate(self.range_x):
-                argument_matrix[index_y][index_x][self.x_axis["name"]] = value_x
-                argument_matrix[index_y][index_x][self.y_axis["name"]] = value_y
+    def _run_plan(
+        self,
+        plan: SweepPlan,
+        path: Optional[str] = None,
+        show_progress: bool = False,
+        dtype: Any = None,
+    ) -> ResultTensor:
+        """
+        Simulating every work unit of a plan with a pool of workers. Workers
+        receive the plan and a shared result tensor once, are then only sent
+        ranges of units and write their results in place. With a path the
+        tensor is a memory-mapped file, never held in memory at once, and is
+        completed into a ResultBundle.
+        :param plan: SweepPlan to simulate
+        :param path: result bundle directory, results kept in memory if None
+        :param show_progress: print a progress bar as ranges complete
+        :param dtype: dtype of the results, by default the smallest holding
+            num_of_requests misses
+        :return: ResultTensor, cells,trials matrix of caching misses
+        """
+        num_of_workers = max(1, min(self.num_of_workers, plan.num_units))
+        if dtype is None and plan.engine in WEIGHTED_ENGINES:
+            dtype = np.float64
+        elif dtype is None:
+            # misses never exceed the number of requests
+            dtype = smallest_uint_dtype(plan.maximum("num_of_requests"))
+        results = ResultTensor(
+            (plan.num_cells, plan.trials),
+            dtype,
+            None if path is None else ResultBundle.results_path(path),
+        )
+        start_time = time.time()
+        # now use multiprocessing to bring out the big guns to simulate
+        with self._start_pool(plan, results, num_of_workers) as pool:
+            self._dispatch(pool, plan, num_of_workers, show_progress)
 
+        if path is not None:
+            with timer("driver.write_bundle"):
+                ResultBundle.write(
+                    path, plan, results, {"simulation": time.time() - start_time}
+                )
+        self.profile.merge(collect())
+        return results
 
-        # now use multiprocessing to bring out the big guns to simulate
-        caching_dists: List[List[np.ndarray]] = []
+    def _start_pool(
+        self, plan: SweepPlan, results: ResultTensor, num_of_workers: int
+    ) -> Any:
+        """
+        Starting workers attached to a result tensor, and resetting the
+        driver's profile
+        :param plan: SweepPlan the workers start with
+        :param results: ResultTensor the workers write to
+        :param num_of_workers: number of worker processes
+        :return: multiprocessing Pool, terminated when its context exits
+        """
+        profiling = {"enabled": PROFILING_ENABLED, "timeline": self.profile_timeline}
+        profiling_configure(**profiling)
+        collect()
+        self.profile = Profile()
+        with timer("driver.pool_start"):
+            return mp.Pool(
+                num_of_workers,
+                initializer=_init_worker,
+                initargs=(plan, results, profiling),
+            )
+
+    def _dispatch(
+        self,
+        pool: Any,
+        plan: SweepPlan,
+        num_of_workers: int,
+        show_progress: bool = False,
+        offset: Optional[int] = None,
+    ) -> None:
+        """
+        Sending ranges of a plan's work units to a pool and waiting for them
+        :param pool: multiprocessing Pool started by _start_pool
+        :param plan: SweepPlan simulated
+        :param num_of_workers: number of worker processes of the pool
+        :param show_progress: print a progress bar as ranges complete
+        :param offset: with a plan other than the pool's, the cells of the
+            result tensor before the plan's first cell. The plan is then sent
+            along with every range.
+        """
         try:
-            with mp.Pool(len(self.range_x)) as p:
-                for row in argument_matrix:
-                    async_process = [
-                        p.apply_async(setup_and_simulate, (), arg_dict)
-                        for arg_dict in row
-                    ]
-                    caching_dists.append(
-                        [result.get(timeout=10) for result in async_process]
+            chunks = plan.chunks(num_of_workers * CHUNKS_PER_WORKER)
+            async_process = [
+                pool.apply_async(
+                    _run_units,
+                    (start, stop) if offset is None else (start, stop, plan, offset),
+                )
+                for start, stop in chunks
+            ]
+            completed = 0
+            assert self.profile is not None, "Pool was not started"
+            for result in async_process:
+                # time spent waiting on workers, including IPC
+                with timer("driver.wait"):
+                    units, collected = result.get()
+                completed += units
+                self.profile.merge(collected)
+                if show_progress:
+                    bars_completed = int(20 * completed / plan.num_units)
+                    print(
+                        f":{bars_completed * '#'}{(20 - bars_completed) * '-'}: "
+                        f"{(100 * completed / plan.num_units):.2f}%"
                     )
+        except WorkerError as e:
+            raise e.error
         except Exception as e:
-            if "division by zero" in e.args[0].lower():
+            if e.args and "division by zero" in str(e.args[0]).lower():
                 raise InvalidParametersException(
                     "Attempted to divide in range containing 0"
                 )
+            raise
+
+    def _table_plan(
+        self, formula: str, parameters: np.ndarray, trials: int
+    ) -> SweepPlan:
+        """
+        Plan of an arbitrary table of parameter overrides.
+        :param formula: evaluated formula string
+        :param parameters: structured np.ndarray overriding the driver's
+            parameters, one row per entry
+        :param trials: number of independent user simulations per entry, times
+            the columns of the engine
+        :return: SweepPlan of entries,trials units
+        """
+        return SweepPlan(
+            formula,
+            parameters,
+            self._engine_arguments(),
+            trials,
+            seed=self.seed,
+            engine=self.engine,
+        )
 
-        for prc in mp.active_children():
-            prc.terminate()
+    def _points_plan(
+        self, formula: str, points: List[Tuple[Any, Any]], trials: int
+    ) -> SweepPlan:
+        """
+        Plan of an arbitrary list of (x, y) sweep points.
+        :param formula: evaluated formula string
+        :param points: list of (x value, y value) pairs
+        :param trials: number of independent user simulations per point
+        :return: SweepPlan of points,trials units
+        """
+        values_x = np.array([value_x for value_x, _ in points])
+        values_y = np.array([value_y for _, value_y in points])
+        parameters = np.empty(
+            len(points),
+            dtype=[
+                (self.x_axis["name"], values_x.dtype),
+                (self.y_axis["name"], values_y.dtype),
+            ],
+        )
+        parameters[self.x_axis["name"]] = values_x
+        parameters[self.y_axis["name"]] = values_y
+        return self._table_plan(formula, parameters, trials)
 
-        # for now, return the length of caching purposes
-        # if needed, exact indexes are still available for index
+    def drive_adaptive(
+        self,
+        formula: str,
+        coarse_points: int = DEFAULT_ADAPTIVE_COARSE_POINTS,
+        max_points: int = DEFAULT_ADAPTIVE_MAX_POINTS,
+        threshold: float = DEFAULT_ADAPTIVE_THRESHOLD,
+        scale_x: str = "linear",
+        scale_y: str = "linear",
+    ) -> AdaptiveResult:
+        """
+        Driving simulations with adaptive grid refinement. A coarse grid spanning
+        range_x and range_y is simulated first, then only cells with large
+        gradients or noisy corners are subdivided, up to max_points points.
+        :param formula: formula string provided
+        :param coarse_points: number of coarse points per axis
+        :param max_points: total budget of simulated points
+        :param threshold: relative change (fraction of the result spread) that
+            triggers subdivision of a cell
+        :param scale_x: "linear" or "log" subdivision of the x axis
+        :param scale_y: "linear" or "log" subdivision of the y axis
+        :return: AdaptiveResult of mean caching misses per user, use
+            AdaptiveResult.resample(range_x, range_y) for a regular grid
+        """
+        formula = evaluate_string_to_valid_formula_str(formula)
+        trials = self.num_of_users * self._num_columns()
+        num_of_workers = max(1, min(self.num_of_workers, max_points * trials))
+        # one pool and one result tensor for every round, rows filled in order
+        results = ResultTensor(
+            (max_points, trials),
+            np.float64 if self.engine in WEIGHTED_ENGINES else np.int64,
+        )
+        pools: List[Any] = []
+        filled = 0
+
+        def simulate(points: List[Tuple[Any, Any]]) -> np.ndarray:
+            nonlocal filled
+            plan = self._points_plan(formula, points, trials)
+            if not pools:
+                pools.append(self._start_pool(plan, results, num_of_workers))
+            self._dispatch(pools[0], plan, num_of_workers, offset=filled)
+            rows = self._last_column(results.array[filled:filled + len(points)]).copy()
+            filled += len(points)
+            return rows
+
+        try:
+            return refine(
+                simulate,
+                self.range_x,
+                self.range_y,
+                coarse_points=coarse_points,
+                max_points=max_points,
+                threshold=threshold,
+                scale_x=scale_x,
+                scale_y=scale_y,
+            )
+        finally:
+            for pool in pools:
+                pool.terminate()
+                pool.join()
+            if self.profile is not None:
+                self.profile.merge(collect())
+
+    def drive_sweep(self, formula: str, spec: SweepSpec) -> SweepResult:
+        """
+        Driving an N-dimensional sweep. Parameters not swept by spec keep the
+        driver's values.
+        :param formula: formula string provided
+        :param spec: SweepSpec describing the swept parameters and design
+        :return: SweepResult holding num_of_users trials of caching misses per
+            point, addressable by parameter tuple
+        """
+        plan = SweepPlan(
+            evaluate_string_to_valid_formula_str(formula),
+            spec.parameter_table(),
+            self._engine_arguments(),
+            self.num_of_users * self._num_columns(),
+            axes=spec.axes,
+            seed=self.seed,
+            engine=self.engine,
+        )
+        self.results = self._run_plan(plan, self.result_path)
+        values = self._last_column(self.results.array)
+        return SweepResult(
+            plan.parameters,
+            values.astype(
+                np.float64 if self.engine in WEIGHTED_ENGINES else np.int64
+            ),
+        )
+
+    def drive_replay(
+        self, formula: str, trace_path: str, num_shards: Optional[int] = None
+    ) -> np.ndarray:
+        """
+        Driving trace replay. Every user of the trace replays its recorded
+        requests against its own placement drawn from the caching distribution.
+        :param formula: formula string provided
+        :param trace_path: ReplayTrace directory, see core.replay
+        :param num_shards: user ranges replayed as separate units, by default
+            one per worker
+        :return: x,y matrix of TOTAL caching misses over the trace
+        """
+        trace = ReplayTrace(trace_path)
+        num_shards = num_shards or self.num_of_workers
 
-        for index, row in enumerate(caching_dists):
-            caching_dists[index] = [len(item) for item in row]
+        defaults = self._default_arguments()
+        defaults["trace_path"] = trace_path
+        defaults["num_shards"] = num_shards
+        if self.file_request_distribution is None:
+            # rank popularity of the replayed trace itself
+            defaults["num_of_files"] = trace.num_of_files()
+            defaults["file_request_distribution"] = trace.request_distribution(
+                defaults["num_of_files"]
+            )
+
+        # shards of the trace are the trials of each cell
+        plan = SweepPlan.from_grid(
+            evaluate_string_to_valid_formula_str(formula),
+            defaults,
+            self.x_axis["name"],
+            self.range_x,
+            self.y_axis["name"],
+            self.range_y,
+            trials=num_shards,
+            seed=self.seed,
+            engine="replay",
+        )
+
+        self.results = self._run_plan(
+            plan, self.result_path, dtype=smallest_uint_dtype(trace.num_requests)
+        )
+        return self.results.sum_trials().reshape(
+            len(self.range_y), len(self.range_x)
+        )
+
+    def drive_epochs(
+        self,
+        formula: str,
+        epochs: List[Dict[str, Any]],
+        initial_weights: Optional[np.ndarray] = None,
+    ) -> Dict[str, np.ndarray]:
+        """
+        Driving an epoch-based simulation with drifting popularity. The caching
+        distribution is updated incrementally each epoch, and the cost of
+        keeping the first epoch's placement is measured against it.
+        :param formula: formula string provided
+        :param epochs: keyword arguments of EpochDistribution.apply per epoch,
+            e.g. {"insert": weights, "decay": 0.9}
+        :param initial_weights: item popularity of the first epoch, by default
+            the request distribution of the driver
+        :return: dict of per-epoch arrays, see core.epochs.simulate_epochs
+        """
+        if initial_weights is None:
+            initial_weights = (
+                self.file_request_distribution
+                if self.file_request_distribution is not None
+                else generate_distribution_curve(
+                    self.num_of_files, automatic=True, a=self.a
+                )
+            )
+        distribution = EpochDistribution(
+            initial_weights,
+            evaluate_string_to_valid_formula_str(formula),
+            **self._default_arguments(),
+        )
+        return simulate_epochs(
+            distribution,
+            epochs,
+            self.cache_size,
+            self.number_of_files_requested,
+            self.num_of_users,
+        )
 
-        return np.array(caching_dists)
+    def drive_population(
+        self, formula: str, population: PopulationSpec
+    ) -> PopulationResult:
+        """
+        Driving a simulation of a heterogeneous population, users of each class
+        overriding the driver's arguments (a, cache_size, num_of_requests,
+        formula variables...). Users sharing distributions are evaluated in one
+        batched pass.
+        :param formula: formula string provided
+        :param population: PopulationSpec
+        :return: PopulationResult, see PopulationResult.summary for per-class stats
+        """
+        if self.seed is not None:
+            np.random.seed(self.seed)
+        return evaluate_population(
+            evaluate_string_to_valid_formula_str(formula),
+            population,
+            self._default_arguments(),
+        )
 
 
 if __name__ == "__main__":
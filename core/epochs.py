@@ -0,0 +1,307 @@
+"""
+Time-varying popularity, simulated as a sequence of epochs
+
+Item popularity changes between epochs (insertions, decays, rank shifts). The
+rank-ordered request weights, their running sums (v) and the caching weights
+are kept between epochs and only recomputed from the first rank an epoch
+changed, as are running sums in the formula (\\sum_{n=1}^{m}). Formulas
+homogeneous in r and v (such as DEFAULT_FORMULA) are evaluated on unnormalized
+weights, so a change of total mass does not force a re-evaluation of untouched
+ranks, and a decay of every item re-evaluates none of them; other formulas are
+re-evaluated in full whenever the total mass changes, and formulas with
+windowed sums or products on every epoch.
+"""
+import numpy as np
+from typing import Any, Dict, List, Optional, Tuple
+
+from core.evaluator import _compile_formula, evaluate
+from exceptions import InvalidParametersException
+from utils.formula_compiler import AGGREGATE_PREFIX
+from utils.sanitize import sanitize
+
+# bounds of the common weight scale, folded into the weights beyond them
+MIN_WEIGHT_SCALE: float = 1e-150
+
+
+def _is_scale_invariant(
+    sympy_formula: Any, aggregates: List[Tuple[str, Any, Any, Any]]
+) -> bool:
+    # f(kr, kv) / f(r, v) independent of r and v, only a constant factor that
+    # the final normalization removes. Sums of terms scaling by g(k) scale by
+    # g(k) themselves.
+    import sympy
+
+    r, v, k = sympy.symbols("r v k", positive=True)
+    scaled = {r: k * r, v: k * v}
+
+    def ratio(item: Any) -> Any:
+        original = item.subs({sympy.Symbol("r"): r, sympy.Symbol("v"): v})
+        return sympy.simplify(original.xreplace(scaled) / original)
+
+    for index, (kind, term, _, _) in enumerate(aggregates):
+        factor = ratio(term)
+        if kind != "sum" or factor.has(r) or factor.has(v):
+            return False
+        symbol = sympy.Symbol(f"{AGGREGATE_PREFIX}{index}")
+        scaled[symbol] = factor * symbol
+    factor = ratio(sympy_formula)
+    return not factor.has(r) and not factor.has(v)
+
+
+class EpochDistribution(object):
+    """
+    Rank-ordered popularity with incrementally maintained caching weights
+    """
+
+    def __init__(self, weights: np.ndarray, formula: str, **kwargs) -> None:
+        """
+        :param weights: np.ndarray of initial popularity weights, item i has
+            weight weights[i], need not be sorted or normalized
+        :param formula: evaluated formula string
+        :param kwargs: formula variables
+        """
+        compiled = _compile_formula(formula)
+        for var in compiled.variables:
+            if var not in kwargs:
+                raise InvalidParametersException(f"Formula variable '{var}' missing")
+        self.variables = {var: kwargs[var] for var in compiled.variables}
+        self._compiled = compiled
+        self.scale_invariant = _is_scale_invariant(*compiled.expression())
+        # windowed sums and products of untouched ranks may still change
+        self.incremental = compiled.prefix_sums
+        # factor common to every weight, kept apart by uniform decays of
+        # scale-invariant formulas, whose caching weights it does not change
+        self.scale = 1.0
+
+        weights = np.asarray(weights, dtype=np.float64)
+        # rank -> item and item -> rank
+        self.items = np.argsort(-weights, kind="stable")
+        self.weights = weights[self.items]
+        self.ranks = np.empty(len(weights), dtype=np.int64)
+        self.ranks[self.items] = np.arange(len(weights))
+
+        self.cumulative = np.cumsum(self.weights)
+        # running sums of the formula's terms, maintained like cumulative
+        self.running = [np.empty(len(weights)) for _ in compiled.aggregates]
+        self.caching_weights = np.empty(len(weights))
+        self._total = self.total
+        # ranks recomputed by each refresh, for reporting
+        self.recomputed: List[int] = []
+        self._refresh(0)
+
+    @property
+    def total(self) -> float:
+        return float(self.cumulative[-1]) if len(self.cumulative) else 0.0
+
+    def _evaluate(self, first: int) -> None:
+        scale = 1.0 if self.scale_invariant else self.total
+        arguments = [
+            np.arange(first, len(self.weights)),
+            self.cumulative[first:] / scale,
+            self.weights[first:] / scale,
+            *self.variables.values(),
+        ]
+        if not self._compiled.aggregates or not self.incremental:
+            # without incremental aggregates first is 0, arrays are complete
+            values = self._compiled.function(*arguments)
+        else:
+            sums = []
+            for index, running in enumerate(self.running):
+                terms = np.broadcast_to(
+                    self._compiled.term(index)(*arguments), arguments[0].shape
+                )
+                base = running[first - 1] if first else 0.0
+                running[first:] = base + np.cumsum(terms)
+                sums.append(running[first:])
+            values = self._compiled.outer(*arguments, *sums)
+        self.caching_weights[first:] = np.nan_to_num(
+            np.broadcast_to(values, (len(self.weights) - first,))
+        )
+
+    def _refresh(self, first: int) -> None:
+        if first < len(self.weights):
+            base = self.cumulative[first - 1] if first else 0.0
+            self.cumulative[first:] = base + np.cumsum(self.weights[first:])
+        if not self.incremental or (
+            not self.scale_invariant and self.total != self._total
+        ):
+            # every normalized weight moved
+            first = 0
+        self._total = self.total
+        self._evaluate(first)
+        self.recomputed.append(len(self.weights) - first)
+
+    def _rerank(self, changed_items: np.ndarray) -> int:
+        """
+        Moving changed items to their new ranks
+        :param changed_items: items whose weight changed
+        :return: first rank whose item or weight changed
+        """
+        if not len(changed_items):
+            return len(self.weights)
+        old_ranks = self.ranks[changed_items]
+        kept = np.ones(len(self.weights), dtype=bool)
+        kept[old_ranks] = False
+        kept_items = self.items[kept]
+        kept_weights = self.weights[kept]
+
+        new_weights = self._item_weights[changed_items]
+        order = np.argsort(-new_weights, kind="stable")
+        changed_items, new_weights = changed_items[order], new_weights[order]
+        positions = np.searchsorted(-kept_weights, -new_weights, side="right")
+
+        self.items = np.insert(kept_items, positions, changed_items)
+        self.weights = np.insert(kept_weights, positions, new_weights)
+        new_ranks = positions + np.arange(len(positions))
+        first = int(min(old_ranks.min(), new_ranks.min()))
+        self.ranks[self.items[first:]] = np.arange(first, len(self.items))
+        return first
+
+    @property
+    def _item_weights(self) -> np.ndarray:
+        item_weights = np.empty(len(self.weights))
+        item_weights[self.items] = self.weights
+        return item_weights
+
+    def apply(
+        self,
+        update: Optional[Dict[int, float]] = None,
+        decay: Optional[float] = None,
+        decay_items: Optional[np.ndarray] = None,
+        insert: Optional[np.ndarray] = None,
+    ) -> int:
+        """
+        Applying one epoch of popularity changes
+        :param update: item -> new weight, e.g. rank shifts of trending items
+        :param decay: factor multiplying the weight of decay_items
+        :param decay_items: items decayed, every existing item if None
+        :param insert: np.ndarray of weights of new items, appended as new ids
+        :return: first rank that had to be recomputed
+        """
+        item_weights = self._item_weights
+        changed: List[np.ndarray] = []
+        if update:
+            items = np.fromiter(update.keys(), dtype=np.int64)
+            item_weights[items] = (
+                np.fromiter(update.values(), dtype=np.float64) / self.scale
+            )
+            changed.append(items)
+        if decay is not None:
+            if decay_items is None and self.scale_invariant and 0 < decay < np.inf:
+                # ranks, and caching weights up to a constant factor, are kept
+                self.scale *= decay
+            else:
+                items = (
+                    np.arange(len(item_weights)) if decay_items is None
+                    else np.asarray(decay_items, dtype=np.int64)
+                )
+                item_weights[items] *= decay
+                changed.append(items)
+        if insert is not None and len(insert):
+            new_items = np.arange(len(item_weights), len(item_weights) + len(insert))
+            item_weights = np.concatenate(
+                [item_weights, np.asarray(insert, dtype=np.float64) / self.scale]
+            )
+            # new items enter with zero weight at the tail, then move up
+            self.items = np.concatenate([self.items, new_items])
+            self.weights = np.concatenate([self.weights, np.zeros(len(insert))])
+            self.ranks = np.concatenate([self.ranks, np.arange(
+                len(self.ranks), len(self.ranks) + len(insert)
+            )])
+            self.cumulative = np.concatenate(
+                [self.cumulative, np.full(len(insert), self.total)]
+            )
+            self.caching_weights = np.concatenate(
+                [self.caching_weights, np.zeros(len(insert))]
+            )
+            self.running = [
+                np.concatenate([running, np.zeros(len(insert))])
+                for running in self.running
+            ]
+            changed.append(new_items)
+
+        changed_items = np.unique(np.concatenate(changed)) if changed else np.array(
+            [], dtype=np.int64
+        )
+        self.weights = item_weights[self.items]
+        first = self._rerank(changed_items)
+        if not MIN_WEIGHT_SCALE < self.scale < 1 / MIN_WEIGHT_SCALE:
+            # folded before new weights underflow or overflow
+            self.weights *= self.scale
+            self.scale = 1.0
+            first = 0
+        self._refresh(first)
+        return first
+
+    def request_distribution(self) -> np.ndarray:
+        """
+        :return: np.ndarray p_r by rank
+        """
+        return self.weights / self.total
+
+    def caching_distribution(self) -> np.ndarray:
+        """
+        :return: np.ndarray caching distribution by rank
+        """
+        return self.caching_weights / self.caching_weights.sum()
+
+    def caching_distribution_by_item(self) -> np.ndarray:
+        """
+        :return: np.ndarray caching distribution by item, to be reused as a
+            placement in later epochs
+        """
+        by_item = np.empty(len(self.items))
+        by_item[self.items] = self.caching_distribution()
+        return by_item
+
+
+def simulate_epochs(
+    distribution: EpochDistribution,
+    epochs: List[Dict[str, Any]],
+    cache_size: int,
+    num_of_requests: int,
+    trials: int,
+) -> Dict[str, np.ndarray]:
+    """
+    Measuring placement staleness across epochs. The placement distribution of
+    the first epoch is kept while popularity drifts, and compared against a
+    placement refreshed every epoch under the same request distribution.
+    :param distribution: EpochDistribution in its initial state
+    :param epochs: keyword arguments of EpochDistribution.apply, one per epoch
+    :param cache_size: files cached per user
+    :param num_of_requests: files requested per user
+    :param trials: simulated users per epoch
+    :return: dict of per-epoch arrays: "fresh" and "stale" mean misses,
+        "staleness" (their difference) and "recomputed" ranks
+    """
+    stale_by_item = distribution.caching_distribution_by_item()
+    results: Dict[str, List[float]] = {
+        "fresh": [], "stale": [], "staleness": [], "recomputed": []
+    }
+
+    for epoch in [{}] + list(epochs):
+        if epoch:
+            distribution.apply(**epoch)
+        request_dist = distribution.request_distribution()
+        # sanitized once, sampled by every trial
+        fresh_dist = sanitize(distribution.caching_distribution())
+        # items unknown when the stale placement was made are never cached
+        stale_weights = np.zeros(len(distribution.items))
+        known = distribution.items < len(stale_by_item)
+        stale_weights[known] = stale_by_item[distribution.items[known]]
+        stale_dist = sanitize(stale_weights)
+
+        fresh = np.mean([
+            len(evaluate(request_dist, fresh_dist, cache_size, num_of_requests))
+            for _ in range(trials)
+        ])
+        stale = np.mean([
+            len(evaluate(request_dist, stale_dist, cache_size, num_of_requests))
+            for _ in range(trials)
+        ])
+        results["fresh"].append(fresh)
+        results["stale"].append(stale)
+        results["staleness"].append(stale - fresh)
+        results["recomputed"].append(distribution.recomputed[-1])
+
+    return {key: np.array(values) for key, values in results.items()}
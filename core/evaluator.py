@@ -4,26 +4,30 @@ Evaluating simulations with the power of multiprocessing
 
 import numpy as np
 np.seterr(divide='ignore', invalid='ignore')
-from typing import Any
+from functools import lru_cache
+from typing import Any, Dict, Optional, Tuple, Union
 
 from utils.generate_distribution_curves import (
     generate_distribution_curve,
     modify_distribution_curve,
 )
-from utils.parse_formula import (
-    evaluate_string_to_valid_formula_str,
-    parse_to_sympy,
-    _unique_vars_in_formula,
-)
 from exceptions import InvalidParametersException
+from config import PRECISION, USE_NUMPY_ZIPF
+from utils.dtypes import float_dtype, index_dtype
+from utils.formula_compiler import CompiledFormula, compile_formula
+from utils.memo import Memo
+from utils.profiling import count, timer
+from utils.sampling import AliasTable
+from utils.sanitize import HEALTHY, SanitizedDistribution, sanitize
 
 
 def evaluate(
     file_prob_dist: np.ndarray,
-    cache_choice_prob_dist: np.ndarray,
+    cache_choice_prob_dist: Union[np.ndarray, SanitizedDistribution],
     cache_size: int,
     num_files_requested: int,
     *args,
+    with_replacement: bool = False,
     **kwargs,
 ) -> np.ndarray:
     """
@@ -34,9 +38,12 @@ def evaluate(
     Distribution array lengths must be the same.
 
     :param file_prob_dist: np.ndarray containing probability of file request
-    :param cache_choice_prob_dist: np.ndarray containing probability of file caching
+    :param cache_choice_prob_dist: np.ndarray containing probability of file caching,
+        or its SanitizedDistribution when reused across users
     :param num_files_cached: int number of files cached by user
     :param num_files_requested: int number of files requested by user
+    :param with_replacement: draw i.i.d. requests (repeats included) from the
+        request distribution's cached AliasTable, every missed request counted
     :param args - unused
     :param kwargs - unused
     :return: np.ndarray containing indexes chosen. Use length at discretion
@@ -45,56 +52,205 @@ def evaluate(
         cache_choice_prob_dist
     ), "Distribution arrays must have identical index count."
 
-    # first, choose files to be cached
-    file_indexes_cached: np.ndarray = np.array([])
+    count("evaluate.users")
+    if not isinstance(cache_choice_prob_dist, SanitizedDistribution):
+        cache_choice_prob_dist = sanitize(cache_choice_prob_dist)
+    status = cache_choice_prob_dist.status(cache_size)
+    if status != HEALTHY:
+        count(f"evaluate.{status}")
 
-    # try to choose the greatest number possible
-    try:
-        file_indexes_cached = np.random.choice(
-            len(cache_choice_prob_dist),
-            cache_size,
-            p=cache_choice_prob_dist,
-            replace=False,
-        )
-    except ValueError as e:
-        if "Fewer non-zero entries in p than size" in e.args[0]:
-            number_of_nonzero_entries = np.count_nonzero(cache_choice_prob_dist)
-            assert number_of_nonzero_entries < cache_size
-            file_indexes_cached = np.random.choice(
-                len(cache_choice_prob_dist),
-                number_of_nonzero_entries,
-                p=cache_choice_prob_dist,
-                replace=False,
-            )
-        elif "contain NaN" in e.args[0]:
-            remove_nan = np.nan_to_num(cache_choice_prob_dist)
-            number_of_nonzero_entries = np.count_nonzero(remove_nan)
-            file_indexes_cached = np.random.choice(
-                len(cache_choice_prob_dist),
-                min(number_of_nonzero_entries, cache_size),
-                p=remove_nan,
-                replace=False,
-            )
-            print(file_indexes_cached)
-        else:
-            raise InvalidParametersException(e.args[0])
+    # first, choose files to be cached, at most every file with a probability
+    with timer("evaluate.sample_cache"):
+        file_indexes_cached = cache_choice_prob_dist.sample(cache_size)
 
     # next, choose files requested
+    if with_replacement:
+        with timer("evaluate.sample_requests"):
+            files_indexes_requested = alias_table(file_prob_dist).sample(
+                num_files_requested
+            )
+        with timer("evaluate.difference"):
+            return files_indexes_requested[
+                ~np.isin(files_indexes_requested, file_indexes_cached)
+            ]
 
     # in this case, we will not permit requests asking for files in excess of lambda
     assert np.count_nonzero(file_prob_dist) >= num_files_requested
 
-    files_indexes_requested = np.random.choice(
-        len(file_prob_dist), num_files_requested, p=file_prob_dist, replace=False
+    with timer("evaluate.sample_requests"):
+        files_indexes_requested = np.random.choice(
+            len(file_prob_dist), num_files_requested, p=file_prob_dist, replace=False
+        )
+
+    # return difference, indexes in the smallest dtype indexing the files
+    with timer("evaluate.difference"):
+        return np.setdiff1d(files_indexes_requested, file_indexes_cached).astype(
+            index_dtype(len(file_prob_dist)), copy=False
+        )
+
+
+# generated request distributions, given ones converted to a precision, their
+# alias tables and the sanitized caching distributions derived from them, per
+# process. Entries hold the request distribution their key refers to by id.
+_REQUEST_DISTRIBUTIONS = Memo("request_distribution")
+_GIVEN_DISTRIBUTIONS = Memo("given_distribution")
+_ALIAS_TABLES = Memo("alias_table")
+_CACHING_DISTRIBUTIONS = Memo("caching_distribution")
+
+
+def alias_table(file_prob_dist: np.ndarray) -> AliasTable:
+    """
+    AliasTable of a request distribution, built once per process and kept
+    alongside it. Distributions must not be modified once sampled.
+    :param file_prob_dist: np.ndarray containing probability of file request
+    :return: AliasTable
+    """
+
+    def build() -> Tuple[np.ndarray, AliasTable]:
+        with timer("setup.alias_table"):
+            return file_prob_dist, AliasTable(file_prob_dist)
+
+    return _ALIAS_TABLES.get(id(file_prob_dist), build)[1]
+
+
+def _request_distribution(num_of_files: int, a: Any, precision: str) -> np.ndarray:
+    """
+    Generated Zipf request distribution, once per process and parameters
+    :param num_of_files: number of files
+    :param a: Zipf exponent, DEFAULT_ZIPF if None
+    :param precision: floating point precision
+    :return: read-only np.ndarray, shared by every caller
+    """
+
+    def build() -> np.ndarray:
+        distribution = generate_distribution_curve(
+            num_of_files, automatic=True, precision=precision, a=a
+        )
+        distribution.flags.writeable = False
+        return distribution
+
+    return _REQUEST_DISTRIBUTIONS.get((num_of_files, a, precision), build)
+
+
+def _given_distribution(
+    file_request_distribution: np.ndarray, precision: str
+) -> np.ndarray:
+    """
+    Given request distribution in a precision, converted once per process so
+    that memos keyed by its id keep hitting
+    :param file_request_distribution: given np.ndarray, e.g. shared by a plan
+    :param precision: floating point precision
+    :return: file_request_distribution itself if already in the precision
+    """
+
+    def build() -> Tuple[np.ndarray, np.ndarray]:
+        return file_request_distribution, file_request_distribution.astype(
+            float_dtype(precision), copy=False
+        )
+
+    return _GIVEN_DISTRIBUTIONS.get(
+        (id(file_request_distribution), precision), build
+    )[1]
+
+
+@lru_cache(maxsize=None)
+def _compile_formula(formula: str) -> CompiledFormula:
+    """
+    Compiling a formula once per process, see utils.formula_compiler
+    :param formula: LaTeX string
+    :return: CompiledFormula, with the variables to be supplied by the caller
+    """
+    return compile_formula(formula)
+
+
+def setup_sanitized_distributions(
+    formula: str,
+    num_of_files: int,
+    *args,
+    file_request_distribution: Optional[np.ndarray] = None,
+    precision: str = PRECISION,
+    **kwargs,
+) -> Tuple[np.ndarray, SanitizedDistribution, Dict[str, Any]]:
+    """
+    Request and caching distributions for a given set of arguments, the
+    caching distribution sanitized once and memoized per process for every
+    user sampling it
+    :param formula: sympy-ready formula
+    :param num_of_files: number of files of the generated distribution
+    :param file_request_distribution: given file distribution array, e.g. from
+        a trace, used in place of the generated Zipf distribution
+    :param precision: floating point precision of both distributions
+    :param args: unused
+    :param kwargs: arguments, including every variable of the formula
+    :return: request distribution, SanitizedDistribution of the caching
+        distribution and formula variables
+    """
+
+    # evaluate the formula, parsed once per process
+    with timer("setup.compile_formula"):
+        compiled = _compile_formula(formula)
+    var_dict = dict()
+
+    for var in compiled.variables:
+        if var not in kwargs:
+            raise InvalidParametersException(f"Formula variable '{var}' missing")
+        var_dict[var] = kwargs[var]
+
+    with timer("setup.request_distribution"):
+        if file_request_distribution is None and not USE_NUMPY_ZIPF:
+            file_request_distribution = _request_distribution(
+                num_of_files, kwargs.get("a"), precision
+            )
+        elif file_request_distribution is None:
+            file_request_distribution = generate_distribution_curve(
+                num_of_files, automatic=True, precision=precision, **kwargs
+            )
+        else:
+            file_request_distribution = _given_distribution(
+                file_request_distribution, precision
+            )
+
+    def build() -> Tuple[np.ndarray, SanitizedDistribution]:
+        with timer("setup.caching_distribution"):
+            caching_dist = modify_distribution_curve(
+                file_request_distribution, compiled, precision=precision, **var_dict
+            )
+        with timer("setup.sanitize"):
+            sanitized = sanitize(caching_dist)
+        if sanitized.repaired:
+            count("setup.repaired_weights", sanitized.repaired)
+        # shared by every later caller of the same cell
+        sanitized.probabilities.flags.writeable = False
+        return file_request_distribution, sanitized
+
+    _, caching = _CACHING_DISTRIBUTIONS.get(
+        (id(file_request_distribution), formula, precision, tuple(var_dict.items())),
+        build,
     )
+    return file_request_distribution, caching, var_dict
 
-    # return difference
-    return np.setdiff1d(files_indexes_requested, file_indexes_cached)
+
+def setup_distributions(
+    formula: str, num_of_files: int, *args, **kwargs
+) -> Tuple[np.ndarray, np.ndarray, Dict[str, Any]]:
+    """
+    Request and caching distributions for a given set of arguments, see
+    setup_sanitized_distributions
+    :param formula: sympy-ready formula
+    :param num_of_files: number of files of the generated distribution
+    :param args: unused
+    :param kwargs: arguments, including every variable of the formula
+    :return: request distribution, caching distribution (finite, non-negative
+        and normalized, or all zeros) and formula variables
+    """
+    file_request_distribution, caching, var_dict = setup_sanitized_distributions(
+        formula, num_of_files, *args, **kwargs
+    )
+    return file_request_distribution, caching.probabilities, var_dict
 
 
 def setup_and_simulate(
     formula: str,
-    # file_request_distribution: np.ndarray,
     num_of_files: int,
     num_of_requests: int,
     cache_size: int,
@@ -104,36 +260,17 @@ def setup_and_simulate(
     """
     Full, single-user simulation for a given set of arguments
     :param formula: sympy-ready formula
-    :param file_request_distribution: given file distribution array
+    :param num_of_files: number of files of the generated distribution
     :param num_of_requests: integer number of requests
     :param num_files_cached: integer number of files cached per user
     :param args: unused
     :param kwargs: (supply all arguments as keyword arguments in order
-    to allow logic to utilize them for formula analysis)
+    to allow logic to utilize them for formula analysis), including an
+    optional file_request_distribution and with_replacement
     :return: caching results
     """
-
-    # evaluate the formula
-    formula = evaluate_string_to_valid_formula_str(formula)
-    sympy_formula: Any = parse_to_sympy(formula)
-    variables_to_fill = [
-        var for var in _unique_vars_in_formula(formula) if var not in ["m", "r", "v"]
-    ]
-    var_dict = dict()
-
-    for var in variables_to_fill:
-        if var not in kwargs:
-            import ipdb
-
-            ipdb.set_trace()
-        var_dict[var] = kwargs[var]
-
-    file_request_distribution: np.ndarray = generate_distribution_curve(
-                num_of_files, automatic=True, **kwargs
-            )
-
-    caching_dist = modify_distribution_curve(
-        file_request_distribution, sympy_formula, **var_dict
+    file_request_distribution, caching_dist, var_dict = setup_sanitized_distributions(
+        formula, num_of_files, **kwargs
     )
 
     # run evaluation
@@ -142,12 +279,42 @@ def setup_and_simulate(
         caching_dist,
         cache_size,
         num_of_requests,
+        with_replacement=kwargs.get("with_replacement", False),
         **var_dict,
     )
 
     return result
 
 
+def precision_error(
+    formula: str, num_of_files: int, precision: str, **kwargs
+) -> Dict[str, float]:
+    """
+    Accuracy of reduced precision distributions against float64 ones
+    :param formula: sympy-ready formula
+    :param num_of_files: number of files of the generated distribution
+    :param precision: precision checked
+    :param kwargs: arguments, including every variable of the formula
+    :return: dict of the largest absolute and relative entry errors and the
+        total variation distance, for the "request" and "caching" distributions
+    """
+    reference = setup_distributions(
+        formula, num_of_files, precision="float64", **kwargs
+    )
+    reduced = setup_distributions(formula, num_of_files, precision=precision, **kwargs)
+    errors: Dict[str, float] = {}
+    for name, exact, approximate in zip(
+        ["request", "caching"], reference[:2], reduced[:2]
+    ):
+        difference = np.abs(approximate.astype(np.float64) - exact)
+        errors[f"{name}_max_abs"] = float(difference.max())
+        errors[f"{name}_max_rel"] = float(
+            np.max(difference[exact > 0] / exact[exact > 0])
+        )
+        errors[f"{name}_total_variation"] = float(difference.sum() / 2)
+    return errors
+
+
 if __name__ == "__main__":
     print(
         evaluate(np.array([0, 0.3, 0.4, 0.3, 0]), np.array([0.2, 0.8, 0, 0, 0]), 2, 2)
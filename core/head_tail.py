@@ -0,0 +1,81 @@
+"""
+Simulation engine over head-tail distributions, for catalogs too large to
+hold dense distributions of (e.g. num_of_files = 10^9)
+"""
+import numpy as np
+from functools import lru_cache
+from typing import Any, Dict, Tuple
+
+from config import DEFAULT_HEAD_SIZE, DEFAULT_TAIL_BUCKETS, DEFAULT_ZIPF
+from core.evaluator import _compile_formula
+from exceptions import InvalidParametersException
+from utils.sparse_distributions import HeadTailDistribution
+
+
+@lru_cache(maxsize=16)
+def head_tail_distributions(
+    formula: str,
+    num_of_files: int,
+    a: float,
+    variables: Tuple[Tuple[str, Any], ...],
+    head_size: int = DEFAULT_HEAD_SIZE,
+    num_buckets: int = DEFAULT_TAIL_BUCKETS,
+) -> Tuple[HeadTailDistribution, HeadTailDistribution]:
+    """
+    Request and caching distributions, built once per process and cell
+    :param formula: evaluated formula
+    :param num_of_files: catalog size
+    :param a: Zipf exponent
+    :param variables: (name, value) pairs of the formula variables
+    :param head_size: ranks stored densely
+    :param num_buckets: desired number of tail buckets
+    :return: request and caching HeadTailDistribution
+    """
+    compiled = _compile_formula(formula)
+    values = dict(variables)
+    for var in compiled.variables:
+        if var not in values:
+            raise InvalidParametersException(f"Formula variable '{var}' missing")
+    if not compiled.prefix_sums:
+        raise InvalidParametersException(
+            "Head-tail distributions support running sums from the first rank "
+            "only, not windowed sums or products"
+        )
+    arguments = [values[var] for var in compiled.variables]
+    request = HeadTailDistribution.zipf(num_of_files, a, head_size, num_buckets)
+    if not compiled.aggregates:
+        caching = request.map(
+            lambda m, v, r: compiled.function(m, v, r, *arguments)
+        )
+    else:
+        # each running sum is the cumulative of its terms' distribution
+        sums = [
+            request.map(lambda m, v, r, index=index: compiled.term(index)(
+                m, v, r, *arguments
+            ))
+            for index in range(len(compiled.aggregates))
+        ]
+        caching = request.map(
+            lambda m, v, r, *found: compiled.outer(m, v, r, *arguments, *found),
+            *sums,
+        )
+    return request, caching
+
+
+def head_tail_cell(arguments: Dict[str, Any], trial: int) -> int:
+    """
+    Head-tail engine, one user of one cell of a sweep
+    :param arguments: cell arguments
+    :param trial: unused
+    :return: misses of the user
+    """
+    names = _compile_formula(arguments["formula"]).variables
+    request, caching = head_tail_distributions(
+        arguments["formula"],
+        arguments["num_of_files"],
+        arguments.get("a") or DEFAULT_ZIPF,
+        tuple((var, arguments[var]) for var in names if var in arguments),
+    )
+    cached = caching.sample(arguments["cache_size"])[0]
+    requested = request.sample(arguments["num_of_requests"])[0]
+    return int(np.count_nonzero(~np.isin(requested, cached)))
@@ -0,0 +1,149 @@
+"""
+Two-tier caching, per-user edge caches backed by a shared regional cache
+
+Each user of a group holds an edge cache drawn from the caching formula, and
+the whole group shares one regional cache drawn from its own formula and size.
+A request missing the edge cache is served by the regional cache, and only
+requests missing both reach the origin. Placements and requests of a batch of
+users are sampled together and tested against membership matrices, so the
+second tier costs one extra membership lookup rather than a second simulation.
+Both tiers are reported by the same pass, one column of the results each.
+"""
+import numpy as np
+from typing import Any, Callable, Dict, List, Optional
+
+from config import HIERARCHY_BATCH_ELEMENTS
+from core.evaluator import _compile_formula, setup_distributions
+from exceptions import InvalidParametersException
+from utils.generate_distribution_curves import modify_distribution_curve
+from utils.memo import Memo
+from utils.profiling import count, timer
+from utils.sampling import membership_mask, sample_without_replacement
+from utils.sanitize import SanitizedDistribution, sanitize
+
+# regional variables are the formula's variables under this prefix, falling
+# back to the edge value, e.g. regional_alpha
+REGIONAL_PREFIX: str = "regional_"
+TIERS = ["edge", "regional"]
+
+# request distribution, formula and variables -> (request distribution,
+# sanitized regional caching distribution), per process
+_REGIONAL_DISTRIBUTIONS = Memo("regional_distribution")
+
+
+def regional_distribution(
+    file_prob_dist: np.ndarray, formula: str, arguments: Dict[str, Any]
+) -> SanitizedDistribution:
+    """
+    Caching distribution of the regional tier, sanitized once and memoized per
+    process like the edge caching distribution
+    :param file_prob_dist: np.ndarray containing probability of file request,
+        shared by every cell using it
+    :param formula: evaluated regional formula
+    :param arguments: cell arguments, regional_<var> overriding <var>
+    :return: SanitizedDistribution of the regional caching distribution
+    """
+    compiled = _compile_formula(formula)
+    var_dict: Dict[str, Any] = {}
+    for var in compiled.variables:
+        if REGIONAL_PREFIX + var in arguments:
+            var_dict[var] = arguments[REGIONAL_PREFIX + var]
+        elif var in arguments:
+            var_dict[var] = arguments[var]
+        else:
+            raise InvalidParametersException(
+                f"Regional formula variable '{var}' missing"
+            )
+
+    def build() -> Any:
+        with timer("setup.regional_distribution"):
+            caching_dist = modify_distribution_curve(
+                file_prob_dist, compiled, **var_dict
+            )
+        with timer("setup.sanitize"):
+            sanitized = sanitize(caching_dist)
+        if sanitized.repaired:
+            count("setup.repaired_weights", sanitized.repaired)
+        sanitized.probabilities.flags.writeable = False
+        return file_prob_dist, sanitized
+
+    return _REGIONAL_DISTRIBUTIONS.get(
+        (id(file_prob_dist), formula, tuple(var_dict.items())), build
+    )[1]
+
+
+def simulate_hierarchy(
+    file_prob_dist: np.ndarray,
+    edge_dist: np.ndarray,
+    regional_dist: np.ndarray,
+    cache_size: int,
+    regional_cache_size: int,
+    num_files_requested: int,
+    num_users: int,
+) -> Dict[str, np.ndarray]:
+    """
+    Misses per tier of one group of users sharing a regional cache, users
+    simulated HIERARCHY_BATCH_ELEMENTS users x files elements at a time
+    :param file_prob_dist: np.ndarray containing probability of file request
+    :param edge_dist: np.ndarray edge caching distribution
+    :param regional_dist: np.ndarray regional caching distribution
+    :param cache_size: files cached by each edge cache
+    :param regional_cache_size: files cached by the regional cache
+    :param num_files_requested: files requested per user
+    :param num_users: users in the group
+    :return: dict of per-user np.ndarray misses, "edge" (requests missing the
+        edge cache) and "regional" (requests missing both tiers)
+    """
+    num_of_files = len(file_prob_dist)
+    regional = membership_mask(
+        sample_without_replacement(regional_dist, regional_cache_size, 1),
+        num_of_files,
+    )[0]
+    misses = {tier: np.empty(num_users, dtype=np.int64) for tier in TIERS}
+    batch_users = max(1, HIERARCHY_BATCH_ELEMENTS // max(1, num_of_files))
+    for start in range(0, num_users, batch_users):
+        stop = min(start + batch_users, num_users)
+        edge = membership_mask(
+            sample_without_replacement(edge_dist, cache_size, stop - start),
+            num_of_files,
+        )
+        requested = sample_without_replacement(
+            file_prob_dist, num_files_requested, stop - start
+        )
+        edge_missed = ~edge[np.arange(stop - start)[:, None], requested]
+        regional_missed = edge_missed & ~regional[requested]
+        misses["edge"][start:stop] = np.count_nonzero(edge_missed, axis=1)
+        misses["regional"][start:stop] = np.count_nonzero(regional_missed, axis=1)
+    return misses
+
+
+def hierarchy_cell(arguments: Dict[str, Any], trial: int) -> List[int]:
+    """
+    Hierarchy engine, one group of num_users users of one cell of a sweep
+    :param arguments: cell arguments, including regional_cache_size and an
+        optional regional_formula (the edge formula by default)
+    :param trial: unused, users are simulated together
+    :return: total misses of each tier over the group, in the order of TIERS
+    """
+    file_request_distribution, edge_dist, _ = setup_distributions(**arguments)
+    regional_formula: Optional[str] = arguments.get("regional_formula")
+    regional = regional_distribution(
+        file_request_distribution,
+        regional_formula or arguments["formula"],
+        arguments,
+    )
+    misses = simulate_hierarchy(
+        file_request_distribution,
+        edge_dist,
+        regional.probabilities,
+        arguments["cache_size"],
+        arguments["regional_cache_size"],
+        arguments["num_of_requests"],
+        arguments["num_users"],
+    )
+    return [int(misses[tier].sum()) for tier in TIERS]
+
+
+HIERARCHY_ENGINES: Dict[str, Callable[[Dict[str, Any], int], Any]] = {
+    "hierarchy": hierarchy_cell
+}
@@ -0,0 +1,130 @@
+"""
+Importance sampling of rare misses
+
+Where the cache holds nearly all of the request mass (large cache_size, small
+alpha, steep Zipf a), misses are rare and plain Monte Carlo needs enormous
+numbers of users to resolve them. Requests are instead drawn i.i.d. from a
+proposal over-sampling files unlikely to be cached, and every miss is weighted
+by its likelihood ratio p/q. The weighted misses of a user are an unbiased
+estimate of its expected misses with i.i.d. requests (the with_replacement
+model of evaluate()), and the spread over users gives the estimate's variance.
+"""
+import numpy as np
+from typing import Any, Dict, Tuple, Union
+
+from config import IMPORTANCE_MIXTURE
+from core.evaluator import _compile_formula, setup_sanitized_distributions
+from utils.memo import Memo
+from utils.profiling import count, timer
+from utils.sampling import AliasTable
+from utils.sanitize import SanitizedDistribution, sanitize
+
+
+def proposal_distribution(
+    file_prob_dist: np.ndarray,
+    cache_choice_prob_dist: np.ndarray,
+    cache_size: int,
+    mixture: float = IMPORTANCE_MIXTURE,
+) -> np.ndarray:
+    """
+    Request proposal weighted by an estimate of each file's chance of missing,
+    1 - min(1, cache_size * c). The mixture with the request distribution keeps
+    every likelihood ratio at most 1 / mixture.
+    :param file_prob_dist: np.ndarray containing probability of file request
+    :param cache_choice_prob_dist: np.ndarray containing probability of file caching
+    :param cache_size: files cached per user
+    :param mixture: share of the request distribution in the proposal
+    :return: np.ndarray proposal, float64, non-zero wherever p is
+    """
+    requests = np.asarray(file_prob_dist, dtype=np.float64)
+    uncached = np.clip(1 - cache_size * np.asarray(cache_choice_prob_dist), 0, 1)
+    tail = requests * uncached
+    total = tail.sum()
+    if not total > 0:
+        # every requested file is surely cached, nothing to over-sample
+        return requests.copy()
+    return mixture * requests + (1 - mixture) * tail / total
+
+
+def importance_estimate(
+    cache_choice_prob_dist: Union[np.ndarray, SanitizedDistribution],
+    cache_size: int,
+    num_files_requested: int,
+    proposal: AliasTable,
+    likelihood_ratio: np.ndarray,
+) -> float:
+    """
+    Weighted misses of one user
+    :param cache_choice_prob_dist: np.ndarray containing probability of file
+        caching, or its SanitizedDistribution
+    :param cache_size: files cached per user
+    :param num_files_requested: i.i.d. requests of the user
+    :param proposal: AliasTable of the proposal distribution
+    :param likelihood_ratio: np.ndarray p/q of every file
+    :return: unbiased estimate of the user's expected misses
+    """
+    if not isinstance(cache_choice_prob_dist, SanitizedDistribution):
+        cache_choice_prob_dist = sanitize(cache_choice_prob_dist)
+    cached = cache_choice_prob_dist.sample(cache_size)
+    requested = proposal.sample(num_files_requested)
+    missed = requested[~np.isin(requested, cached)]
+    count("importance.misses", len(missed))
+    return float(likelihood_ratio[missed].sum())
+
+
+# cell key -> (given request distribution, caching distribution, proposal,
+# likelihood ratios)
+_PROPOSALS = Memo("importance_proposal")
+
+
+def _cell_proposal(
+    arguments: Dict[str, Any]
+) -> Tuple[SanitizedDistribution, AliasTable, np.ndarray]:
+    """
+    Distributions and proposal of a cell, built once per process. A given
+    request distribution (shared through the plan) is identified by its id,
+    and held by its entry so that the id is never reused.
+    :param arguments: cell arguments
+    :return: caching distribution, proposal AliasTable and likelihood ratios
+    """
+    given = arguments.get("file_request_distribution")
+    variables = _compile_formula(arguments["formula"]).variables
+    key = (
+        id(given),
+        arguments["formula"],
+        arguments["num_of_files"],
+        arguments.get("a"),
+        arguments.get("precision"),
+        arguments["cache_size"],
+        tuple((var, arguments.get(var)) for var in variables),
+    )
+
+    def build() -> Tuple[Any, ...]:
+        request_dist, caching, _ = setup_sanitized_distributions(**arguments)
+        with timer("importance.proposal"):
+            proposal = proposal_distribution(
+                request_dist, caching.probabilities, arguments["cache_size"]
+            )
+            with np.errstate(divide="ignore", invalid="ignore"):
+                ratio = np.where(proposal > 0, request_dist / proposal, 0.0)
+            table = AliasTable(proposal)
+        return given, caching, table, ratio
+
+    return _PROPOSALS.get(key, build)[1:]
+
+
+def importance_cell(arguments: Dict[str, Any], trial: int) -> float:
+    """
+    Importance sampling engine, one user of one cell of a sweep
+    :param arguments: cell arguments
+    :param trial: unused
+    :return: weighted misses of the user
+    """
+    caching, proposal, ratio = _cell_proposal(arguments)
+    return importance_estimate(
+        caching,
+        arguments["cache_size"],
+        arguments["num_of_requests"],
+        proposal,
+        ratio,
+    )
@@ -0,0 +1,354 @@
+"""
+Compact sweep plans shared with pool workers
+
+A plan holds the evaluated formula once, the scalar arguments common to every
+cell and one structured NumPy table of the swept parameter columns. Workers
+receive the plan once through the pool initializer and are then only sent
+ranges of work units (cell x trial) to simulate, writing results in place.
+Formulas are compiled by the parent and shipped with the plan, so workers
+never import sympy.
+"""
+import numpy as np
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+from config import MAX_UNITS_PER_CHUNK
+from core.evaluator import evaluate, setup_sanitized_distributions
+from core.delivery import DELIVERY_ENGINES
+from core.head_tail import head_tail_cell
+from core.importance import importance_cell
+from core.hierarchy import HIERARCHY_ENGINES, REGIONAL_PREFIX, TIERS
+from core.policies import POLICY_ENGINES
+from core.replay import replay_cell
+from core.results import ResultTensor
+from exceptions import InvalidParametersException, WorkerError
+from utils.formula_compiler import CompiledFormula, compile_formula, register
+from utils.profiling import collect, count, timer
+from utils.profiling import configure as profiling_configure
+
+# arguments the request distribution depends on, then the caching one
+REQUEST_KEYS: List[str] = ["num_of_files", "a", "precision"]
+
+# plan and result tensor of the current worker process, set by _init_worker
+_PLAN: Optional["SweepPlan"] = None
+_RESULTS: Optional[ResultTensor] = None
+
+
+class SweepPlan(object):
+    """
+    Array-backed description of every simulation in a sweep
+    """
+
+    def __init__(
+        self,
+        formula: str,
+        parameters: np.ndarray,
+        defaults: Dict[str, Any],
+        trials: int = 1,
+        axes: Optional[Dict[str, np.ndarray]] = None,
+        seed: Optional[int] = None,
+        engine: str = "evaluate",
+    ) -> None:
+        """
+        :param formula: evaluated formula string, shared by every cell
+        :param parameters: structured np.ndarray, one row per cell and one field
+            per swept parameter
+        :param defaults: arguments shared by every cell
+        :param trials: independent simulations per cell
+        :param axes: values of each swept axis, recorded alongside results
+        :param seed: base seed, unit u is simulated with seed (seed, u)
+        :param engine: name of the simulation engine, a key of ENGINES
+        """
+        assert engine in ENGINES, f"Unknown engine '{engine}'"
+        self.formula = formula
+        self.parameters = parameters
+        self.defaults = defaults
+        self.trials = trials
+        self.axes = axes if axes is not None else {}
+        self.seed = seed
+        self.engine = engine
+        # compiled here rather than in every worker
+        self.compiled: List[CompiledFormula] = [
+            compile_formula(name)
+            for name in (formula, defaults.get("regional_formula"))
+            if name
+        ]
+        self.validate()
+        # cells in the order they are simulated, and the positions in that
+        # order where the upstream distributions change
+        self.order, self.group_starts = self.schedule()
+
+    @classmethod
+    def from_grid(
+        cls,
+        formula: str,
+        defaults: Dict[str, Any],
+        x_name: str,
+        range_x: Union[List[Union[int, float]], np.ndarray],
+        y_name: str,
+        range_y: Union[List[Union[int, float]], np.ndarray],
+        trials: int = 1,
+        seed: Optional[int] = None,
+        engine: str = "evaluate",
+    ) -> "SweepPlan":
+        """
+        Plan of a two-axis grid, cells ordered y-major so that results reshape
+        to (len(range_y), len(range_x))
+        """
+        range_x = np.asarray(range_x)
+        range_y = np.asarray(range_y)
+        parameters = np.empty(
+            len(range_x) * len(range_y),
+            dtype=[(x_name, range_x.dtype), (y_name, range_y.dtype)],
+        )
+        parameters[x_name] = np.tile(range_x, len(range_y))
+        parameters[y_name] = np.repeat(range_y, len(range_x))
+        return cls(
+            formula,
+            parameters,
+            defaults,
+            trials,
+            axes={y_name: range_y, x_name: range_x},
+            seed=seed,
+            engine=engine,
+        )
+
+    def validate(self) -> None:
+        """
+        Checking that every cell supplies every formula variable and the
+        arguments of its engine, so that invalid sweeps fail before any work is
+        dispatched to the pool
+        """
+        supplied = set(self.defaults) | set(self.parameters.dtype.names or ())
+        for name in ENGINE_ARGUMENTS.get(self.engine, []):
+            if name not in supplied:
+                raise InvalidParametersException(
+                    f"Engine '{self.engine}' requires argument '{name}'"
+                )
+        columns = len(ENGINE_COLUMNS.get(self.engine, [None]))
+        if self.trials % columns:
+            raise InvalidParametersException(
+                f"Engine '{self.engine}' fills {columns} trials per unit"
+            )
+        if self.engine in PREFIX_SUM_ENGINES and not all(
+            compiled.prefix_sums for compiled in self.compiled
+        ):
+            raise InvalidParametersException(
+                f"Engine '{self.engine}' supports running sums from the first "
+                "rank only, not windowed sums or products"
+            )
+        for index, compiled in enumerate(self.compiled):
+            for var in compiled.variables:
+                # the regional formula falls back to the edge variables
+                if var not in supplied and not (
+                    index and REGIONAL_PREFIX + var in supplied
+                ):
+                    raise InvalidParametersException(
+                        f"Formula variable '{var}' of {compiled.formula} missing"
+                    )
+
+    def schedule(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Ordering cells by the swept arguments of their request distribution,
+        then of their caching distribution (formula variables), so that
+        consecutive cells of a worker reuse its memoized distributions. Results
+        keep the cell order of the parameter table.
+        :return: np.ndarray of cells in simulation order, and np.ndarray of the
+            first position of each group of cells sharing both distributions
+        """
+        names = self.parameters.dtype.names or ()
+        variables = {
+            prefix + var
+            for compiled in self.compiled
+            for var in compiled.variables
+            for prefix in ("", REGIONAL_PREFIX)
+        }
+        keys = [name for name in REQUEST_KEYS if name in names] + [
+            name for name in names if name in variables and name not in REQUEST_KEYS
+        ]
+        if not keys or not self.num_cells:
+            return np.arange(self.num_cells), np.zeros(
+                min(1, self.num_cells), dtype=np.int64
+            )
+        # stable, cells sharing every key keep their table order
+        order = np.lexsort([self.parameters[name] for name in reversed(keys)])
+        ordered = self.parameters[order]
+        changed = np.zeros(self.num_cells - 1, dtype=bool)
+        for name in keys:
+            changed |= ordered[name][1:] != ordered[name][:-1]
+        return order, np.concatenate([[0], np.flatnonzero(changed) + 1])
+
+    @property
+    def num_cells(self) -> int:
+        return len(self.parameters)
+
+    @property
+    def num_units(self) -> int:
+        return self.num_cells * self.trials
+
+    def cell_arguments(self, cell: int) -> Dict[str, Any]:
+        """
+        :param cell: row of the parameter table
+        :return: full keyword arguments for setup_and_simulate
+        """
+        arguments = dict(self.defaults)
+        arguments["formula"] = self.formula
+        row = self.parameters[cell]
+        for name in self.parameters.dtype.names or ():
+            arguments[name] = row[name].item()
+        return arguments
+
+    def maximum(self, name: str) -> Any:
+        """
+        :param name: argument name
+        :return: largest value of the argument over every cell
+        """
+        if name in (self.parameters.dtype.names or ()) and self.num_cells:
+            return self.parameters[name].max().item()
+        return self.defaults[name]
+
+    def chunks(self, num_chunks: int) -> List[Tuple[int, int]]:
+        """
+        Splitting the scheduled work units into contiguous ranges of at most
+        MAX_UNITS_PER_CHUNK units, aligned to cell boundaries where possible.
+        Bounds move to the nearest group boundary within half a range, so that
+        each group of cells sharing distributions sticks to a single worker.
+        :param num_chunks: desired number of ranges
+        :return: list of [start, stop) ranges of positions in the schedule,
+            position p is trial p % trials of cell order[p // trials]
+        """
+        num_chunks = max(num_chunks, -(-self.num_units // MAX_UNITS_PER_CHUNK), 1)
+        bounds = np.linspace(0, self.num_units, num_chunks + 1).astype(np.int64)
+        if self.num_units // num_chunks >= self.trials:
+            bounds = (bounds // self.trials) * self.trials
+            bounds[-1] = self.num_units
+        step = self.num_units // num_chunks
+        tolerance = min(step, MAX_UNITS_PER_CHUNK - step) // 2
+        if tolerance > 0 and len(self.group_starts) > 1:
+            edges = np.append(self.group_starts, self.num_cells) * self.trials
+            after = np.minimum(np.searchsorted(edges, bounds), len(edges) - 1)
+            before = edges[np.maximum(after - 1, 0)]
+            after = edges[after]
+            nearest = np.where(bounds - before <= after - bounds, before, after)
+            bounds = np.unique(
+                np.where(np.abs(nearest - bounds) <= tolerance, nearest, bounds)
+            )
+        return [
+            (int(start), int(stop))
+            for start, stop in zip(bounds[:-1], bounds[1:])
+            if stop > start
+        ]
+
+
+def _evaluate_unit(arguments: Dict[str, Any], trial: int) -> int:
+    request_dist, caching, var_dict = setup_sanitized_distributions(**arguments)
+    if caching.empty:
+        # nothing can be cached, every (distinct) requested file misses
+        count("evaluate.analytic")
+        return arguments["num_of_requests"]
+    return len(evaluate(
+        request_dist,
+        caching,
+        arguments["cache_size"],
+        arguments["num_of_requests"],
+        with_replacement=arguments.get("with_replacement", False),
+        **var_dict,
+    ))
+
+
+# simulation engines, each called with a cell's arguments and the trial number
+ENGINES: Dict[str, Callable[[Dict[str, Any], int], Any]] = {
+    "evaluate": _evaluate_unit,
+    "replay": replay_cell,
+    "head_tail": head_tail_cell,
+    "importance": importance_cell,
+    **POLICY_ENGINES,
+    **DELIVERY_ENGINES,
+    **HIERARCHY_ENGINES,
+}
+# arguments an engine reads beyond those of the evaluate engine
+ENGINE_ARGUMENTS: Dict[str, List[str]] = {"replay": ["trace_path", "num_shards"]}
+# engines whose units each fill several consecutive trials, trial t of a
+# cell holding column t % len(columns)
+ENGINE_COLUMNS: Dict[str, List[str]] = {"hierarchy": TIERS}
+# engines maintaining running sums of formulas themselves
+PREFIX_SUM_ENGINES: List[str] = ["head_tail"]
+# engines simulating all num_users users of a cell in a single unit
+USER_BATCHED_ENGINES: List[str] = [
+    *POLICY_ENGINES, *DELIVERY_ENGINES, *HIERARCHY_ENGINES
+]
+# engines returning weighted estimates of misses rather than counts
+WEIGHTED_ENGINES: List[str] = ["importance"]
+
+
+def _init_worker(
+    plan: SweepPlan,
+    results: ResultTensor,
+    profiling: Optional[Dict[str, bool]] = None,
+) -> None:
+    global _PLAN, _RESULTS
+    _PLAN = plan
+    _RESULTS = results
+    for compiled in plan.compiled:
+        register(compiled)
+    profiling_configure(**(profiling or {}))
+
+
+def _run_units(
+    start: int, stop: int, plan: Optional[SweepPlan] = None, offset: int = 0
+) -> Tuple[int, Dict[str, Any]]:
+    """
+    Simulating a range of work units of the worker's plan, caching misses are
+    written to the shared result tensor at the units' offsets
+    :param start: first position in the plan's schedule, see SweepPlan.chunks
+    :param stop: position after the last
+    :param plan: SweepPlan replacing the worker's plan, for pools simulating
+        several plans into one result tensor
+    :param offset: cells of the result tensor before the plan's first cell
+    :return: number of units simulated, and the worker's profiling data
+        collected since its previous range
+    """
+    global _PLAN
+    if plan is not None:
+        _PLAN = plan
+        for compiled in plan.compiled:
+            register(compiled)
+    assert _PLAN is not None and _RESULTS is not None, (
+        "Worker was not initialized with a plan"
+    )
+    engine = ENGINES[_PLAN.engine]
+    stage = f"engine.{_PLAN.engine}"
+    columns = len(ENGINE_COLUMNS.get(_PLAN.engine, [None]))
+    # a unit starting in the range may fill trials past its end
+    misses = np.empty(stop - start + columns - 1, dtype=_RESULTS.dtype)
+    # unit u is trial u % trials of cell u // trials
+    units = np.empty(len(misses), dtype=np.int64)
+    filled = 0
+    cell = -1
+    arguments: Dict[str, Any] = {}
+    try:
+        for position in range(start, stop):
+            trial = position % _PLAN.trials
+            if trial % columns:
+                # filled along with the first column, by this range or the last
+                continue
+            if _PLAN.order[position // _PLAN.trials] != cell:
+                cell = int(_PLAN.order[position // _PLAN.trials])
+                arguments = _PLAN.cell_arguments(cell)
+            unit = (offset + cell) * _PLAN.trials + trial
+            if _PLAN.seed is not None:
+                # seeded per unit, results do not depend on how units are
+                # scheduled
+                np.random.seed([_PLAN.seed, unit])
+            with timer(stage):
+                misses[filled:filled + columns] = engine(arguments, trial)
+            units[filled:filled + columns] = np.arange(unit, unit + columns)
+            filled += columns
+    except (Exception, KeyboardInterrupt, SystemExit):
+        raise
+    except BaseException as error:
+        # e.g. InvalidParametersException, which would kill the worker
+        raise WorkerError(error)
+    with timer("worker.write_results"):
+        _RESULTS.write_units(units[:filled], misses[:filled])
+    count("worker.units", stop - start)
+    return stop - start, collect()
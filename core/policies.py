@@ -0,0 +1,139 @@
+"""
+Online cache policies simulated for many independent users at once
+
+Every user holds a cache of cache_size slots. Cache contents and per-slot
+bookkeeping (last use, request count, insertion time) are (users, slots) NumPy
+arrays, so each time step is a handful of vectorized operations over all users.
+The formula-driven static placement is included as the "static" policy so the
+online policies can be compared under the same request stream.
+"""
+import numpy as np
+from typing import Any, Callable, Dict, Optional
+
+from config import POLICY_STEPS_PER_BLOCK
+from exceptions import InvalidParametersException
+from core.evaluator import setup_distributions
+from utils.sampling import membership_mask, sample_without_replacement
+
+POLICIES = ["lru", "lfu", "fifo", "static"]
+
+
+def _request_block(
+    file_prob_dist: np.ndarray, num_steps: int, num_users: int
+) -> np.ndarray:
+    # i.i.d. requests, with replacement, for a block of time steps
+    return np.random.choice(
+        len(file_prob_dist), (num_steps, num_users), p=file_prob_dist
+    )
+
+
+def simulate_policy(
+    policy: str,
+    file_prob_dist: np.ndarray,
+    cache_size: int,
+    num_of_requests: int,
+    num_users: int,
+    cache_choice_prob_dist: Optional[np.ndarray] = None,
+    requests: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """
+    Time-stepped simulation of a cache policy for independent users, caches
+    start empty and every request is counted
+    :param policy: one of POLICIES
+    :param file_prob_dist: np.ndarray containing probability of file request
+    :param cache_size: slots per user
+    :param num_of_requests: requests per user
+    :param num_users: number of users simulated together
+    :param cache_choice_prob_dist: caching distribution, "static" policy only
+    :param requests: num_of_requests,num_users np.ndarray of requested files,
+        replacing i.i.d. requests drawn from file_prob_dist
+    :return: np.ndarray of misses per user
+    """
+    if policy not in POLICIES:
+        raise InvalidParametersException(f"Unknown cache policy '{policy}'")
+    if policy == "static" and cache_choice_prob_dist is None:
+        raise InvalidParametersException("Static placement needs a caching dist")
+    if cache_size <= 0:
+        # a cache without slots misses every request
+        return np.full(num_users, num_of_requests, dtype=np.int64)
+    misses = np.zeros(num_users, dtype=np.int64)
+
+    def request_block(start: int) -> np.ndarray:
+        stop = min(start + POLICY_STEPS_PER_BLOCK, num_of_requests)
+        if requests is not None:
+            return np.asarray(requests[start:stop])
+        return _request_block(file_prob_dist, stop - start, num_users)
+
+    if policy == "static":
+        cached = membership_mask(
+            sample_without_replacement(cache_choice_prob_dist, cache_size, num_users),
+            len(file_prob_dist),
+        )
+        users = np.arange(num_users)
+        for start in range(0, num_of_requests, POLICY_STEPS_PER_BLOCK):
+            block = request_block(start)
+            misses += np.count_nonzero(~cached[users, block], axis=0)
+        return misses
+
+    users = np.arange(num_users)
+    # -1 marks an empty slot, which always scores lowest and is filled first
+    cache = np.full((num_users, cache_size), -1, dtype=np.int64)
+    last_used = np.full((num_users, cache_size), -1, dtype=np.int64)
+    inserted = np.full((num_users, cache_size), -1, dtype=np.int64)
+    frequency = np.zeros((num_users, cache_size), dtype=np.int64)
+
+    for start in range(0, num_of_requests, POLICY_STEPS_PER_BLOCK):
+        block = request_block(start)
+        for offset, requests in enumerate(block):
+            step = start + offset
+            match = cache == requests[:, None]
+            hit = match.any(axis=1)
+
+            if policy == "lru":
+                score = last_used
+            elif policy == "fifo":
+                score = inserted
+            else:
+                # least frequently used, ties broken by recency
+                score = np.where(
+                    cache < 0, -1, frequency * (num_of_requests + 1) + last_used
+                )
+            slot = np.where(hit, match.argmax(axis=1), score.argmin(axis=1))
+
+            misses += ~hit
+            cache[users, slot] = requests
+            last_used[users, slot] = step
+            frequency[users, slot] = np.where(hit, frequency[users, slot] + 1, 1)
+            inserted[users, slot] = np.where(hit, inserted[users, slot], step)
+
+    return misses
+
+
+def _policy_engine(policy: str) -> Callable[[Dict[str, Any], int], int]:
+    def policy_cell(arguments: Dict[str, Any], trial: int) -> int:
+        """
+        Policy engine, num_users users of one cell of a sweep
+        :param arguments: cell arguments
+        :param trial: unused, users are simulated together
+        :return: total misses over all users
+        """
+        file_request_distribution, caching_dist, _ = setup_distributions(
+            **arguments
+        )
+        return int(
+            simulate_policy(
+                policy,
+                file_request_distribution,
+                arguments["cache_size"],
+                arguments["num_of_requests"],
+                arguments["num_users"],
+                caching_dist,
+            ).sum()
+        )
+
+    return policy_cell
+
+
+POLICY_ENGINES: Dict[str, Callable[[Dict[str, Any], int], int]] = {
+    policy: _policy_engine(policy) for policy in POLICIES
+}
@@ -0,0 +1,210 @@
+"""
+Heterogeneous user populations evaluated in batched passes
+
+Users may differ in Zipf exponent, cache size, number of requests or formula
+variables. Users sharing a request and caching distribution are grouped, and
+each group is sampled at once (placements and requests of every user as rows
+of one array), so there is no Python loop per user.
+"""
+import numpy as np
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from config import POPULATION_BATCH_ELEMENTS
+from core.evaluator import setup_distributions
+from exceptions import InvalidParametersException
+from utils.sampling import sample_without_replacement
+
+# per-user columns sized by sampling rather than shaping the distributions
+SIZE_COLUMNS: List[str] = ["cache_size", "num_of_requests"]
+
+
+class PopulationSpec(object):
+    """
+    Population made of classes of identical users
+    """
+
+    def __init__(self, classes: List[Dict[str, Any]]) -> None:
+        """
+        :param classes: one dict per class holding "count" (number of users),
+            an optional "name" and any simulation arguments overriding the
+            driver's, e.g. {"count": 100, "a": 1.2, "cache_size": 50}
+        """
+        if not classes:
+            raise InvalidParametersException("Populations need at least one class")
+        self.classes = classes
+
+    @classmethod
+    def sample(
+        cls,
+        num_users: int,
+        distributions: Dict[str, Tuple[Sequence[Any], Optional[Sequence[float]]]],
+        seed: Optional[int] = None,
+    ) -> "PopulationSpec":
+        """
+        Drawing each user's parameters independently
+        :param num_users: number of users
+        :param distributions: argument name -> (values, probabilities or None
+            for uniform), e.g. {"a": ([0.8, 1.2], [0.3, 0.7])}
+        :param seed: random seed
+        :return: PopulationSpec with one class per distinct combination
+        """
+        rng = np.random.default_rng(seed)
+        names = list(distributions.keys())
+        draws = [
+            rng.choice(len(values), num_users, p=probabilities)
+            for values, probabilities in distributions.values()
+        ]
+        combinations, counts = np.unique(
+            np.stack(draws, axis=1), axis=0, return_counts=True
+        )
+        classes = []
+        for combination, count in zip(combinations, counts):
+            user_class: Dict[str, Any] = {"count": int(count)}
+            for name, choice in zip(names, combination):
+                user_class[name] = distributions[name][0][choice]
+            classes.append(user_class)
+        return cls(classes)
+
+    @property
+    def num_users(self) -> int:
+        return sum(user_class["count"] for user_class in self.classes)
+
+    def names(self) -> List[str]:
+        """
+        :return: name of each class
+        """
+        return [
+            user_class.get("name", f"class_{index}")
+            for index, user_class in enumerate(self.classes)
+        ]
+
+
+class PopulationResult(object):
+    """
+    Misses of every user of a population
+    """
+
+    def __init__(
+        self, spec: PopulationSpec, user_classes: np.ndarray, misses: np.ndarray
+    ) -> None:
+        """
+        :param spec: PopulationSpec evaluated
+        :param user_classes: np.ndarray class index of each user
+        :param misses: np.ndarray misses of each user
+        """
+        self.spec = spec
+        self.user_classes = user_classes
+        self.misses = misses
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """
+        :return: class name (and "all") -> count, mean and standard deviation
+            of misses per user
+        """
+        summary: Dict[str, Dict[str, float]] = {}
+        for index, name in enumerate(self.spec.names()):
+            class_misses = self.misses[self.user_classes == index]
+            summary[name] = {
+                "count": len(class_misses),
+                "mean": float(class_misses.mean()) if len(class_misses) else 0.0,
+                "std": float(class_misses.std()) if len(class_misses) else 0.0,
+            }
+        summary["all"] = {
+            "count": len(self.misses),
+            "mean": float(self.misses.mean()),
+            "std": float(self.misses.std()),
+        }
+        return summary
+
+
+def evaluate_group(
+    file_prob_dist: np.ndarray,
+    cache_choice_prob_dist: np.ndarray,
+    cache_sizes: np.ndarray,
+    num_files_requested: np.ndarray,
+) -> np.ndarray:
+    """
+    evaluate() for many users sharing both distributions at once. Each user's
+    placement and requests are prefixes of one batched sample without
+    replacement, sized per user.
+    :param file_prob_dist: np.ndarray containing probability of file request
+    :param cache_choice_prob_dist: np.ndarray containing probability of file caching
+    :param cache_sizes: np.ndarray of files cached by each user
+    :param num_files_requested: np.ndarray of files requested by each user
+    :return: np.ndarray of misses per user
+    """
+    num_users = len(cache_sizes)
+    num_of_files = len(file_prob_dist)
+    rows = np.arange(num_users)[:, None]
+
+    cached_indexes = sample_without_replacement(
+        cache_choice_prob_dist, int(cache_sizes.max(initial=0)), num_users
+    )
+    cached = np.zeros((num_users, num_of_files), dtype=bool)
+    in_cache = np.arange(cached_indexes.shape[1]) < cache_sizes[:, None]
+    owners = np.broadcast_to(rows, in_cache.shape)[in_cache]
+    cached[owners, cached_indexes[in_cache]] = True
+
+    requested = sample_without_replacement(
+        file_prob_dist, int(num_files_requested.max(initial=0)), num_users
+    )
+    in_request = np.arange(requested.shape[1]) < num_files_requested[:, None]
+    missed = in_request & ~cached[rows, requested]
+    return np.count_nonzero(missed, axis=1)
+
+
+def evaluate_population(
+    formula: str, spec: PopulationSpec, defaults: Dict[str, Any]
+) -> PopulationResult:
+    """
+    Evaluating every user of a population, grouped by shared distributions
+    :param formula: evaluated formula string
+    :param spec: PopulationSpec
+    :param defaults: arguments of users whose class does not override them
+    :return: PopulationResult
+    """
+    user_classes = np.repeat(
+        np.arange(len(spec.classes)), [c["count"] for c in spec.classes]
+    )
+    misses = np.zeros(len(user_classes), dtype=np.int64)
+
+    # classes differing only in sizes share their distributions
+    groups: Dict[Tuple[Any, ...], List[int]] = {}
+    for index, user_class in enumerate(spec.classes):
+        arguments = {**defaults, **user_class}
+        key = tuple(
+            (name, arguments[name]) for name in sorted(arguments)
+            if name not in SIZE_COLUMNS + ["count", "name"]
+            and not isinstance(arguments[name], np.ndarray)
+        )
+        groups.setdefault(key, []).append(index)
+
+    # per-class sizes, looked up per user
+    sizes = {
+        column: np.array([{**defaults, **c}[column] for c in spec.classes])
+        for column in SIZE_COLUMNS
+    }
+
+    for class_indexes in groups.values():
+        arguments = {**defaults, **spec.classes[class_indexes[0]]}
+        arguments.pop("count")
+        arguments.pop("name", None)
+        file_request_distribution, caching_dist, _ = setup_distributions(
+            formula=formula, **arguments
+        )
+
+        users = np.flatnonzero(np.isin(user_classes, class_indexes))
+        cache_sizes = sizes["cache_size"][user_classes[users]]
+        num_requests = sizes["num_of_requests"][user_classes[users]]
+
+        batch = max(1, POPULATION_BATCH_ELEMENTS // len(file_request_distribution))
+        for start in range(0, len(users), batch):
+            stop = start + batch
+            misses[users[start:stop]] = evaluate_group(
+                file_request_distribution,
+                caching_dist,
+                cache_sizes[start:stop],
+                num_requests[start:stop],
+            )
+
+    return PopulationResult(spec, user_classes, misses)
@@ -0,0 +1,206 @@
+"""
+Replaying recorded request sequences against sampled cache placements
+
+A replay trace is a directory holding every user's requests, as ranks of the
+request distribution, grouped by user (requests.npy) and the offset of each
+user's sequence (offsets.npy). Both are memory-mapped, so workers only touch
+the users of the shard they replay.
+"""
+import os
+import numpy as np
+from functools import lru_cache
+from typing import Any, List, Tuple
+
+from config import REPLAY_BATCH_ELEMENTS
+from exceptions import InvalidParametersException
+from core.evaluator import setup_distributions
+from utils.dtypes import smallest_uint_dtype
+from utils.sampling import membership_mask, sample_without_replacement
+from utils.traces import DenseIdIndex, iter_user_trace_chunks
+
+REQUESTS_FILE: str = "requests.npy"
+OFFSETS_FILE: str = "offsets.npy"
+
+
+class ReplayTrace(object):
+    """
+    Memory-mapped per-user request sequences
+    """
+
+    def __init__(self, path: str) -> None:
+        """
+        :param path: trace directory
+        """
+        self.path = path
+        self.requests: np.ndarray = np.load(
+            os.path.join(path, REQUESTS_FILE), mmap_mode="r"
+        )
+        self.offsets: np.ndarray = np.load(os.path.join(path, OFFSETS_FILE))
+
+    @classmethod
+    def write(cls, path: str, sequences: List[np.ndarray]) -> "ReplayTrace":
+        """
+        Writing in-memory sequences as a trace
+        :param path: trace directory
+        :param sequences: one np.ndarray of request ranks per user
+        :return: ReplayTrace
+        """
+        os.makedirs(path, exist_ok=True)
+        lengths = [len(sequence) for sequence in sequences]
+        requests = np.concatenate(sequences) if sequences else np.array([0])
+        np.save(
+            os.path.join(path, REQUESTS_FILE),
+            requests.astype(smallest_uint_dtype(int(requests.max(initial=0)))),
+        )
+        np.save(os.path.join(path, OFFSETS_FILE), np.cumsum([0] + lengths))
+        return cls(path)
+
+    @property
+    def num_users(self) -> int:
+        return len(self.offsets) - 1
+
+    @property
+    def num_requests(self) -> int:
+        return int(self.offsets[-1])
+
+    def num_of_files(self) -> int:
+        """
+        :return: smallest catalog holding every requested rank
+        """
+        highest = -1
+        for start in range(0, self.num_requests, REPLAY_BATCH_ELEMENTS):
+            chunk = self.requests[start:start + REPLAY_BATCH_ELEMENTS]
+            highest = max(highest, int(chunk.max()))
+        return highest + 1
+
+    def shard(self, shard: int, num_shards: int) -> Tuple[int, int]:
+        """
+        :param shard: shard number
+        :param num_shards: number of equal user ranges the trace is split into
+        :return: [start, stop) range of users in the shard
+        """
+        bounds = np.linspace(0, self.num_users, num_shards + 1).astype(np.int64)
+        return int(bounds[shard]), int(bounds[shard + 1])
+
+    def request_distribution(self, num_of_files: int) -> np.ndarray:
+        """
+        :param num_of_files: catalog size
+        :return: np.ndarray empirical request distribution of the trace by rank
+        """
+        counts = np.zeros(num_of_files, dtype=np.int64)
+        for start in range(0, self.num_requests, REPLAY_BATCH_ELEMENTS):
+            counts += np.bincount(
+                self.requests[start:start + REPLAY_BATCH_ELEMENTS],
+                minlength=num_of_files,
+            )
+        return counts / max(1, counts.sum())
+
+
+def build_replay_trace(
+    log_path: str, path: str, ranked_ids: np.ndarray, **kwargs
+) -> ReplayTrace:
+    """
+    Converting a (user, object) access log into a replay trace in two streaming
+    passes, memory bounded by the number of users and objects
+    :param log_path: access log
+    :param path: trace directory
+    :param ranked_ids: object ID of each rank, e.g. from trace_request_distribution
+    :param kwargs: passed to utils.traces.iter_user_trace_chunks
+    :return: ReplayTrace
+    """
+    rank_order = np.argsort(ranked_ids)
+    sorted_ids = np.asarray(ranked_ids)[rank_order]
+
+    def ranks_of(ids: np.ndarray) -> np.ndarray:
+        positions = np.clip(np.searchsorted(sorted_ids, ids), 0, len(sorted_ids) - 1)
+        if np.any(sorted_ids[positions] != ids):
+            raise InvalidParametersException("Log holds objects missing from ranking")
+        return rank_order[positions]
+
+    # first pass, requests per user
+    users = DenseIdIndex()
+    counts = np.zeros(0, dtype=np.int64)
+    for user_ids, _ in iter_user_trace_chunks(log_path, **kwargs):
+        chunk_counts = np.bincount(users.index(user_ids), minlength=len(users))
+        counts = np.pad(counts, (0, len(chunk_counts) - len(counts)))
+        counts += chunk_counts
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    # second pass, scatter each chunk after the user's previous requests
+    os.makedirs(path, exist_ok=True)
+    requests = np.lib.format.open_memmap(
+        os.path.join(path, REQUESTS_FILE),
+        mode="w+",
+        dtype=smallest_uint_dtype(max(0, len(ranked_ids) - 1)),
+        shape=(int(offsets[-1]),),
+    )
+    cursors = offsets[:-1].copy()
+    for user_ids, ids in iter_user_trace_chunks(log_path, **kwargs):
+        dense_users = users.index(user_ids)
+        order = np.argsort(dense_users, kind="stable")
+        sorted_users = dense_users[order]
+        group_starts = np.searchsorted(sorted_users, sorted_users)
+        positions = cursors[sorted_users] + np.arange(len(order)) - group_starts
+        requests[positions] = ranks_of(ids[order])
+        cursors += np.bincount(dense_users, minlength=len(cursors))
+    requests.flush()
+    np.save(os.path.join(path, OFFSETS_FILE), offsets)
+    return ReplayTrace(path)
+
+
+@lru_cache(maxsize=None)
+def _load_trace(path: str) -> ReplayTrace:
+    # one map per worker process and trace
+    return ReplayTrace(path)
+
+
+def replay(
+    trace: ReplayTrace,
+    caching_dist: np.ndarray,
+    cache_size: int,
+    user_start: int,
+    user_stop: int,
+) -> int:
+    """
+    Replaying a range of users, each against its own placement drawn from the
+    caching distribution. Placements of a batch of users are sampled together
+    and requests are tested against a users x files membership matrix.
+    :param trace: ReplayTrace
+    :param caching_dist: np.ndarray containing probability of file caching
+    :param cache_size: files cached per user
+    :param user_start: first user replayed
+    :param user_stop: user after the last
+    :return: total misses of the replayed requests
+    """
+    num_of_files = len(caching_dist)
+    batch_users = max(1, REPLAY_BATCH_ELEMENTS // max(1, num_of_files))
+    misses = 0
+    for batch_start in range(user_start, user_stop, batch_users):
+        batch_stop = min(batch_start + batch_users, user_stop)
+        cached = membership_mask(
+            sample_without_replacement(
+                caching_dist, cache_size, batch_stop - batch_start
+            ),
+            num_of_files,
+        )
+        first, last = trace.offsets[batch_start], trace.offsets[batch_stop]
+        requests = np.asarray(trace.requests[first:last])
+        owners = np.repeat(
+            np.arange(batch_stop - batch_start),
+            np.diff(trace.offsets[batch_start:batch_stop + 1]),
+        )
+        misses += int(len(requests) - np.count_nonzero(cached[owners, requests]))
+    return misses
+
+
+def replay_cell(arguments: Any, shard: int) -> int:
+    """
+    Replay engine, one shard of the trace for one cell of a sweep
+    :param arguments: cell arguments, including trace_path and num_shards
+    :param shard: shard of the trace to replay
+    :return: total misses of the shard
+    """
+    trace = _load_trace(arguments["trace_path"])
+    _, caching_dist, _ = setup_distributions(**arguments)
+    user_start, user_stop = trace.shard(shard, arguments["num_shards"])
+    return replay(trace, caching_dist, arguments["cache_size"], user_start, user_stop)
@@ -0,0 +1,370 @@
+"""
+Result tensors written in place by pool workers
+
+The parent allocates the tensor once, workers attach to the same memory and
+write each unit's result at its own offset, so no results are pickled back.
+Tensors too large for memory are backed by a memory-mapped .npy file instead,
+stored as part of a self-describing result bundle.
+"""
+import ctypes
+import json
+import multiprocessing as mp
+import os
+import numpy as np
+from typing import Any, Dict, List, Optional, Tuple
+
+from config import RESULT_READ_CHUNK_ENTRIES
+from exceptions import InvalidParametersException
+
+BUNDLE_VERSION: int = 1
+MANIFEST_FILE: str = "manifest.json"
+PARAMETERS_FILE: str = "parameters.npy"
+RESULTS_FILE: str = "results.npy"
+
+
+class ResultTensor(object):
+    """
+    cells x trials tensor in shared memory or in a memory-mapped file
+    """
+
+    def __init__(
+        self, shape: Tuple[int, ...], dtype: Any = np.int64, path: Optional[str] = None
+    ) -> None:
+        """
+        :param shape: tensor shape, (cells, trials)
+        :param dtype: NumPy dtype of each entry
+        :param path: .npy file backing the tensor, shared memory if None
+        """
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.path = path
+        self._buffer: Any = None
+        self._array: Any = None
+        if path is None:
+            nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+            # unsynchronized, every unit is written by exactly one worker
+            self._buffer = mp.RawArray(ctypes.c_byte, max(nbytes, 1))
+        else:
+            # create the file once, workers reopen it in place
+            np.lib.format.open_memmap(
+                path, mode="w+", dtype=self.dtype, shape=self.shape
+            ).flush()
+
+    @classmethod
+    def open(cls, path: str) -> "ResultTensor":
+        """
+        Lazily opening an existing tensor file, nothing is read until sliced
+        :param path: .npy file written by a previous run
+        :return: read-only ResultTensor
+        """
+        array = np.load(path, mmap_mode="r")
+        tensor = cls.__new__(cls)
+        tensor.shape = array.shape
+        tensor.dtype = array.dtype
+        tensor.path = path
+        tensor._buffer = None
+        tensor._array = array
+        return tensor
+
+    def __getstate__(self) -> dict:
+        # views are not shared, workers rebuild their own on attach
+        state = self.__dict__.copy()
+        state["_array"] = None
+        return state
+
+    @property
+    def array(self) -> np.ndarray:
+        """
+        :return: np.ndarray view of the shared memory or memory-mapped file,
+            no copy is made
+        """
+        if self._array is None and self.path is not None:
+            self._array = np.load(self.path, mmap_mode="r+")
+        elif self._array is None:
+            size = int(np.prod(self.shape))
+            self._array = np.frombuffer(
+                self._buffer, dtype=self.dtype, count=size
+            ).reshape(self.shape)
+        return self._array
+
+    def write(self, start: int, values: np.ndarray) -> None:
+        """
+        Writing a contiguous block of units in row-major order
+        :param start: flat index of the first unit
+        :param values: results of units [start, start + len(values))
+        """
+        flat = self.array.reshape(-1)
+        flat[start:start + len(values)] = values
+        if self.path is not None:
+            self.array.flush()
+
+    def write_units(self, units: np.ndarray, values: np.ndarray) -> None:
+        """
+        Writing units in any order
+        :param units: np.ndarray of flat unit indexes
+        :param values: results of the units
+        """
+        self.array.reshape(-1)[units] = values
+        if self.path is not None:
+            self.array.flush()
+
+    def sum_trials(self, columns: int = 1) -> np.ndarray:
+        """
+        Summing over trials, reading at most RESULT_READ_CHUNK_ENTRIES entries
+        at a time so memory use stays bounded however many trials are stored
+        :param columns: separate totals of trials t % columns, e.g. of the
+            tiers of core.plan.ENGINE_COLUMNS
+        :return: np.ndarray of per-cell totals, float64 for float results, with
+            one column per total if columns > 1
+        """
+        # weighted estimates are summed as floats, counts as integers
+        dtype = np.float64 if self.dtype.kind == "f" else np.int64
+        totals = np.empty((self.shape[0], columns), dtype=dtype)
+        cells_per_read = max(1, RESULT_READ_CHUNK_ENTRIES // max(1, self.shape[1]))
+        for start in range(0, self.shape[0], cells_per_read):
+            stop = start + cells_per_read
+            block = self.array[start:stop]
+            totals[start:stop] = block.reshape(len(block), -1, columns).sum(
+                axis=1, dtype=dtype
+            )
+        return totals[:, 0] if columns == 1 else totals
+
+    def variance_trials(self) -> np.ndarray:
+        """
+        Unbiased sample variance of each cell's trials, read in chunks like
+        sum_trials
+        :return: np.ndarray of per-cell variances, NaN with a single trial
+        """
+        variances = np.full(self.shape[0], np.nan)
+        if self.shape[1] < 2:
+            return variances
+        cells_per_read = max(1, RESULT_READ_CHUNK_ENTRIES // max(1, self.shape[1]))
+        for start in range(0, self.shape[0], cells_per_read):
+            stop = start + cells_per_read
+            variances[start:stop] = np.var(
+                self.array[start:stop], axis=1, dtype=np.float64, ddof=1
+            )
+        return variances
+
+
+def _to_json(value: Any) -> Any:
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, dict):
+        return {str(key): _to_json(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_json(item) for item in value]
+    return value
+
+
+class ResultBundle(object):
+    """
+    Self-describing result directory
+
+    manifest.json - formula, axes, arguments, seeds, engine and timings
+    parameters.npy - structured parameter table, one row per cell
+    results.npy - cells x trials result tensor, written in chunks during a run
+    <argument>.npy - array arguments, such as trace request distributions
+
+    Both arrays are memory-mapped on load, so opening a bundle reads nothing
+    but the manifest until cells are sliced.
+    """
+
+    def __init__(
+        self, path: str, manifest: Dict[str, Any], parameters: np.ndarray,
+        results: ResultTensor
+    ) -> None:
+        self.path = path
+        self.manifest = manifest
+        self.parameters = parameters
+        self.results = results
+
+    @staticmethod
+    def results_path(path: str) -> str:
+        """
+        :param path: bundle directory, created if missing
+        :return: location of the bundle's result tensor
+        """
+        os.makedirs(path, exist_ok=True)
+        return os.path.join(path, RESULTS_FILE)
+
+    @classmethod
+    def write(
+        cls, path: str, plan: Any, results: ResultTensor, timings: Dict[str, float]
+    ) -> "ResultBundle":
+        """
+        Completing a bundle once its result tensor has been written
+        :param path: bundle directory
+        :param plan: SweepPlan that was simulated
+        :param results: ResultTensor stored at results_path(path)
+        :param timings: named wall times in seconds
+        :return: ResultBundle
+        """
+        np.save(os.path.join(path, PARAMETERS_FILE), plan.parameters)
+        # array arguments (e.g. trace distributions) are stored beside the
+        # manifest rather than inlined into it
+        arguments: Dict[str, Any] = {}
+        for name, value in plan.defaults.items():
+            if isinstance(value, np.ndarray):
+                arguments[name] = f"{name}.npy"
+                np.save(os.path.join(path, arguments[name]), value)
+            else:
+                arguments[name] = _to_json(value)
+        axis_lengths = [len(values) for values in plan.axes.values()]
+        manifest = {
+            "version": BUNDLE_VERSION,
+            "formula": plan.formula,
+            "engine": plan.engine,
+            "axes": {name: _to_json(values) for name, values in plan.axes.items()},
+            "grid": bool(axis_lengths)
+            and int(np.prod(axis_lengths)) == plan.num_cells,
+            "arguments": arguments,
+            "seeds": [plan.seed],
+            "trials": plan.trials,
+            "shape": list(results.shape),
+            "dtype": results.dtype.str,
+            "timings": [timings],
+        }
+        with open(os.path.join(path, MANIFEST_FILE), "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+        return cls(path, manifest, plan.parameters, results)
+
+    @classmethod
+    def load(cls, path: str) -> "ResultBundle":
+        """
+        Lazily loading a bundle
+        :param path: bundle directory
+        :return: ResultBundle with memory-mapped parameters and results
+        """
+        with open(os.path.join(path, MANIFEST_FILE)) as manifest_file:
+            manifest = json.load(manifest_file)
+        return cls(
+            path,
+            manifest,
+            np.load(os.path.join(path, PARAMETERS_FILE), mmap_mode="r"),
+            ResultTensor.open(os.path.join(path, RESULTS_FILE)),
+        )
+
+    def __len__(self) -> int:
+        return self.results.shape[0]
+
+    def __getitem__(self, index: Any) -> np.ndarray:
+        return self.results.array[index]
+
+    def grid(self) -> np.ndarray:
+        """
+        :return: trial totals reshaped to the axes, for grid sweeps only
+        """
+        if not self.manifest["grid"]:
+            raise InvalidParametersException("Bundle was not a grid sweep")
+        shape = [len(values) for values in self.manifest["axes"].values()]
+        return self.results.sum_trials().reshape(shape)
+
+
+def _same_arguments(bundle: ResultBundle, other: ResultBundle) -> bool:
+    """
+    :return: whether both bundles were simulated with the same shared
+        arguments, array arguments compared by content
+    """
+    arguments = bundle.manifest["arguments"]
+    if arguments.keys() != other.manifest["arguments"].keys():
+        return False
+    for name, value in arguments.items():
+        other_value = other.manifest["arguments"][name]
+        if value == f"{name}.npy" and other_value == value:
+            if not np.array_equal(
+                np.load(os.path.join(bundle.path, value), mmap_mode="r"),
+                np.load(os.path.join(other.path, value), mmap_mode="r"),
+            ):
+                return False
+        elif value != other_value:
+            return False
+    return True
+
+
+def merge_bundles(paths: List[str], path: str) -> ResultBundle:
+    """
+    Merging partial bundles. Bundles with identical parameter tables (repeated
+    runs, e.g. on separate hosts) are joined along trials, others along cells.
+    Trials joined must come from distinct seeds, otherwise they would repeat
+    the same simulations.
+    :param paths: bundle directories to merge
+    :param path: directory of the merged bundle
+    :return: merged ResultBundle
+    """
+    bundles = [ResultBundle.load(bundle_path) for bundle_path in paths]
+    first = bundles[0]
+    for bundle in bundles[1:]:
+        if bundle.manifest["formula"] != first.manifest["formula"] or (
+            bundle.manifest["engine"] != first.manifest["engine"]
+        ):
+            raise InvalidParametersException("Cannot merge different simulations")
+        if list(bundle.manifest["axes"]) != list(first.manifest["axes"]) or (
+            bundle.parameters.dtype.names != first.parameters.dtype.names
+        ):
+            raise InvalidParametersException("Cannot merge different sweep axes")
+        if not _same_arguments(bundle, first):
+            raise InvalidParametersException("Cannot merge different arguments")
+
+    same_cells = all(
+        len(bundle) == len(first)
+        and np.array_equal(bundle.parameters, first.parameters)
+        for bundle in bundles[1:]
+    )
+    seeds = [seed for bundle in bundles for seed in bundle.manifest["seeds"]]
+    # unseeded runs draw fresh entropy, seeded ones repeat their units
+    seeded = [seed for seed in seeds if seed is not None]
+    if same_cells and len(set(seeded)) < len(seeded):
+        raise InvalidParametersException("Cannot merge trials of repeated seeds")
+    dtype = np.result_type(*[bundle.results.dtype for bundle in bundles])
+    if same_cells:
+        shape = (len(first), sum(bundle.results.shape[1] for bundle in bundles))
+        parameters = np.asarray(first.parameters)
+    else:
+        if len({bundle.results.shape[1] for bundle in bundles}) > 1:
+            raise InvalidParametersException("Cannot merge cells with unequal trials")
+        shape = (sum(len(bundle) for bundle in bundles), first.results.shape[1])
+        parameters = np.concatenate([np.asarray(b.parameters) for b in bundles])
+
+    merged = ResultTensor(shape, dtype, ResultBundle.results_path(path))
+    offset = 0
+    for bundle in bundles:
+        # copy a bounded block of cells at a time
+        cells_per_read = max(
+            1, RESULT_READ_CHUNK_ENTRIES // max(1, bundle.results.shape[1])
+        )
+        for start in range(0, len(bundle), cells_per_read):
+            block = bundle.results.array[start:start + cells_per_read]
+            if same_cells:
+                merged.array[
+                    start:start + len(block), offset:offset + block.shape[1]
+                ] = block
+            else:
+                merged.array[offset + start:offset + start + len(block)] = block
+        offset += bundle.results.shape[1] if same_cells else len(bundle)
+    merged.array.flush()
+
+    np.save(os.path.join(path, PARAMETERS_FILE), parameters)
+    for name, value in first.manifest["arguments"].items():
+        if value == f"{name}.npy":
+            np.save(os.path.join(path, value), np.load(os.path.join(first.path, value)))
+    manifest = dict(first.manifest)
+    manifest["seeds"] = seeds
+    manifest["timings"] = [t for b in bundles for t in b.manifest["timings"]]
+    manifest["trials"] = shape[1]
+    manifest["shape"] = list(shape)
+    manifest["dtype"] = dtype.str
+    if not same_cells:
+        manifest["grid"] = False
+        # every value swept by any of the bundles
+        manifest["axes"] = {
+            name: _to_json(np.unique(np.concatenate(
+                [bundle.manifest["axes"][name] for bundle in bundles]
+            )))
+            for name in first.manifest["axes"]
+        }
+    with open(os.path.join(path, MANIFEST_FILE), "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    return ResultBundle(path, manifest, parameters, merged)
@@ -0,0 +1,143 @@
+"""
+N-dimensional sweep specifications and results
+
+A sweep is described by one value array per swept parameter and a design that
+decides which combinations are simulated. Combinations are stored as a single
+structured NumPy table (one column per parameter) instead of nested dicts.
+"""
+import numpy as np
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from config import POSSIBLE_DESIGNS, POSSIBLE_SWEEPS
+from exceptions import InvalidParametersException
+
+
+class SweepSpec(object):
+    """
+    Specification of an N-dimensional sweep
+    """
+
+    def __init__(
+        self,
+        axes: Dict[str, Union[List[Union[int, float]], np.ndarray]],
+        design: str = "factorial",
+        num_points: Optional[int] = None,
+        seed: Optional[int] = None,
+    ) -> None:
+        """
+        :param axes: parameter name -> values. For "factorial" and
+            "latin_hypercube" these are the candidate values of each axis, for
+            "points" they are aligned columns, one entry per point
+        :param design: one of POSSIBLE_DESIGNS
+        :param num_points: number of latin hypercube samples
+        :param seed: random seed for latin hypercube sampling
+        """
+        valid_names = [sweep["name"] for sweep in POSSIBLE_SWEEPS.values()]
+        for name in axes.keys():
+            if name not in valid_names:
+                raise InvalidParametersException(f"Cannot sweep over '{name}'")
+        if design not in POSSIBLE_DESIGNS:
+            raise InvalidParametersException(f"Unknown sweep design '{design}'")
+        if design == "latin_hypercube" and not num_points:
+            raise InvalidParametersException(
+                "Latin hypercube designs require num_points"
+            )
+
+        self.axes: Dict[str, np.ndarray] = {
+            name: np.asarray(values) for name, values in axes.items()
+        }
+        if design == "points" and len({len(v) for v in self.axes.values()}) > 1:
+            raise InvalidParametersException("Point columns must have equal length")
+
+        self.design = design
+        self.num_points = num_points
+        self.seed = seed
+
+    @property
+    def names(self) -> List[str]:
+        return list(self.axes.keys())
+
+    def _dtype(self) -> np.dtype:
+        return np.dtype(
+            [
+                (name, np.int64 if values.dtype.kind in "iu" else np.float64)
+                for name, values in self.axes.items()
+            ]
+        )
+
+    def parameter_table(self) -> np.ndarray:
+        """
+        Generating the parameter table of the design
+        :return: structured np.ndarray, one row per simulated point and one
+            field per swept parameter
+        """
+        if self.design == "factorial":
+            columns = [
+                column.ravel()
+                for column in np.meshgrid(*self.axes.values(), indexing="ij")
+            ]
+        elif self.design == "latin_hypercube":
+            # checked by __init__
+            assert self.num_points is not None
+            num_points = self.num_points
+            rng = np.random.default_rng(self.seed)
+            columns = []
+            for values in self.axes.values():
+                # one sample per stratum, strata shuffled independently per axis
+                strata = (
+                    rng.permutation(num_points) + rng.random(num_points)
+                ) / num_points
+                columns.append(values[(strata * len(values)).astype(np.int64)])
+        else:
+            columns = list(self.axes.values())
+
+        table = np.empty(len(columns[0]) if columns else 0, dtype=self._dtype())
+        for name, column in zip(self.names, columns):
+            table[name] = column
+        return table
+
+
+class SweepResult(object):
+    """
+    Results of an N-dimensional sweep, addressable by parameter tuple
+    """
+
+    def __init__(self, table: np.ndarray, values: np.ndarray) -> None:
+        """
+        :param table: structured parameter table, see SweepSpec.parameter_table
+        :param values: points,trials matrix of results
+        """
+        assert len(table) == len(values), "One row of results is required per point"
+        self.table = table
+        self.values = values
+        self._index: Optional[Dict[Tuple[Any, ...], int]] = None
+
+    @property
+    def names(self) -> List[str]:
+        return list(self.table.dtype.names or ())
+
+    def __len__(self) -> int:
+        return len(self.table)
+
+    def index(self, key: Tuple[Any, ...]) -> int:
+        """
+        :param key: parameter values, ordered as names
+        :return: row of the table holding key
+        """
+        if self._index is None:
+            self._index = {
+                tuple(row): index for index, row in enumerate(self.table.tolist())
+            }
+        try:
+            return self._index[tuple(key)]
+        except KeyError:
+            raise InvalidParametersException(f"{key} was not part of the sweep")
+
+    def __getitem__(self, key: Tuple[Any, ...]) -> np.ndarray:
+        return self.values[self.index(key)]
+
+    def mean(self) -> np.ndarray:
+        """
+        :return: mean result of each point over all trials
+        """
+        return self.values.mean(axis=1)
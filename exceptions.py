@@ -13,3 +13,14 @@ class NumericalError(BaseException):
 
 class EvaluationError(BaseException):
     pass
+
+
+class WorkerError(Exception):
+    """
+    Carrying the exceptions above out of pool workers, pools only return
+    Exception subclasses to the parent and otherwise lose the worker
+    """
+
+    @property
+    def error(self) -> BaseException:
+        return self.args[0]
@@ -0,0 +1,328 @@
+"""
+Benchmarks of every stage of the simulation pipeline.
+
+    python scripts/benchmark.py run --output bench.json [--quick] [--filter drive]
+    python scripts/benchmark.py compare baseline.json bench.json [--threshold 0.2]
+
+Each case runs in a fresh process, so its peak RSS (including pool workers)
+is its own. Results are written as JSON, and compare exits with status 1 when
+a case got slower or larger than the baseline by more than the threshold.
+"""
+import argparse
+import itertools
+import json
+import multiprocessing as mp
+import platform
+import re
+import resource
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import sympy
+
+from config import DEFAULT_FORMULA, POSSIBLE_SWEEPS
+from core.driver import Driver
+from core.evaluator import (
+    _CACHING_DISTRIBUTIONS,
+    _REQUEST_DISTRIBUTIONS,
+    _compile_formula,
+    evaluate,
+    setup_and_simulate,
+)
+from utils.generate_distribution_curves import (
+    generate_distribution_curve,
+    modify_distribution_curve,
+)
+from utils.parse_formula import (
+    _unique_vars_in_formula,
+    evaluate_string_to_valid_formula_str,
+    parse_to_sympy,
+    tokenize,
+)
+
+BENCHMARK_VERSION = 1
+
+CATALOG_SIZES = [10**3, 10**5, 10**6]
+GRID_SIZES = [4, 10]
+WORKER_COUNTS = [1, mp.cpu_count() or 1]
+REPEATS = 5
+
+QUICK_CATALOG_SIZES = [10**3, 10**4]
+QUICK_GRID_SIZES = [3]
+QUICK_WORKER_COUNTS = [1, 2]
+QUICK_REPEATS = 2
+
+FORMULA = evaluate_string_to_valid_formula_str(DEFAULT_FORMULA)
+ARGUMENTS = {"alpha": 0.7, "beta": 1.0, "a": 1.0005}
+
+
+def _tokenize(params: Dict[str, Any]) -> int:
+    tokenize(DEFAULT_FORMULA)
+    return 1
+
+
+def _parse(params: Dict[str, Any]) -> int:
+    # both are cached per process, the benchmarks measure a first call
+    parse_to_sympy.cache_clear()
+    parse_to_sympy(FORMULA)
+    return 1
+
+
+def _unique_vars(params: Dict[str, Any]) -> int:
+    parse_to_sympy.cache_clear()
+    _unique_vars_in_formula.cache_clear()
+    _unique_vars_in_formula(FORMULA)
+    return 1
+
+
+def _generate_automatic(params: Dict[str, Any]) -> int:
+    generate_distribution_curve(params["num_of_files"], automatic=True, a=1.0005)
+    return 1
+
+
+def _generate_formula(params: Dict[str, Any]) -> int:
+    m = sympy.Symbol("m")
+    generate_distribution_curve(params["num_of_files"], formula=1 / (m + 1))
+    return 1
+
+
+def _distributions(params: Dict[str, Any]) -> Dict[str, Any]:
+    # untimed inputs of the distribution and evaluate benchmarks
+    compiled = _compile_formula(FORMULA)
+    request = generate_distribution_curve(params["num_of_files"], automatic=True)
+    caching = modify_distribution_curve(request, compiled, alpha=ARGUMENTS["alpha"])
+    return {"compiled": compiled, "request": request, "caching": caching}
+
+
+def _modify(params: Dict[str, Any]) -> int:
+    modify_distribution_curve(
+        params["request"], params["compiled"], alpha=ARGUMENTS["alpha"]
+    )
+    return 1
+
+
+def _evaluate(params: Dict[str, Any]) -> int:
+    for _ in range(params["trials"]):
+        evaluate(params["request"], params["caching"], 20, 5)
+    return params["trials"]
+
+
+def _setup_and_simulate(params: Dict[str, Any]) -> int:
+    for _ in range(params["trials"]):
+        # the cold path, distributions set up again by every trial rather than
+        # taken from the memos filled by the first one
+        _REQUEST_DISTRIBUTIONS.clear()
+        _CACHING_DISTRIBUTIONS.clear()
+        setup_and_simulate(
+            FORMULA, params["num_of_files"], 5, 20, **ARGUMENTS
+        )
+    return params["trials"]
+
+
+def _driver(params: Dict[str, Any], multiple: bool) -> int:
+    driver = Driver()
+    driver.num_of_files = params["num_of_files"]
+    driver.num_of_workers = params["workers"]
+    driver.num_of_users = params["users"]
+    driver.seed = 0
+    grid = params["grid"]
+    driver._update_simulation_args(
+        POSSIBLE_SWEEPS["ALPHA"],
+        POSSIBLE_SWEEPS["CACHE_SIZE"],
+        10 ** np.linspace(-1, 1, grid),
+        np.arange(1, grid + 1),
+    )
+    if multiple:
+        driver.drive_multiple(DEFAULT_FORMULA)
+        return grid * grid * params["users"]
+    driver.drive(DEFAULT_FORMULA)
+    return grid * grid
+
+
+def cases(
+    quick: bool = False
+) -> List[Tuple[str, str, Callable, Dict[str, Any], Optional[Callable]]]:
+    """
+    :param quick: small sizes, for smoke runs
+    :return: list of (name, stage, function, parameters, setup). setup, if
+        any, builds additional inputs of the function outside of the timing
+    """
+    sizes = QUICK_CATALOG_SIZES if quick else CATALOG_SIZES
+    grids = QUICK_GRID_SIZES if quick else GRID_SIZES
+    workers = QUICK_WORKER_COUNTS if quick else WORKER_COUNTS
+    trials = 20 if quick else 200
+
+    found: List[Tuple[str, str, Callable, Dict[str, Any], Optional[Callable]]] = [
+        ("tokenize", "parse", _tokenize, {}, None),
+        ("parse_to_sympy", "parse", _parse, {}, None),
+        ("unique_vars_in_formula", "parse", _unique_vars, {}, None),
+        # evaluated through sympy item by item, kept small
+        ("generate_formula[1000]", "distribution", _generate_formula,
+         {"num_of_files": 1000}, None),
+    ]
+    for size in sizes:
+        found += [
+            (f"generate_automatic[{size}]", "distribution", _generate_automatic,
+             {"num_of_files": size}, None),
+            (f"modify[{size}]", "distribution", _modify, {"num_of_files": size},
+             _distributions),
+            (f"evaluate[{size}]", "evaluate", _evaluate,
+             {"num_of_files": size, "trials": trials}, _distributions),
+            (f"setup_and_simulate[{size}]", "evaluate", _setup_and_simulate,
+             {"num_of_files": size, "trials": trials // 10}, None),
+        ]
+    for grid, worker_count in itertools.product(grids, workers):
+        params = {
+            "num_of_files": sizes[0], "grid": grid, "workers": worker_count,
+            "users": 10,
+        }
+        found += [
+            (f"drive[{grid}x{grid},w{worker_count}]", "driver",
+             lambda p: _driver(p, multiple=False), params, None),
+            (f"drive_multiple[{grid}x{grid},w{worker_count}]", "driver",
+             lambda p: _driver(p, multiple=True), params, None),
+        ]
+    return found
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS. RUSAGE_CHILDREN
+    # is the peak of the largest single child (e.g. one pool worker) rather
+    # than a total over them, so the sum overestimates processes that never
+    # overlapped and underestimates several large workers at once
+    scale = 1 if sys.platform == "darwin" else 1024
+    peak = (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        + resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    )
+    return peak * scale / 2**20
+
+
+def _measure(
+    func: Callable,
+    params: Dict[str, Any],
+    setup: Optional[Callable],
+    repeats: int,
+    pipe: Any,
+) -> None:
+    # inputs are built once, before the first repeat is timed
+    inputs = {**params, **setup(params)} if setup is not None else params
+    times: List[float] = []
+    trials = 0
+    for _ in range(repeats):
+        start = time.perf_counter()
+        trials += func(inputs)
+        times.append(time.perf_counter() - start)
+    pipe.send({
+        "wall_time": sum(times),
+        "best_time": min(times),
+        "trials": trials,
+        "throughput": trials / sum(times) if sum(times) else float("inf"),
+        "peak_rss_mb": _peak_rss_mb(),
+    })
+    pipe.close()
+
+
+def run(output: str, quick: bool = False, pattern: str = "") -> Dict[str, Any]:
+    """
+    Running every case in its own process
+    :param output: JSON file written
+    :param quick: small sizes, for smoke runs
+    :param pattern: regular expression selecting cases by name
+    :return: benchmark document
+    """
+    repeats = QUICK_REPEATS if quick else REPEATS
+    # fork keeps the cases' closures, each case still gets a fresh process
+    context = mp.get_context("fork")
+    results = []
+    for name, stage, func, params, setup in cases(quick):
+        if pattern and not re.search(pattern, name):
+            continue
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(
+            target=_measure, args=(func, params, setup, repeats, sender)
+        )
+        process.start()
+        measurement = receiver.recv()
+        process.join()
+        results.append({
+            "name": name, "stage": stage, "params": params, "repeats": repeats,
+            **measurement,
+        })
+        print(
+            f"{name:<40} {measurement['best_time'] * 1e3:>10.2f} ms "
+            f"{measurement['throughput']:>12.1f} trials/s "
+            f"{measurement['peak_rss_mb']:>8.1f} MB"
+        )
+
+    document = {
+        "version": BENCHMARK_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": mp.cpu_count(),
+        "results": results,
+    }
+    with open(output, "w") as handle:
+        json.dump(document, handle, indent=2)
+    return document
+
+
+def compare(
+    baseline: str, current: str, threshold: float, rss_threshold: float
+) -> List[str]:
+    """
+    :param baseline: stored benchmark JSON
+    :param current: new benchmark JSON
+    :param threshold: tolerated relative increase of the best time
+    :param rss_threshold: tolerated relative increase of the peak RSS
+    :return: names of regressed cases
+    """
+    with open(baseline) as handle:
+        before = {result["name"]: result for result in json.load(handle)["results"]}
+    with open(current) as handle:
+        after = {result["name"]: result for result in json.load(handle)["results"]}
+
+    regressions = []
+    print(f"{'case':<40} {'time':>10} {'rss':>10}")
+    for name in sorted(set(before) & set(after)):
+        time_ratio = after[name]["best_time"] / max(before[name]["best_time"], 1e-12)
+        rss_ratio = after[name]["peak_rss_mb"] / max(before[name]["peak_rss_mb"], 1e-12)
+        regressed = time_ratio > 1 + threshold or rss_ratio > 1 + rss_threshold
+        if regressed:
+            regressions.append(name)
+        print(
+            f"{name:<40} {time_ratio:>9.2f}x {rss_ratio:>9.2f}x"
+            + ("  REGRESSION" if regressed else "")
+        )
+    for name in sorted(set(before) ^ set(after)):
+        print(f"{name:<40} only in {'baseline' if name in before else 'current'}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("--output", default="bench.json")
+    run_parser.add_argument("--quick", action="store_true")
+    run_parser.add_argument("--filter", default="", help="regex on case names")
+
+    compare_parser = commands.add_parser("compare", help="flag regressions")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.2)
+    compare_parser.add_argument("--rss-threshold", type=float, default=0.2)
+
+    arguments = parser.parse_args()
+    if arguments.command == "run":
+        run(arguments.output, arguments.quick, arguments.filter)
+    else:
+        sys.exit(1 if compare(
+            arguments.baseline, arguments.current, arguments.threshold,
+            arguments.rss_threshold,
+        ) else 0)
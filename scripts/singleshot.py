@@ -19,6 +19,8 @@ import config
 config.USE_NUMPY_ZIPF = False
 
 users_to_drive = 1
+# refine only the regions of the heatmap with structure, then resample
+adaptive = False
 
 dr = Driver()
 
@@ -45,15 +47,20 @@ dr.number_of_files_requested = 10
 dr.num_of_files = 1000
 
 t1 = time.time()
-results = dr.drive_multiple(formula=DEFAULT_FORMULA)
+if adaptive:
+    adaptive_results = dr.drive_adaptive(formula=DEFAULT_FORMULA, scale_x="log", scale_y="log")
+    results = adaptive_results.resample(dr.range_x, dr.range_y)
+    num_trials = len(adaptive_results)*num_users
+else:
+    results = dr.drive_multiple(formula=DEFAULT_FORMULA)
 
-results = results/dr.num_of_users
+    results = results/dr.num_of_users
+    num_trials = x_range_length*y_range_length*num_users
 
 print(results)
 [print(str(row) + "\n") for row in results]
 t2 = time.time()
 
-num_trials = x_range_length*y_range_length*num_users
 print(f"Evaluation Time: {(t2-t1):2f}seconds for {num_trials} trials, {(t2-t1)/num_trials:2f}sec/trial")
 
 fig, (axs, ax2) = plt.subplots(1, 2, figsize=(8, 4), constrained_layout=True, dpi=200)
@@ -1,9 +1,58 @@
+import multiprocessing as mp
+import numpy as np
 import pytest
+import tracemalloc
+import sympy
+from config import DEFAULT_FORMULA, IMPORTANCE_MIXTURE
+from core.adaptive import refine
 from core.driver import Driver
+from core.epochs import EpochDistribution
+from core.evaluator import (
+    evaluate,
+    precision_error,
+    setup_sanitized_distributions,
+)
+from core.delivery import delivery_load, sample_group
+from core.head_tail import head_tail_cell
+from core.hierarchy import TIERS, simulate_hierarchy
+from core.importance import importance_estimate, proposal_distribution
+from core.population import PopulationSpec
+import core.delivery
+import core.hierarchy
+import core.replay
+import core.results
+import utils.formula_compiler
+from core.replay import build_replay_trace, replay
+from core.plan import ENGINES, SweepPlan, _init_worker, _run_units
+from core.policies import simulate_policy
+from core.results import ResultBundle, ResultTensor, merge_bundles
+from core.sweep import SweepResult, SweepSpec
+from exceptions import InvalidParametersException
+from utils.formula_compiler import CompiledFormula, compile_formula
+from utils.generate_distribution_curves import (
+    generate_distribution_curve,
+    modify_distribution_curve,
+)
+from utils.parse_formula import (
+    _unique_vars_in_formula,
+    evaluate_string_to_valid_formula_str,
+)
+from utils.sampling import AliasTable, sample_without_replacement
+from utils.sanitize import EMPTY, HEALTHY, SATURATED, sanitize
+from utils.sparse_distributions import HeadTailDistribution
+from utils.traces import trace_request_distribution
 
 # One day, I will make sure everything works...
 
 
+@pytest.fixture(autouse=True)
+def formula_cache_dir(tmp_path, monkeypatch):
+    # compiled formula artifacts of each test stay in its temporary directory
+    monkeypatch.setattr(
+        utils.formula_compiler, "FORMULA_CACHE_DIR", str(tmp_path / "formulas")
+    )
+
+
 @pytest.fixture
 def valid_formula() -> str:
     return "{p_r(m)^{1\\over\\alpha}}\\over{\\sum_{n=1}^{m}{p_r(n)^{1\\over\\alpha}}}}"
@@ -14,3 +63,442 @@ def valid_formula() -> str:
 def test_driver_functionality(valid_formula):
     dr = Driver()
     results = dr.drive(formula=valid_formula)
+
+
+@pytest.mark.Driver
+def test_driver_adaptive_refinement(valid_formula):
+    dr = Driver()
+    dr.num_of_files = 100
+    dr.num_of_users = 2
+    dr.range_x = 10 ** np.linspace(-1, 1, 10)
+    result = dr.drive_adaptive(
+        formula=valid_formula, coarse_points=3, max_points=20, scale_x="log"
+    )
+    assert 9 <= len(result) <= 20
+    grid = result.resample(dr.range_x, dr.range_y)
+    assert grid.shape == (len(dr.range_y), len(dr.range_x))
+    assert not np.isnan(grid).any()
+    # every cell above threshold of a round is split in one batch
+    batches = []
+
+    def step(points):
+        batches.append(len(points))
+        return np.array([[float(x > 0.5)] for x, _ in points])
+
+    refined = refine(step, [0.0, 1.0], [0.0, 1.0], 3, 200, 0.1)
+    assert len(refined) == sum(batches) and len(batches) < len(refined) / 4
+
+
+def test_sweep_spec_designs():
+    axes = {"alpha": [0.5, 1.0, 2.0], "cache_size": [5, 10]}
+    assert len(SweepSpec(axes).parameter_table()) == 6
+
+    table = SweepSpec(axes, design="latin_hypercube", num_points=4, seed=0)
+    table = table.parameter_table()
+    assert len(table) == 4 and table["cache_size"].dtype == np.int64
+
+    points = SweepSpec({"alpha": [0.5, 2.0], "a": [1.1, 1.5]}, design="points")
+    result = SweepResult(points.parameter_table(), np.array([[1, 3], [2, 2]]))
+    assert list(result[(2.0, 1.5)]) == [2, 2]
+
+
+def test_trace_request_distribution(tmp_path):
+    ids = np.array([7, 3, 7, 9, 7, 3], dtype="<u8")
+    ids.tofile(tmp_path / "trace.bin")
+    p_r, ranked_ids = trace_request_distribution(
+        str(tmp_path / "trace.bin"), trace_format="binary", chunk_size=4
+    )
+    assert np.allclose(p_r, [3 / 6, 2 / 6, 1 / 6])
+    assert list(ranked_ids) == [7, 3, 9]
+
+
+def test_trace_replay(valid_formula, tmp_path, monkeypatch):
+    log = [(10, 7), (20, 3), (10, 7), (30, 9), (20, 7), (10, 3), (30, 7)]
+    (tmp_path / "log.csv").write_text(
+        "".join(f"{user},{id}\n" for user, id in log)
+    )
+    (tmp_path / "ids.csv").write_text("".join(f"{id}\n" for _, id in log))
+    _, ranked_ids = trace_request_distribution(str(tmp_path / "ids.csv"))
+    trace = build_replay_trace(
+        str(tmp_path / "log.csv"), str(tmp_path / "trace"), ranked_ids, chunk_size=3
+    )
+    # ranks of 7, 3 and 9 are 0, 1 and 2, grouped by user in log order
+    assert list(trace.offsets) == [0, 3, 5, 7]
+    assert list(trace.requests) == [0, 0, 1, 1, 0, 2, 0]
+
+    # every user caches ranks 0 and 1, batches of one user each
+    monkeypatch.setattr(core.replay, "REPLAY_BATCH_ELEMENTS", 3)
+    misses = replay(trace, np.array([0.5, 0.5, 0.0]), 2, 0, trace.num_users)
+    assert misses == np.count_nonzero(np.asarray(trace.requests) >= 2)
+
+    dr = Driver()
+    dr._update_simulation_args(dr.x_axis, dr.y_axis, [0.5, 1, 2], [0, 3])
+    results = dr.drive_replay(valid_formula, str(tmp_path / "trace"), num_shards=2)
+    assert np.all(results[0] == trace.num_requests) and np.all(results[1] == 0)
+
+    dr.engine = "replay"
+    with pytest.raises(InvalidParametersException):
+        dr.drive(formula=valid_formula)
+
+
+def test_epochs_incremental(valid_formula):
+    formula = evaluate_string_to_valid_formula_str(valid_formula)
+    rng = np.random.default_rng(0)
+    distribution = EpochDistribution(rng.random(50), formula, alpha=0.7)
+    epochs = [
+        {"insert": rng.random(5)},
+        {"decay": 0.5},
+        {"decay": 0.3, "decay_items": [3, 7]},
+        {"update": {4: 2.0, 11: 0.01}},
+    ]
+    for epoch in epochs:
+        distribution.apply(**epoch)
+        full = EpochDistribution(
+            distribution.request_distribution()[np.argsort(distribution.items)],
+            formula,
+            alpha=0.7,
+        )
+        assert np.allclose(
+            distribution.caching_distribution_by_item(),
+            full.caching_distribution_by_item(),
+        )
+    # decaying every item recomputes no rank
+    assert distribution.recomputed[2] == 0
+
+
+# tensor attached by each pool worker of test_result_tensor
+_TENSOR = None
+
+
+def _attach_tensor(tensor):
+    global _TENSOR
+    _TENSOR = tensor
+
+
+def _write_units(start, stop):
+    units = np.arange(start, stop)[::-1]
+    _TENSOR.write_units(units, units % 7)
+
+
+@pytest.mark.parametrize("memmapped", [False, True])
+def test_result_tensor(tmp_path, monkeypatch, memmapped):
+    path = str(tmp_path / "results.npy") if memmapped else None
+    tensor = ResultTensor((11, 3), np.uint8, path)
+    with mp.get_context("fork").Pool(
+        2, initializer=_attach_tensor, initargs=(tensor,)
+    ) as pool:
+        pool.starmap(_write_units, [(0, 10), (10, 25), (25, 33)])
+    expected = (np.arange(33) % 7).reshape(11, 3)
+    # one cell per read
+    monkeypatch.setattr(core.results, "RESULT_READ_CHUNK_ENTRIES", 5)
+    assert np.array_equal(tensor.sum_trials(), expected.sum(axis=1))
+    assert np.allclose(tensor.variance_trials(), expected.var(axis=1, ddof=1))
+    if memmapped:
+        assert np.array_equal(ResultTensor.open(path).array, expected)
+
+
+def test_result_bundles(valid_formula, tmp_path):
+    dr = Driver()
+    dr.num_of_files = 100
+    dr.num_of_users = 2
+    dr._update_simulation_args(dr.x_axis, dr.y_axis, [0.5, 1], [2, 4])
+    runs = []
+    for index, seed in enumerate([1, 2, 2]):
+        dr.seed = seed
+        dr.result_path = str(tmp_path / f"run_{index}")
+        dr.drive_multiple(valid_formula)
+        runs.append(dr.result_path)
+    loaded = [ResultBundle.load(run) for run in runs]
+    assert loaded[0].manifest["seeds"] == [1] and loaded[0].grid().shape == (2, 2)
+
+    merged = merge_bundles(runs[:2], str(tmp_path / "trials"))
+    assert merged.results.shape == (4, 4)
+    assert np.array_equal(
+        ResultBundle.load(str(tmp_path / "trials")).grid(),
+        loaded[0].grid() + loaded[1].grid(),
+    )
+    with pytest.raises(InvalidParametersException):
+        merge_bundles(runs[1:], str(tmp_path / "repeated"))
+
+    dr._update_simulation_args(dr.x_axis, dr.y_axis, [2], [2, 4])
+    dr.result_path = str(tmp_path / "cells")
+    dr.drive_multiple(valid_formula)
+    merged = merge_bundles([runs[0], dr.result_path], str(tmp_path / "merged"))
+    assert merged.results.shape == (6, 2) and not merged.manifest["grid"]
+    assert merged.manifest["axes"]["alpha"] == [0.5, 1, 2]
+    dr.num_of_files = 50
+    dr.result_path = str(tmp_path / "other")
+    dr.drive_multiple(valid_formula)
+    with pytest.raises(InvalidParametersException):
+        merge_bundles([runs[0], dr.result_path], str(tmp_path / "invalid"))
+
+
+def test_driver_population(valid_formula):
+    dr = Driver()
+    population = PopulationSpec([
+        {"count": 20, "a": 0.8, "cache_size": 0, "name": "uncached"},
+        {"count": 30, "a": 1.2, "cache_size": 10},
+    ])
+    summary = dr.drive_population(valid_formula, population).summary()
+    assert summary["uncached"]["mean"] == dr.number_of_files_requested
+    assert summary["class_1"]["count"] == 30 and summary["all"]["count"] == 50
+
+
+def test_delivery_load(monkeypatch):
+    # each user caches the file the other one requests, one XOR serves both
+    cached = np.array([[1], [0], [2]])
+    requested = np.array([[0], [1], [0]])
+    assert delivery_load(cached, requested, 3) == {
+        "misses": 3, "uncoded": 2, "coded": 2
+    }
+    assert delivery_load(cached[:2], requested[:2], 3)["coded"] == 1
+
+    # batches of one user each, nothing cached but the requested files
+    monkeypatch.setattr(core.delivery, "DELIVERY_BATCH_ELEMENTS", 3)
+    p = np.array([0.5, 0.5, 0.0])
+    cached, requested = sample_group(p, p, 2, 2, 5)
+    assert cached.shape == requested.shape == (5, 2)
+    assert delivery_load(cached, requested, 3)["misses"] == 0
+
+
+def test_hierarchy_tiers(monkeypatch):
+    p = np.full(100, 0.01)
+    misses = simulate_hierarchy(p, p, p, 10, 100, 5, 20)
+    assert (misses["edge"] >= 1).any() and not misses["regional"].any()
+    misses = simulate_hierarchy(p, p, p, 10, 0, 5, 20)
+    assert np.array_equal(misses["edge"], misses["regional"])
+
+    # batches of three users each
+    monkeypatch.setattr(core.hierarchy, "HIERARCHY_BATCH_ELEMENTS", 300)
+    misses = simulate_hierarchy(p, p, p, 100, 0, 5, 20)
+    assert not misses["edge"].any() and len(misses["regional"]) == 20
+
+
+def test_driver_hierarchy_columns():
+    dr = Driver()
+    dr.engine = "hierarchy"
+    dr.num_of_files = 200
+    dr.num_of_users = 10
+    dr.num_of_workers = 1
+    dr._update_simulation_args(dr.x_axis, dr.y_axis, [0.5], [2, 10])
+    origin = dr.drive(DEFAULT_FORMULA, generate_new_dist=True)
+    assert dr.results.shape == (2, len(TIERS))
+    assert sorted(dr.columns) == sorted(TIERS)
+    assert np.array_equal(origin, dr.columns["regional"])
+    assert (dr.columns["regional"] <= dr.columns["edge"]).all()
+    assert dr.columns["edge"].any()
+
+
+def test_head_tail_distribution():
+    dense = generate_distribution_curve(10**5, automatic=True, a=1.2)
+    compact = HeadTailDistribution.zipf(10**5, 1.2, head_size=500, num_buckets=100)
+    assert np.abs(compact.to_dense() / compact.total - dense).sum() < 1e-3
+
+    samples = HeadTailDistribution.zipf(10**9, 1.2).sample(30, 10)
+    assert all(len(np.unique(sample)) == 30 for sample in samples)
+    assert samples.max() < 10**9
+
+
+def test_head_tail_degenerate_weights():
+    # a head holding nearly all of the mass, e.g. DEFAULT_FORMULA at alpha=0.02
+    skewed = HeadTailDistribution(
+        np.array([1, 8.9e-16, 1e-35, 1e-60, 0.0]), np.array([5]), np.array([0.0])
+    )
+    samples = skewed.sample(5, num_samples=3)
+    assert skewed.support == 4
+    assert all(sorted(sample) == [0, 1, 2, 3] for sample in samples)
+    assert samples.shape == (3, 4)
+    misses = head_tail_cell({
+        "formula": evaluate_string_to_valid_formula_str(DEFAULT_FORMULA),
+        "num_of_files": 10**6, "a": 0.8, "cache_size": 5, "num_of_requests": 5,
+        "alpha": 0.02, "beta": 1,
+    }, 0)
+    assert 0 <= misses <= 5
+
+
+def _invalid_cell(arguments, trial):
+    raise InvalidParametersException("Rejected by the worker")
+
+
+def test_worker_exceptions(monkeypatch):
+    dr = Driver()
+    dr.engine = "head_tail"
+    # rejected by the plan, before any worker starts
+    with pytest.raises(InvalidParametersException):
+        dr.drive(formula="\\sum_{n=m-2}^{m}{p_r(n)}")
+    # raised by a worker, returned to the parent rather than losing the worker
+    monkeypatch.setitem(ENGINES, "head_tail", _invalid_cell)
+    with pytest.raises(InvalidParametersException):
+        dr.drive(formula=DEFAULT_FORMULA)
+
+
+def test_float32_precision(valid_formula):
+    errors = precision_error(valid_formula, 10**5, "float32", alpha=0.7, a=1.0005)
+    assert errors["request_max_rel"] < 1e-5 and errors["caching_max_rel"] < 1e-5
+    assert errors["caching_total_variation"] < 1e-6
+    # ranks above 2**24 stay distinct in float32 distributions
+    m = sympy.Symbol("m")
+    ranks = modify_distribution_curve(
+        np.ones(2**24 + 3, dtype=np.float32), (m - (2**24 - 2)) ** 2
+    )
+    assert ranks.dtype == np.float32
+    assert np.allclose(ranks[-4:] / ranks[-4], [1, 4, 9, 16])
+    chosen = sample_without_replacement(np.ones(8, dtype=np.float32), 8, 100)
+    assert (np.sort(chosen, axis=1) == np.arange(8)).all()
+    # a given float64 distribution is converted once, memoized downstream
+    given = np.full(10, 0.1)
+    formula = evaluate_string_to_valid_formula_str(valid_formula)
+    first, second = [
+        setup_sanitized_distributions(
+            formula, 10, file_request_distribution=given, precision="float32",
+            alpha=0.7,
+        )
+        for _ in range(2)
+    ]
+    assert first[0].dtype == np.float32 and first[1] is second[1]
+    # formula temporaries, integer ranks included, stay in float32
+    ranked = compile_formula("{p_r(m)}\\over{(m+1)^{\\alpha}}")
+    m = np.arange(10**6)
+    r = np.full(10**6, 1e-6, dtype=np.float32)
+    v = np.cumsum(r)
+    ranked(m, v, r, 0.7)
+    tracemalloc.start()
+    weights = ranked(m, v, r, 0.7)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert weights.dtype == np.float32 and peak < 1.5 * r.nbytes
+
+
+def test_driver_profile(valid_formula, tmp_path):
+    dr = Driver()
+    dr.profile_timeline = True
+    dr.drive(valid_formula)
+    assert dr.profile.counters["worker.units"] == len(dr.range_x) * len(dr.range_y)
+    assert "engine.evaluate" in dr.profile.summary()
+    dr.profile.write_chrome_trace(str(tmp_path / "trace.json"))
+
+
+def test_compiled_formula_artifact(valid_formula, tmp_path):
+    compiled = compile_formula(valid_formula)
+    assert compiled.variables == ("alpha",)
+    # p_r(m)^{1/alpha} is shared by the numerator and the running sum
+    assert compiled.source.split("\n\n")[0].count("numpy.power") == 1
+    compiled.save(str(tmp_path / "formula.json"))
+    loaded = CompiledFormula.load(str(tmp_path / "formula.json"))
+    m, v, r = np.arange(3), np.array([0.5, 0.8, 1.0]), np.array([0.5, 0.3, 0.2])
+    weights = r ** (1 / 0.7)
+    assert np.allclose(loaded(m, v, r, 0.7), weights / np.cumsum(weights))
+    # edited artifacts are never executed
+    artifact = compiled.to_dict()
+    artifact["source"] = artifact["source"].replace("numpy.power", "print")
+    with pytest.raises(ValueError):
+        CompiledFormula.from_dict(artifact)
+
+
+def test_formula_variables_validated(valid_formula):
+    assert _unique_vars_in_formula(valid_formula) == {"r", "m", "alpha"}
+    with pytest.raises(InvalidParametersException):
+        Driver().drive("{p_r(m)^{1\\over\\gamma}}")
+
+
+def test_formula_running_aggregates():
+    r = generate_distribution_curve(100, automatic=True)
+    m, v = np.arange(100), np.cumsum(r)
+    window = compile_formula("\\sum_{n=m-2}^{m}{p_r(n)}")
+    expected = [r[max(0, i - 2):i + 1].sum() for i in m]
+    assert np.allclose(window(m, v, r), expected)
+    product = compile_formula("{r}/{\\prod_{n=1}^{m-1}{(1-p_r(n))}}")
+    expected = r / np.concatenate([[1.0], np.cumprod(1 - r)[:-1]])
+    assert np.allclose(product(m, v, r), expected)
+
+
+def test_sanitized_distribution():
+    caching = sanitize(np.array([np.nan, 2.0, -1.0, 2.0, 0.0]))
+    assert caching.support == 2 and caching.repaired == 2
+    assert np.allclose(caching.probabilities, [0, 0.5, 0, 0.5, 0])
+    assert caching.status(1) == HEALTHY and caching.status(2) == SATURATED
+    assert sorted(caching.sample(3)) == [1, 3]
+    empty = sanitize(np.full(5, np.nan))
+    assert empty.status(2) == EMPTY and not len(empty.sample(2))
+    assert len(evaluate(np.full(5, 0.2), empty, 2, 3)) == 3
+
+
+def test_alias_table_with_replacement(valid_formula):
+    distribution = np.array([0.5, 0.0, 0.25, 0.25])
+    table = AliasTable(distribution)
+    assert np.allclose(table.probabilities(), distribution)
+    draws = table.sample(100000)
+    assert not np.any(draws == 1)
+    assert abs(np.mean(draws == 0) - 0.5) < 0.01
+    # more requests than files, repeats all counted
+    misses = evaluate(distribution, np.array([0.0, 0.0, 1.0, 0.0]), 1, 10, with_replacement=True)
+    assert len(misses) <= 10 and not np.any(misses == 2)
+    dr = Driver()
+    dr.with_replacement = True
+    assert dr.drive(formula=valid_formula).shape == (len(dr.range_y), len(dr.range_x))
+
+
+def test_importance_sampling(valid_formula):
+    np.random.seed(0)
+    distribution = generate_distribution_curve(500, automatic=True, a=1.6)
+    caching = distribution ** 2 / np.sum(distribution ** 2)
+    proposal = proposal_distribution(distribution, caching, 50)
+    assert np.all(distribution / proposal <= 1 / IMPORTANCE_MIXTURE + 1e-9)
+    table = AliasTable(proposal)
+    estimates = [
+        importance_estimate(caching, 50, 20, table, distribution / proposal)
+        for _ in range(2000)
+    ]
+    plain = [
+        len(evaluate(distribution, caching, 50, 20, with_replacement=True))
+        for _ in range(2000)
+    ]
+    assert abs(np.mean(estimates) - np.mean(plain)) < 4 * np.std(plain) / np.sqrt(2000)
+    dr = Driver()
+    dr.engine = "importance"
+    results = dr.drive(formula=valid_formula)
+    assert results.dtype == np.float64 and dr.variance.shape == results.shape
+    sweep = dr.drive_sweep(valid_formula, SweepSpec({"cache_size": [5, 10]}))
+    assert sweep.values.dtype == np.float64 and dr.results.dtype == np.float64
+
+
+def test_plan_schedule(valid_formula):
+    defaults = Driver()._default_arguments()
+    defaults["num_of_files"] = 500
+    plan = SweepPlan.from_grid(
+        evaluate_string_to_valid_formula_str(valid_formula), defaults,
+        "alpha", [0.5, 1.0], "cache_size", [5, 10, 20], trials=3, seed=7,
+    )
+    # cells sharing a caching distribution are simulated together
+    assert list(plan.parameters["alpha"][plan.order]) == [0.5] * 3 + [1.0] * 3
+    assert list(plan.group_starts) == [0, 3]
+    results = []
+    for order in (plan.order, np.arange(plan.num_cells)):
+        plan.order = order
+        tensor = ResultTensor((plan.num_cells, plan.trials), np.int64)
+        _init_worker(plan, tensor)
+        for start, stop in plan.chunks(4):
+            _run_units(start, stop)
+        results.append(tensor.array.copy())
+    # seeded per unit, the schedule does not change any result
+    assert np.array_equal(*results)
+
+
+def test_cache_policies(valid_formula):
+    # 0 1 0 2 1 0 2 2 through a single two-slot cache, worked by hand
+    requests = np.array([[0], [1], [0], [2], [1], [0], [2], [2]])
+    expected = {"lru": 6, "fifo": 4, "lfu": 5, "static": 3}
+    for policy, misses in expected.items():
+        result = simulate_policy(
+            policy, np.array([0.5, 0.25, 0.25]), 2, len(requests), 1,
+            cache_choice_prob_dist=np.array([0.5, 0.5, 0.0]), requests=requests,
+        )
+        assert result.tolist() == [misses], policy
+    assert simulate_policy("lru", np.array([0.5, 0.5]), 0, 5, 3).tolist() == [5] * 3
+
+    dr = Driver()
+    dr.engine = "lru"
+    dr._update_simulation_args(dr.x_axis, dr.y_axis, dr.range_x, [0, 5])
+    results = dr.drive(formula=valid_formula)
+    # one user per cell, every request missing a zero-slot cache
+    assert np.all(results[0] == dr.number_of_files_requested)
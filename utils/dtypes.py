@@ -0,0 +1,69 @@
+"""
+Choosing compact dtypes for indexes, counts and distributions
+"""
+import numpy as np
+from typing import Any
+
+from config import PRECISIONS, SAFE_CUMSUM_CHUNK
+from exceptions import InvalidParametersException
+
+
+def smallest_uint_dtype(max_value: int) -> np.dtype:
+    """
+    :param max_value: largest value to be stored
+    :return: smallest unsigned integer dtype able to hold max_value
+    """
+    for dtype in (np.uint8, np.uint16, np.uint32, np.uint64):
+        if max_value <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    raise OverflowError(f"{max_value} does not fit in 64 bits")
+
+
+def float_dtype(precision: str) -> np.dtype:
+    """
+    :param precision: one of config.PRECISIONS
+    :return: floating point dtype of distributions
+    """
+    if precision not in PRECISIONS:
+        raise InvalidParametersException(f"Unknown precision '{precision}'")
+    return np.dtype(precision)
+
+
+def index_dtype(length: int) -> np.dtype:
+    """
+    :param length: number of indexable items
+    :return: smallest unsigned integer dtype able to index them
+    """
+    return smallest_uint_dtype(max(0, length - 1))
+
+
+def safe_cumsum(values: np.ndarray, dtype: Any = None) -> np.ndarray:
+    """
+    Cumulative sum accumulated in float64, chunk by chunk, and stored in dtype.
+    A float32 running sum over millions of small probabilities drifts by far
+    more than float32 resolution, this one is exact to the storage dtype.
+    :param values: np.ndarray to sum
+    :param dtype: dtype of the result, that of values by default
+    :return: np.ndarray of running sums
+    """
+    dtype = np.dtype(values.dtype if dtype is None else dtype)
+    if dtype == np.float64:
+        return np.cumsum(values, dtype=np.float64)
+    cumulative = np.empty(len(values), dtype=dtype)
+    carry = 0.0
+    for start in range(0, len(values), SAFE_CUMSUM_CHUNK):
+        chunk = np.cumsum(values[start:start + SAFE_CUMSUM_CHUNK], dtype=np.float64)
+        chunk += carry
+        cumulative[start:start + SAFE_CUMSUM_CHUNK] = chunk
+        carry = chunk[-1]
+    return cumulative
+
+
+def safe_normalize(values: np.ndarray) -> np.ndarray:
+    """
+    Dividing by a total summed in float64, in place
+    :param values: np.ndarray of non-negative weights
+    :return: values, summing to one
+    """
+    values /= values.dtype.type(np.sum(values, dtype=np.float64))
+    return values
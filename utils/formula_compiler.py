@@ -0,0 +1,627 @@
+"""
+Compiling caching formulas into NumPy functions that load without sympy
+
+A formula is parsed with sympy once, and printed as the source of a plain
+NumPy function f(m, v, r, *variables). That source and the variable list form
+a small JSON artifact. Pool workers receive compiled formulas with their plan,
+and later runs load artifacts from FORMULA_CACHE_DIR, so neither imports sympy
+or the LaTeX parser. Sympy is only imported when a formula is actually parsed.
+
+Sums and products over the file index are lowered to running aggregate
+kernels (utils.formula_kernels) rather than left to sympy's symbolic
+summation. In \\sum_{n=a}^{b}{...}, p_r(n) is the probability of rank n,
+ranks count from 1 and m is the current rank, so \\sum_{n=1}^{m}{p_r(n)} is v.
+"""
+import functools
+import hashlib
+import json
+import math
+import os
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+from config import FORMULA_CACHE_DIR
+from exceptions import InvalidParametersException
+from utils.formula_kernels import running_product, running_sum
+from utils.profiling import timer
+
+COMPILED_FORMULA_VERSION: int = 4
+FUNCTION_NAME: str = "caching_formula"
+# inputs of every caching formula, see modify_distribution_curve
+FORMULA_INPUTS: Tuple[str, ...] = ("m", "v", "r")
+# request distribution as written in formulas, p_r(m) is r
+REQUEST_FUNCTION: str = "p_{r}"
+AGGREGATE_PREFIX: str = "_aggregate_"
+CSE_PREFIX: str = "_x"
+# ranks m cast to the precision of the distributions, where used as values
+RANK_VALUE: str = "_m"
+TEMPORARY_PREFIX: str = "_t"
+# aggregate kind -> kernel called by compiled functions
+KERNELS: Dict[str, Callable[..., np.ndarray]] = {
+    "sum": running_sum,
+    "prod": running_product,
+}
+
+# compiled formulas known to this process, by formula string
+_REGISTRY: Dict[str, "CompiledFormula"] = {}
+
+
+class CompiledFormula(object):
+    """
+    NumPy source of a caching formula and the variables it needs
+    """
+
+    def __init__(
+        self,
+        formula: str,
+        source: str,
+        variables: Tuple[str, ...],
+        aggregates: Optional[List[Dict[str, Any]]] = None,
+    ) -> None:
+        """
+        :param formula: formula string the source was compiled from
+        :param source: Python source defining FUNCTION_NAME(m, v, r, *variables)
+            and, with aggregates, its term and outer parts
+        :param variables: formula variables other than m, v and r, in order
+        :param aggregates: kind ("sum" or "prod") and whether it is a prefix
+            (\\sum_{n=1}^{m}) of each running aggregate, in order
+        """
+        self.formula = formula
+        self.source = source
+        self.variables = tuple(variables)
+        self.aggregates = list(aggregates or [])
+        self._namespace: Optional[Dict[str, Any]] = None
+
+    def _compiled(self, name: str) -> Callable[..., Any]:
+        if self._namespace is None:
+            # modules NumPyPrinter may refer to
+            namespace: Dict[str, Any] = {
+                "numpy": np, "functools": functools, "math": math
+            }
+            namespace.update((kernel.__name__, kernel) for kernel in KERNELS.values())
+            exec(compile(self.source, f"<formula {self.formula}>", "exec"), namespace)
+            self._namespace = namespace
+        return self._namespace[name]
+
+    @property
+    def function(self) -> Callable[..., Any]:
+        """
+        :return: f(m, v, r, *variables) of the full, contiguous distribution,
+            compiled on first use
+        """
+        return self._compiled(FUNCTION_NAME)
+
+    @property
+    def prefix_sums(self) -> bool:
+        """
+        :return: whether every running aggregate is a sum from the first rank,
+            which engines working on partial arrays can maintain themselves
+        """
+        return all(
+            aggregate["kind"] == "sum" and aggregate["prefix"]
+            for aggregate in self.aggregates
+        )
+
+    def term(self, index: int) -> Callable[..., Any]:
+        """
+        :param index: running aggregate
+        :return: t(m, v, r, *variables), the aggregate's term of each rank
+        """
+        return self._compiled(f"{FUNCTION_NAME}_term_{index}")
+
+    @property
+    def outer(self) -> Callable[..., Any]:
+        """
+        :return: g(m, v, r, *variables, *aggregates), the formula given the
+            value of each running aggregate
+        """
+        return self._compiled(f"{FUNCTION_NAME}_outer")
+
+    def __call__(self, m: Any, v: Any, r: Any, *values: Any) -> Any:
+        return self.function(m, v, r, *values)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # functions from exec do not pickle, workers rebuild them from source
+        state = dict(self.__dict__)
+        state["_namespace"] = None
+        return state
+
+    def expression(self) -> Tuple[Any, List[Tuple[str, Any, Any, Any]]]:
+        """
+        :return: sympy expression of the formula over aggregate symbols, and
+            the (kind, term, lower, upper) of each aggregate, parsed again
+            (imports sympy)
+        """
+        return _parse(self.formula)[:2]
+
+    def to_dict(self) -> Dict[str, Any]:
+        artifact = {
+            "version": COMPILED_FORMULA_VERSION,
+            "formula": self.formula,
+            "source": self.source,
+            "variables": list(self.variables),
+            "aggregates": self.aggregates,
+        }
+        artifact["hash"] = _artifact_hash(artifact)
+        return artifact
+
+    @classmethod
+    def from_dict(cls, artifact: Dict[str, Any]) -> "CompiledFormula":
+        if artifact.get("version") != COMPILED_FORMULA_VERSION:
+            raise ValueError(f"Formula artifact version {artifact.get('version')}")
+        # the source is executed later, never from a truncated or edited file
+        if artifact.get("hash") != _artifact_hash(artifact):
+            raise ValueError("Formula artifact hash mismatch")
+        return cls(
+            artifact["formula"],
+            artifact["source"],
+            tuple(artifact["variables"]),
+            artifact["aggregates"],
+        )
+
+    def save(self, path: str) -> None:
+        """
+        :param path: JSON artifact written
+        """
+        with open(path, "w") as handle:
+            json.dump(self.to_dict(), handle, indent=2)
+
+    @classmethod
+    def load(cls, path: str) -> "CompiledFormula":
+        """
+        :param path: JSON artifact
+        :return: CompiledFormula
+        """
+        with open(path) as handle:
+            return cls.from_dict(json.load(handle))
+
+
+def lower_aggregates(expression: Any) -> Tuple[Any, List[Tuple[str, Any, Any, Any]]]:
+    """
+    Replacing sums and products over the file index by aggregate symbols
+    :param expression: parsed sympy expression
+    :return: expression over m, v, r, variables and aggregate symbols, and the
+        (kind, term, lower, upper) of each aggregate, terms as functions of
+        the term's rank position m and bounds as positions of the current m
+    """
+    import sympy
+
+    m, r = sympy.Symbol("m"), sympy.Symbol("r")
+    aggregates: List[Tuple[str, Any, Any, Any]] = []
+
+    def requests(item: Any) -> List[Any]:
+        return [
+            call for call in item.atoms(sympy.Function)
+            if str(call.func) == REQUEST_FUNCTION
+        ]
+
+    def lower(aggregate: Any) -> Any:
+        (index, first, last), = aggregate.limits
+        body = aggregate.function
+        if body.has(m) or any(call.args != (index,) for call in requests(body)):
+            raise InvalidParametersException(
+                f"Terms of {aggregate} may only depend on {index} through "
+                f"{REQUEST_FUNCTION}({index})"
+            )
+        if first.has(index) or last.has(index):
+            raise InvalidParametersException(f"Invalid bounds of {aggregate}")
+        # rank n is at position n - 1, the current rank m at position m
+        term = body.xreplace({call: r for call in requests(body)}).xreplace(
+            {index: m + 1}
+        )
+        aggregates.append((
+            "sum" if isinstance(aggregate, sympy.Sum) else "prod",
+            term,
+            sympy.expand(first.xreplace({m: m + 1}) - 1),
+            sympy.expand(last.xreplace({m: m + 1}) - 1),
+        ))
+        return sympy.Symbol(f"{AGGREGATE_PREFIX}{len(aggregates) - 1}")
+
+    # innermost first, so that terms never contain unlowered aggregates
+    expression = expression.replace(
+        lambda item: isinstance(item, (sympy.Sum, sympy.Product)), lower
+    )
+    expression = expression.xreplace(
+        {call: r for call in requests(expression) if call.args == (m,)}
+    )
+    if requests(expression):
+        raise InvalidParametersException(
+            f"{REQUEST_FUNCTION} may only be applied to m or a summation index"
+        )
+    return expression, aggregates
+
+
+def _parse(
+    formula: str,
+) -> Tuple[Any, List[Tuple[str, Any, Any, Any]], Tuple[str, ...]]:
+    # the only path importing sympy and the LaTeX parser
+    from sympy.core.function import AppliedUndef
+    from utils.parse_formula import (
+        _unique_vars_in_formula,
+        evaluate_string_to_valid_formula_str,
+        parse_to_sympy,
+    )
+
+    formula = evaluate_string_to_valid_formula_str(formula)
+    expression, aggregates = lower_aggregates(parse_to_sympy(formula))
+    variables = tuple(sorted(
+        var for var in _unique_vars_in_formula(formula) if var not in FORMULA_INPUTS
+    ))
+    unknown = expression.atoms(AppliedUndef)
+    if unknown:
+        raise InvalidParametersException(f"Unknown functions {unknown} in formula")
+    return expression, aggregates, variables
+
+
+# sympy functions evaluated by the NumPy ufunc of the same meaning
+UFUNCS: Dict[str, str] = {
+    "exp": "exp", "log": "log", "Abs": "absolute", "sign": "sign",
+    "floor": "floor", "ceiling": "ceil", "sin": "sin", "cos": "cos",
+    "tan": "tan", "asin": "arcsin", "acos": "arccos", "atan": "arctan",
+    "sinh": "sinh", "cosh": "cosh", "tanh": "tanh",
+}
+
+
+class _Emitter(object):
+    """
+    Statements of one compiled function. Array subexpressions are evaluated
+    by NumPy ufuncs into temporaries, reusing (out=) any temporary that is no
+    longer needed, and scalar subexpressions are printed once as they are.
+    """
+
+    def __init__(self, printer: Any, arrays: Set[Any]) -> None:
+        """
+        :param printer: NumPyPrinter of scalar subexpressions
+        :param arrays: array-valued input symbols, never overwritten
+        """
+        self.printer = printer
+        self.arrays = set(arrays)
+        self.lines: List[str] = []
+        # symbol -> code of its value, and array symbols defined by this
+        # function -> remaining uses, after which their buffer is free
+        self.names: Dict[Any, str] = {}
+        self.uses: Dict[Any, int] = {}
+        self.definitions: Dict[Any, Callable[[], Tuple[str, bool]]] = {}
+        self.temporaries = 0
+
+    def is_array(self, expression: Any) -> bool:
+        return bool(expression.free_symbols & self.arrays)
+
+    def count_uses(self, expressions: List[Any]) -> None:
+        import sympy
+
+        for expression in expressions:
+            for item in sympy.preorder_traversal(expression):
+                if item in self.definitions and item in self.arrays:
+                    self.uses[item] = self.uses.get(item, 0) + 1
+
+    def operand(self, expression: Any) -> Tuple[str, bool]:
+        """
+        :param expression: sympy expression
+        :return: code of its value, and whether its buffer may be overwritten
+        """
+        if not self.is_array(expression):
+            return self.printer.doprint(expression), False
+        # definitions first, so that none frees a buffer read by this node
+        for symbol in sorted(expression.free_symbols, key=str):
+            if symbol in self.definitions and symbol not in self.names:
+                self.define(symbol)
+        if not expression.is_Symbol:
+            return self.node(expression)
+        if expression in self.uses:
+            self.uses[expression] -= 1
+            return self.names[expression], self.uses[expression] == 0
+        return self.names.get(expression, self.printer.doprint(expression)), False
+
+    def define(self, symbol: Any) -> None:
+        code, owned = self.definitions[symbol]()
+        self.names[symbol] = code
+        if not owned:
+            # an alias of another array, never to be overwritten
+            self.uses.pop(symbol, None)
+
+    def apply(self, ufunc: str, operands: List[Tuple[str, bool]]) -> Tuple[str, bool]:
+        """
+        :param ufunc: NumPy ufunc name
+        :param operands: (code, overwritable) of each operand
+        :return: temporary holding the result, written into an overwritable
+            operand when there is one
+        """
+        arguments = ", ".join(code for code, _ in operands)
+        free = [code for code, owned in operands if owned]
+        if free:
+            self.lines.append(f"numpy.{ufunc}({arguments}, out={free[0]})")
+            for code in free[1:]:
+                if code != free[0]:
+                    self.lines.append(f"del {code}")
+            return free[0], True
+        self.temporaries += 1
+        name = f"{TEMPORARY_PREFIX}{self.temporaries}"
+        self.lines.append(f"{name} = numpy.{ufunc}({arguments}, dtype=_dtype)")
+        return name, True
+
+    def node(self, expression: Any) -> Tuple[str, bool]:
+        import sympy
+
+        if expression.is_Add:
+            return self._chain(expression.args, "add", "subtract", sympy.S.Zero)
+        if expression.is_Mul:
+            return self._chain(expression.args, "multiply", "divide", sympy.S.One)
+        if expression.is_Pow:
+            base, exponent = expression.args
+            if exponent == 2:
+                return self.apply("square", [self.operand(base)])
+            if exponent == sympy.Rational(1, 2):
+                return self.apply("sqrt", [self.operand(base)])
+            if exponent == -1:
+                return self.apply("divide", [("1.0", False), self.operand(base)])
+            return self.apply("power", [self.operand(base), self.operand(exponent)])
+        name = type(expression).__name__
+        if name in UFUNCS and len(expression.args) == 1:
+            return self.apply(UFUNCS[name], [self.operand(expression.args[0])])
+
+        # anything else is printed as is, its array operands are only read
+        symbols = {}
+        for item in sympy.preorder_traversal(expression):
+            if item.is_Symbol and item in self.definitions:
+                code, _ = self.operand(item)
+                symbols[item] = sympy.Symbol(code)
+        self.temporaries += 1
+        name = f"{TEMPORARY_PREFIX}{self.temporaries}"
+        self.lines.append(
+            f"{name} = numpy.asarray("
+            f"{self.printer.doprint(expression.xreplace(symbols))}, dtype=_dtype)"
+        )
+        return name, False
+
+    def _chain(
+        self, args: Tuple[Any, ...], combine: str, invert: str, identity: Any
+    ) -> Tuple[str, bool]:
+        # a + b - c and a * b / c, scalar parts folded into one operand
+        import sympy
+
+        scalars = [item for item in args if not self.is_array(item)]
+        arrays = [item for item in args if self.is_array(item)]
+        if combine == "add":
+            inverted = [item for item in arrays if item.could_extract_minus_sign()]
+            direct = [item for item in arrays if item not in inverted]
+            inverted = [-item for item in inverted]
+            scalar = sympy.Add(*scalars)
+        else:
+            inverted = [1 / item for item in arrays if item.is_Pow
+                        and item.exp.could_extract_minus_sign()]
+            direct = [item for item in arrays if not (
+                item.is_Pow and item.exp.could_extract_minus_sign()
+            )]
+            scalar = sympy.Mul(*scalars)
+
+        if direct:
+            value = self.operand(direct[0])
+            for item in direct[1:]:
+                value = self.apply(combine, [value, self.operand(item)])
+        else:
+            value = self.operand(scalar)
+            scalar = identity
+        for item in inverted:
+            value = self.apply(invert, [value, self.operand(item)])
+        if scalar != identity:
+            value = self.apply(combine, [value, self.operand(scalar)])
+        return value
+
+
+def _emit_function(
+    name: str,
+    arguments: List[str],
+    arrays: Set[Any],
+    printer: Any,
+    expression: Any,
+    aggregates: List[Tuple[str, Any, Any, Any]],
+) -> List[str]:
+    """
+    :param name: function name
+    :param arguments: argument names
+    :param arrays: array-valued argument symbols
+    :param printer: NumPyPrinter
+    :param expression: returned sympy expression
+    :param aggregates: (kind, term, lower, upper) of the aggregates the
+        expression uses, computed by the function itself
+    :return: source lines of the function
+    """
+    import sympy
+
+    # shared subexpressions of the terms and the result are computed once
+    replacements, reduced = sympy.cse(
+        [term for _, term, _, _ in aggregates] + [expression],
+        symbols=sympy.numbered_symbols(CSE_PREFIX),
+    )
+    emitter = _Emitter(printer, arrays)
+    rank = sympy.Symbol("m")
+    if rank in arrays:
+        # integer ranks enter values in the distributions' precision, as one
+        # cast temporary rather than promoting every temporary to float64
+        value_rank = sympy.Symbol(RANK_VALUE)
+        replacements = [
+            (symbol, value.xreplace({rank: value_rank}))
+            for symbol, value in replacements
+        ]
+        reduced = [item.xreplace({rank: value_rank}) for item in reduced]
+        emitter.arrays.add(value_rank)
+
+        def define_rank() -> Tuple[str, bool]:
+            emitter.lines.append(f"{RANK_VALUE} = numpy.array(m, dtype=_dtype)")
+            return RANK_VALUE, True
+
+        emitter.definitions[value_rank] = define_rank
+    lines: List[str] = []
+    for symbol, value in replacements:
+        if emitter.is_array(value):
+            emitter.arrays.add(symbol)
+            emitter.definitions[symbol] = lambda value=value: emitter.node(value)
+        else:
+            code, _ = emitter.operand(value)
+            lines.append(f"{symbol} = {code}")
+            emitter.names[symbol] = str(symbol)
+
+    for index, (kind, _, first, last) in enumerate(aggregates):
+        symbol = sympy.Symbol(f"{AGGREGATE_PREFIX}{index}")
+
+        def define(index: int = index, kind: str = kind, first: Any = first,
+                   last: Any = last) -> Tuple[str, bool]:
+            term, owned = emitter.operand(reduced[index])
+            # the bare m lets prefix aggregates skip the windowed difference,
+            # other bounds are positions, computed from the integer ranks
+            bounds = ", ".join(
+                "m" if bound == rank else printer.doprint(bound)
+                for bound in (first, last)
+            )
+            emitter.lines.append(
+                f"{AGGREGATE_PREFIX}{index} = {KERNELS[kind].__name__}"
+                f"(m, {term}, {bounds})"
+            )
+            if owned:
+                emitter.lines.append(f"del {term}")
+            return f"{AGGREGATE_PREFIX}{index}", True
+
+        emitter.arrays.add(symbol)
+        emitter.definitions[symbol] = define
+    emitter.count_uses([value for _, value in replacements] + list(reduced))
+
+    result, _ = emitter.operand(reduced[-1])
+    lines = (
+        [f"def {name}({', '.join(arguments)}):",
+         "    _dtype = numpy.result_type(v, r, 1.0)"]
+        + [f"    {line}" for line in lines + emitter.lines]
+        + [f"    return {result}"]
+    )
+    return lines
+
+
+def emit_source(
+    expression: Any,
+    aggregates: List[Tuple[str, Any, Any, Any]],
+    variables: Tuple[str, ...],
+) -> str:
+    """
+    Printing a lowered sympy expression as the source of a NumPy function,
+    simplified, with shared subexpressions computed once and temporaries
+    reused in place
+    :param expression: sympy expression of m, v, r, variables and aggregates
+    :param aggregates: (kind, term, lower, upper) of each aggregate
+    :param variables: formula variables, in argument order
+    :return: Python source defining FUNCTION_NAME, and with aggregates
+        FUNCTION_NAME_term_<i> and FUNCTION_NAME_outer
+    """
+    import sympy
+    from sympy.printing.numpy import NumPyPrinter
+
+    # variables that are not identifiers are renamed, arguments are positional
+    names = list(FORMULA_INPUTS) + [
+        var if var.isidentifier() else f"_variable_{index}"
+        for index, var in enumerate(variables)
+    ]
+    renames = {
+        sympy.Symbol(var): sympy.Symbol(name)
+        for var, name in zip(list(FORMULA_INPUTS) + list(variables), names)
+    }
+
+    def prepare(item: Any) -> Any:
+        # never accepting a simplification with more operations
+        return sympy.simplify(item.xreplace(renames), ratio=1)
+
+    expression = prepare(expression)
+    aggregates = [
+        (kind, prepare(term), first.xreplace(renames), last.xreplace(renames))
+        for kind, term, first, last in aggregates
+    ]
+    printer = NumPyPrinter({"fully_qualified_modules": True})
+    inputs = {sympy.Symbol(name) for name in FORMULA_INPUTS}
+    aggregate_symbols = [
+        sympy.Symbol(f"{AGGREGATE_PREFIX}{index}") for index in range(len(aggregates))
+    ]
+
+    lines = _emit_function(
+        FUNCTION_NAME, names, inputs, printer, expression, aggregates
+    )
+    for index, (_, term, _, _) in enumerate(aggregates):
+        lines += [""] + _emit_function(
+            f"{FUNCTION_NAME}_term_{index}", names, inputs, printer, term, []
+        )
+    if aggregates:
+        lines += [""] + _emit_function(
+            f"{FUNCTION_NAME}_outer",
+            names + [str(symbol) for symbol in aggregate_symbols],
+            inputs | set(aggregate_symbols),
+            printer,
+            expression,
+            [],
+        )
+    return "\n".join(lines) + "\n"
+
+
+def _artifact_hash(artifact: Dict[str, Any]) -> str:
+    content = {key: value for key, value in artifact.items() if key != "hash"}
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+def _artifact_path(formula: str) -> Optional[str]:
+    if not FORMULA_CACHE_DIR:
+        return None
+    # artifacts of older compilers are never picked up
+    key = f"{COMPILED_FORMULA_VERSION}:{formula}"
+    digest = hashlib.sha256(key.encode()).hexdigest()[:32]
+    return os.path.join(FORMULA_CACHE_DIR, f"{digest}.json")
+
+
+def register(compiled: CompiledFormula) -> CompiledFormula:
+    """
+    Making a compiled formula known to this process, e.g. in pool workers
+    :param compiled: CompiledFormula
+    :return: compiled
+    """
+    _REGISTRY[compiled.formula] = compiled
+    return compiled
+
+
+def compile_formula(formula: str) -> CompiledFormula:
+    """
+    Compiled formula from, in order, this process's registry, the artifact
+    cache, or sympy (writing the artifact for later runs)
+    :param formula: LaTeX or evaluated formula string
+    :return: CompiledFormula
+    """
+    if formula in _REGISTRY:
+        return _REGISTRY[formula]
+
+    path = _artifact_path(formula)
+    if path is not None and os.path.exists(path):
+        with timer("formula.load_artifact"):
+            try:
+                compiled = CompiledFormula.load(path)
+                if compiled.formula == formula:
+                    return register(compiled)
+            except (OSError, ValueError, KeyError):
+                pass
+
+    with timer("formula.parse"):
+        expression, aggregates, variables = _parse(formula)
+    with timer("formula.emit"):
+        import sympy
+
+        compiled = CompiledFormula(
+            formula,
+            emit_source(expression, aggregates, variables),
+            variables,
+            [
+                {"kind": kind, "prefix": first == 0 and last == sympy.Symbol("m")}
+                for kind, _, first, last in aggregates
+            ],
+        )
+    if path is not None:
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            compiled.save(path)
+        except OSError:
+            # the artifact cache is an optimization, never a requirement
+            pass
+    return register(compiled)
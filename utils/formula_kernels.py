@@ -0,0 +1,82 @@
+"""
+Running aggregate kernels of compiled formulas
+
+Sums and products over the file index, e.g. \\sum_{n=1}^{m}{p_r(n)^{1\\over\\alpha}},
+are lowered by utils.formula_compiler to one of these kernels over the array of
+per-file terms. Ranks are positions 0..N-1 of the full distribution, lower and
+upper are the (inclusive) positions of each rank's first and last term, and
+every aggregate costs O(N) whatever its bounds.
+"""
+import numpy as np
+from typing import Any
+
+from utils.dtypes import safe_cumsum
+
+
+def _bounds(m: np.ndarray, lower: Any, upper: Any) -> Any:
+    # half-open [lower, upper + 1) positions clipped to the distribution
+    length = np.shape(m)[0]
+    lower = np.clip(np.asarray(lower).astype(np.int64), 0, length)
+    upper = np.clip(np.asarray(upper).astype(np.int64) + 1, 0, length)
+    return lower, upper
+
+
+def _is_prefix(m: np.ndarray, lower: Any, upper: Any) -> bool:
+    # \sum_{n=1}^{m}, the most common bounds by far
+    return np.ndim(lower) == 0 and lower <= 0 and upper is m
+
+
+def _terms(m: np.ndarray, terms: Any) -> np.ndarray:
+    terms = np.broadcast_to(terms, np.shape(m))
+    # integer terms (e.g. \sum_{n=1}^{m}{n}) would overflow or truncate
+    return terms if terms.dtype.kind == "f" else terms.astype(np.float64)
+
+
+def running_sum(m: np.ndarray, terms: Any, lower: Any, upper: Any) -> np.ndarray:
+    """
+    Sum of terms[lower[i]:upper[i] + 1] for every rank i, through one
+    cumulative sum and a windowed difference
+    :param m: np.ndarray of ranks, every position of the distribution
+    :param terms: per-rank terms, broadcast to the ranks
+    :param lower: first position of each rank's sum
+    :param upper: last position of each rank's sum
+    :return: np.ndarray of sums, zero where the window is empty
+    """
+    terms = _terms(m, terms)
+    if _is_prefix(m, lower, upper):
+        return safe_cumsum(terms)
+    cumulative = np.concatenate([np.zeros(1, dtype=terms.dtype), safe_cumsum(terms)])
+    lower, upper = _bounds(m, lower, upper)
+    return np.where(
+        upper > lower, cumulative[upper] - cumulative[np.minimum(lower, upper)], 0
+    )
+
+
+def running_product(m: np.ndarray, terms: Any, lower: Any, upper: Any) -> np.ndarray:
+    """
+    Product of terms[lower[i]:upper[i] + 1] for every rank i. Windows are
+    taken on running sums of log-magnitudes, zero counts and negative counts,
+    so that zero and negative terms do not poison the products of other ranks.
+    :param m: np.ndarray of ranks, every position of the distribution
+    :param terms: per-rank terms, broadcast to the ranks
+    :param lower: first position of each rank's product
+    :param upper: last position of each rank's product
+    :return: np.ndarray of products, one where the window is empty
+    """
+    terms = _terms(m, terms)
+    if _is_prefix(m, lower, upper):
+        return np.cumprod(terms)
+    lower, upper = _bounds(m, lower, upper)
+    lower = np.minimum(lower, upper)
+
+    def window(values: np.ndarray) -> np.ndarray:
+        cumulative = np.concatenate([[0.0], np.cumsum(values, dtype=np.float64)])
+        return cumulative[upper] - cumulative[lower]
+
+    zero = terms == 0
+    with np.errstate(divide="ignore"):
+        magnitude = np.where(zero, 0.0, np.log(np.abs(np.where(zero, 1.0, terms))))
+    products = np.exp(window(magnitude))
+    products[window(zero) > 0] = 0.0
+    products[np.round(window(terms < 0)) % 2 == 1] *= -1
+    return products.astype(terms.dtype, copy=False)
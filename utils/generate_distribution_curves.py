@@ -3,19 +3,27 @@ Generating distribution curves for given sympy distribution formulas
 """
 
 import numpy as np
-import sympy
-from typing import Any, List
-from config import DEFAULT_ZIPF, USE_NUMPY_ZIPF, STRICT_EVALUATION
+from typing import Any, List, Optional
+from config import DEFAULT_ZIPF, PRECISION, USE_NUMPY_ZIPF, STRICT_EVALUATION
+from utils.dtypes import float_dtype, safe_cumsum, safe_normalize
+from utils.formula_compiler import CompiledFormula
+from utils.profiling import timer
 
 
 def generate_distribution_curve(
-    length: int, automatic: bool = False, formula: Any = None, *args, **kwargs
+    length: int,
+    automatic: bool = False,
+    formula: Any = None,
+    *args,
+    precision: str = PRECISION,
+    **kwargs,
 ) -> np.ndarray:
     """
     Generating a distribution curve
     :param length: size of array generated
     :param automatic: Whether to use an predefined, scaled Zipf distribution
     :param formula: sympa.core formula to be evaluated
+    :param precision: floating point precision of the automatic distribution
 
     :param args: additional arguments, currently unused
     :param kwargs: passing additional arguments, including sympy formulas
@@ -27,10 +35,11 @@ def generate_distribution_curve(
 
     if automatic:
         alpha = kwargs.get("a") if kwargs.get("a") else DEFAULT_ZIPF
+        dtype = float_dtype(precision)
         # generate standard zipf
         if USE_NUMPY_ZIPF:
             zipf: np.ndarray = np.random.zipf(alpha, length)
-            zipf = zipf.astype(np.float64)
+            zipf = zipf.astype(dtype)
 
         else:
             # define zipf(m) as
@@ -38,8 +47,8 @@ def generate_distribution_curve(
             if not STRICT_EVALUATION:
                 with np.errstate(divide="ignore", invalid="ignore"):
                     numerator: np.ndarray = np.true_divide(
-                        1, np.arange(length)
-                    ) ** alpha
+                        1, np.arange(length, dtype=dtype)
+                    ) ** dtype.type(alpha)
 
                     # need to remove infinite values, indicator of 0 index, use 1
                     numerator[numerator == np.inf] = 1
@@ -47,18 +56,22 @@ def generate_distribution_curve(
                     # what i'll try later
                     numerator[numerator == -np.inf] = -1
             else:
-                numerator: np.ndarray = (1 / np.arange(length)) ** alpha
-            denominator: np.ndarray = np.cumsum(numerator)
+                numerator: np.ndarray = (
+                    1 / np.arange(length, dtype=dtype)
+                ) ** dtype.type(alpha)
+            denominator: np.ndarray = safe_cumsum(numerator)
 
             zipf: np.ndarray = numerator / denominator
 
         # scale so that sum(p) = 1
-        zipf /= zipf.sum()
+        safe_normalize(zipf)
         # sort in descending order
         zipf = -np.sort(-zipf)
         return zipf
     else:
         # not the fastest implementation, but does allow for hiccups in sympy
+        import sympy
+
         artificial_distribution: List[Any] = []
         for m in np.arange(length):
             symbolic_m = sympy.symbols("m")
@@ -77,13 +90,19 @@ def generate_distribution_curve(
 
 
 def modify_distribution_curve(
-    existing_dist: np.ndarray, formula: Any = None, *args, **kwargs
+    existing_dist: np.ndarray,
+    formula: Any = None,
+    *args,
+    precision: Optional[str] = None,
+    **kwargs,
 ) -> np.ndarray:
     """
     Modifying distribution curves, namely for creating a caching distribution
      for the user
     :param existing_dist: np.ndarray distribution container
-    :param formula: sympy expression mapped for each item
+    :param formula: CompiledFormula (or sympy expression) mapped for each item
+    :param precision: floating point precision of the result, that of
+        existing_dist by default
     :param args: currently unused
     :param kwargs: sympy expression variables (use of variables m, v, and r is illegal)
     :return: np.ndarray containing the final distribution
@@ -93,23 +112,40 @@ def modify_distribution_curve(
     assert not any(
         [var in ["m", "v", "r"] for var in kwargs.keys()]
     ), "Sympy Symbols 'm', 'v', and 'r' are internal use only."
-    cumulative_dist = np.cumsum(existing_dist)
-    index = np.arange(len(existing_dist))
+    dtype = existing_dist.dtype if precision is None else float_dtype(precision)
+    existing_dist = existing_dist.astype(dtype, copy=False)
+    cumulative_dist = safe_cumsum(existing_dist)
+    # ranks enter formulas as signed integers: unsigned ranks would wrap on
+    # subtraction, and float32 ranks collapse above 2**24 as positions of
+    # windowed sums. Compiled formulas cast them to the precision where they
+    # are used as values, sympy ones promote and are cast back below
+    index = np.arange(len(existing_dist), dtype=np.int64)
 
-    lambda_arg_keys = ["m", "v", "r"]
     lambda_arg_values = [index, cumulative_dist, existing_dist]
-    for key, value in kwargs.items():
-        lambda_arg_keys.append(key)
-        lambda_arg_values.append(value)
+    if isinstance(formula, CompiledFormula):
+        func = formula.function
+        lambda_arg_values += [kwargs[var] for var in formula.variables]
+    else:
+        import sympy
+
+        lambda_arg_keys = ["m", "v", "r"]
+        for key, value in kwargs.items():
+            lambda_arg_keys.append(key)
+            lambda_arg_values.append(value)
 
-    lambda_arg_keys = [sympy.Symbol(var) for var in lambda_arg_keys]
+        lambda_arg_keys = [sympy.Symbol(var) for var in lambda_arg_keys]
 
-    func = sympy.lambdify(lambda_arg_keys, formula, "numpy")
-    modified_distribution: np.ndarray = np.array(func(*lambda_arg_values))
+        with timer("distribution.lambdify"):
+            func = sympy.lambdify(lambda_arg_keys, formula, "numpy")
+    # integer and float64 operands may promote, results keep the precision
+    with timer("distribution.formula"):
+        modified_distribution: np.ndarray = np.asarray(
+            func(*lambda_arg_values), dtype=dtype
+        )
 
     # if the total probabilities are less than one, just modify them accordingly
     if not STRICT_EVALUATION:
-        modified_distribution = modified_distribution / np.sum(modified_distribution)
+        modified_distribution = safe_normalize(modified_distribution.copy())
 
     return modified_distribution
 
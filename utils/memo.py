@@ -0,0 +1,52 @@
+"""
+Per-process memos of upstream artifacts (distributions, alias tables)
+
+Workers keep the artifacts of the cells they recently simulated, keyed by the
+arguments they depend on. Hits and misses are counted as profiling counters
+(memo.<name>.hits and memo.<name>.misses), merged per process by
+utils.profiling.Profile, so the hit rates of every worker can be reported.
+"""
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+from config import DISTRIBUTION_CACHE_SIZE
+from utils.profiling import MEMO_PREFIX, count
+
+
+class Memo(object):
+    """
+    Least recently used memo of one kind of artifact
+    """
+
+    def __init__(self, name: str, maxsize: int = DISTRIBUTION_CACHE_SIZE) -> None:
+        """
+        :param name: artifact name, e.g. "alias_table"
+        :param maxsize: entries kept
+        """
+        self.name = name
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[Hashable, Any]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, build: Callable[[], Any]) -> Any:
+        """
+        :param key: arguments the artifact depends on. Arrays are keyed by id,
+            and must then be held by the artifact so that ids are never reused
+        :param build: called without arguments on a miss
+        :return: memoized artifact
+        """
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            count(f"{MEMO_PREFIX}{self.name}.hits")
+            return self._entries[key]
+        count(f"{MEMO_PREFIX}{self.name}.misses")
+        value = build()
+        self._entries[key] = value
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return value
+
+    def clear(self) -> None:
+        self._entries.clear()
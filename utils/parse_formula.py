@@ -6,105 +6,87 @@ just about everything important that can be evaluated, like sums and functions.
 This module permits the use of sympy expressions by adding decorated functions as
 replacements for normally-omitted variables.
 
+Sympy and its LaTeX parser are imported only when a formula is parsed, so
+processes running precompiled formulas (see utils.formula_compiler) skip them.
 """
-from typing import Any, Set, List
-from sympy.core.symbol import Symbol
-from sympy.parsing.latex import parse_latex
+import re
+from functools import lru_cache
+from typing import Any, FrozenSet, List, Tuple
 
 from config import REPLACEMENTS
 
+# one alternative per token kind, matched left to right in a single pass
+TOKEN_PATTERN = re.compile(
+    r"(?P<command>\\[A-Za-z]+|\\.)"
+    r"|(?P<number>\d+(?:\.\d*)?|\.\d+)"
+    r"|(?P<name>[A-Za-z](?:_(?:\{[A-Za-z0-9]*\}|[A-Za-z0-9]))?)"
+    r"|(?P<space>\s+)"
+    r"|(?P<symbol>.)",
+    re.DOTALL,
+)
+# the request distribution, as written in formulas
+REQUEST_NAMES = ("p_r", "p_{r}")
 
+
+def tokenize(formula: str) -> List[Tuple[str, str]]:
+    """
+    Splitting LaTeX into tokens in linear time
+    :param formula: LaTeX string
+    :return: list of (kind, text), kind one of "command" (e.g. \\alpha),
+        "number", "name" (e.g. m, p_r), "space" and "symbol"
+    """
+    return [
+        (match.lastgroup, match.group()) for match in TOKEN_PATTERN.finditer(formula)
+    ]
+
+
+@lru_cache(maxsize=128)
 def parse_to_sympy(formula: str) -> Any:
+    from sympy.parsing.latex import parse_latex
+
     return parse_latex(formula)
 
 
-def _unique_vars_in_formula(formula: str) -> Set[str]:
+@lru_cache(maxsize=128)
+def _unique_vars_in_formula(formula: str) -> FrozenSet[str]:
     """
-    Generating sympy formulas, with some added verification that sympy
-    didn't lazily parse it. Currently depreciated.
+    Variables of a formula, from a single traversal of its sympy tree.
+    Summation indices are bound by their sums and not included.
 
     :param formula: LaTeX string
-    :return: set of unique variables required in formula, neglected by sympy sometimes
+    :return: frozenset of the names of the formula's free symbols, including
+        m, v and r where used
     """
-
-    # first convert all unnecessary syntax into reasonable one-line values
-    for key, value in REPLACEMENTS.items():
-        formula = formula.replace(key, value)
-    # clean up unnecessary spacing, it shouldn't be necessary for proper LaTeX
-    formula = (
-        formula.replace("\n", "").replace(" ", "").replace("\t", "").replace("\r", "")
-    )
-
-    # separate on legitimate latex mathematics
-    variables: List[str] = [formula]
-    for op in ["+", "-", "*", "/", "^"]:
-        variables = list(
-            map(lambda x: x.strip().strip("{").strip("}").split(op), variables)
-        )
-        variables = [item for sublist in variables for item in sublist]
-
-    # there may be some legitimate semantics left, namely implicit multiplication
-    # with parentheses, but taking note of defined functions
-    for index, var in enumerate(variables):
-        # assume all defined functions contain "_"
-        if ("(" in var or ")" in var) and "_" not in var and "\\" not in var:
-            split_vars = [item.split("(") for item in var.split(")")]
-            split_vars = [item for sublist in split_vars for item in sublist]
-            variables.pop(index)
-            variables.extend(split_vars)
-
-    # separate any remaining garlic items
-    for index, var in enumerate(variables):
-        if len(var) > 1 and "_" not in var and "\\" not in var:
-            split_vars = [char for char in var if char not in ",.0123456789"]
-            variables.pop(index)
-            variables.extend(split_vars)
-
-    # last, disregard numericals and empty strings and require unique
-    unique_sympy_vars = []
-
-    parse_latex_identified: List[Any] = list(parse_latex(formula).args)
-
-    while len(parse_latex_identified) > 0:
-        parse_latex_identified = [
-            piecewise.args
-            if (not isinstance(piecewise, Symbol) and not isinstance(piecewise, tuple))
-            else piecewise
-            for piecewise in parse_latex_identified
-        ]
-        # flatten
-        for index, item in enumerate(parse_latex_identified):
-            if isinstance(item, tuple):
-                parse_latex_identified.pop(index)
-                parse_latex_identified.extend(item)
-            elif isinstance(item, Symbol) or item.is_Function:
-                parse_latex_identified.pop(index)
-                unique_sympy_vars.append(item)
-            else:
-                parse_latex_identified.pop(index)
-                parse_latex_identified.extend(item.args)
-
-    stringified = set([str(item) for item in unique_sympy_vars])
-
-    return stringified
+    expression = parse_to_sympy(evaluate_string_to_valid_formula_str(formula))
+    return frozenset(str(symbol) for symbol in expression.free_symbols)
 
 
 def evaluate_string_to_valid_formula_str(formula: str) -> str:
     """
-    Simply cleaning up the mess
+    Simply cleaning up the mess, in one pass over the formula's tokens
     :param formula: string containing LaTeX
-    :return: string with modified variables (namely running sums and file dist func.s)
+    :return: string with modified variables (namely the file dist func. of m),
+        running sums are lowered by utils.formula_compiler
     """
-    # first convert all unnecessary syntax into reasonable one-line values
-    for key, value in REPLACEMENTS.items():
-        formula = formula.replace(key, value)
-    # clean up unnecessary spacing, it shouldn't be necessary for proper LaTeX
-    formula = (
-        formula.replace("\n", "").replace(" ", "").replace("\t", "").replace("\r", "")
-    )
-
-    formula = formula.replace("{\\sum_{n=1}^{m}{p_r(n)", "{v").replace("p_r(m)", "r")
-    return formula
+    tokens = [token for token in tokenize(formula) if token[0] != "space"]
+    pieces: List[str] = []
+    index = 0
+    while index < len(tokens):
+        kind, text = tokens[index]
+        if kind == "name" and text in REQUEST_NAMES and [
+            item for _, item in tokens[index + 1:index + 4]
+        ] == ["(", "m", ")"]:
+            pieces.append("r")
+            index += 4
+            continue
+        text = REPLACEMENTS.get(text, text)
+        # spacing is not necessary for proper LaTeX, except to end a command
+        if pieces and pieces[-1][-1:].isalpha() and pieces[-1].startswith("\\") \
+                and text[:1].isalpha():
+            pieces.append(" ")
+        pieces.append(text)
+        index += 1
+    return "".join(pieces)
 
 
 if __name__ == "__main__":
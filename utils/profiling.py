@@ -0,0 +1,211 @@
+"""
+Low-overhead per-stage timers and counters
+
+Each process accumulates (calls, total, min, max) per named stage and a count
+per named counter in plain dicts, costing two perf_counter_ns calls and a dict
+update per timed block. Workers hand their accumulated data back with each
+chunk of work and start over, and the driver merges them into a Profile. A
+timeline of individual events is kept only when requested, for Chrome traces.
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List
+
+from config import MAX_PROFILE_EVENTS, PROFILING_ENABLED
+
+# counters of utils.memo.Memo, memo.<name>.hits and memo.<name>.misses
+MEMO_PREFIX: str = "memo."
+
+# stage -> [calls, total ns, min ns, max ns]
+_TIMERS: Dict[str, List[int]] = {}
+_COUNTERS: Dict[str, int] = {}
+# (stage, start ns, duration ns) of each timed block, when recorded
+_EVENTS: List[Any] = []
+_ENABLED: bool = PROFILING_ENABLED
+_TIMELINE: bool = False
+
+
+def configure(enabled: bool = PROFILING_ENABLED, timeline: bool = False) -> None:
+    """
+    :param enabled: collect timers and counters in this process
+    :param timeline: also record individual events, up to MAX_PROFILE_EVENTS
+    """
+    global _ENABLED, _TIMELINE
+    _ENABLED = enabled
+    _TIMELINE = enabled and timeline
+
+
+@contextmanager
+def timer(stage: str) -> Iterator[None]:
+    """
+    Timing a block under a stage name
+    :param stage: stage name, e.g. "evaluate.sample_cache"
+    """
+    if not _ENABLED:
+        yield
+        return
+    start = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter_ns() - start
+        stats = _TIMERS.get(stage)
+        if stats is None:
+            _TIMERS[stage] = [1, elapsed, elapsed, elapsed]
+        else:
+            stats[0] += 1
+            stats[1] += elapsed
+            if elapsed < stats[2]:
+                stats[2] = elapsed
+            if elapsed > stats[3]:
+                stats[3] = elapsed
+        if _TIMELINE and len(_EVENTS) < MAX_PROFILE_EVENTS:
+            _EVENTS.append((stage, start, elapsed))
+
+
+def count(counter: str, amount: int = 1) -> None:
+    """
+    :param counter: counter name, e.g. "evaluate.files_requested"
+    :param amount: increment
+    """
+    if _ENABLED:
+        _COUNTERS[counter] = _COUNTERS.get(counter, 0) + amount
+
+
+def collect(reset: bool = True) -> Dict[str, Any]:
+    """
+    :param reset: start over after collecting
+    :return: this process's timers, counters and events, picklable
+    """
+    collected = {
+        "pid": os.getpid(),
+        "tid": threading.get_ident(),
+        "timers": {stage: list(stats) for stage, stats in _TIMERS.items()},
+        "counters": dict(_COUNTERS),
+        "events": list(_EVENTS),
+    }
+    if reset:
+        _TIMERS.clear()
+        _COUNTERS.clear()
+        _EVENTS.clear()
+    return collected
+
+
+class Profile(object):
+    """
+    Timers and counters merged across processes
+    """
+
+    def __init__(self) -> None:
+        self.timers: Dict[str, List[int]] = {}
+        self.counters: Dict[str, int] = {}
+        # (pid, tid, stage, start ns, duration ns)
+        self.events: List[Any] = []
+        self.processes: set = set()
+        # pid -> memo name -> [hits, misses]
+        self.memos: Dict[int, Dict[str, List[int]]] = {}
+
+    def merge(self, collected: Dict[str, Any]) -> "Profile":
+        """
+        :param collected: output of collect() in any process
+        :return: self
+        """
+        self.processes.add(collected["pid"])
+        for stage, (calls, total, low, high) in collected["timers"].items():
+            stats = self.timers.get(stage)
+            if stats is None:
+                self.timers[stage] = [calls, total, low, high]
+            else:
+                stats[0] += calls
+                stats[1] += total
+                stats[2] = min(stats[2], low)
+                stats[3] = max(stats[3], high)
+        for counter, amount in collected["counters"].items():
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+            if counter.startswith(MEMO_PREFIX):
+                name, outcome = counter[len(MEMO_PREFIX):].rsplit(".", 1)
+                stats = self.memos.setdefault(collected["pid"], {}).setdefault(
+                    name, [0, 0]
+                )
+                stats[outcome == "misses"] += amount
+        self.events.extend(
+            (collected["pid"], collected["tid"], *event)
+            for event in collected["events"]
+        )
+        return self
+
+    def summary(self) -> str:
+        """
+        :return: table of stages by total time (summed over processes), then
+            counters
+        """
+        lines = [
+            f"{'stage':<36} {'calls':>10} {'total s':>10} {'mean us':>10} "
+            f"{'min us':>10} {'max us':>10}"
+        ]
+        for stage, (calls, total, low, high) in sorted(
+            self.timers.items(), key=lambda item: -item[1][1]
+        ):
+            lines.append(
+                f"{stage:<36} {calls:>10} {total / 1e9:>10.3f} "
+                f"{total / calls / 1e3:>10.1f} {low / 1e3:>10.1f} {high / 1e3:>10.1f}"
+            )
+        if self.counters:
+            lines.append("")
+            lines.append(f"{'counter':<36} {'value':>10}")
+            for counter, amount in sorted(self.counters.items()):
+                lines.append(f"{counter:<36} {amount:>10}")
+        if self.memos:
+            lines.append("")
+            lines.append(
+                f"{'memo by process':<36} {'hits':>10} {'misses':>10} {'hit rate':>10}"
+            )
+            for pid, memos in sorted(self.memos.items()):
+                for name, (hits, misses) in sorted(memos.items()):
+                    lines.append(
+                        f"{f'{pid} {name}':<36} {hits:>10} {misses:>10} "
+                        f"{hits / max(1, hits + misses):>10.2%}"
+                    )
+        lines.append(f"\n{len(self.processes)} processes")
+        return "\n".join(lines)
+
+    def memo_hit_rates(self) -> Dict[int, Dict[str, float]]:
+        """
+        :return: pid -> memo name -> fraction of lookups that hit, per worker
+        """
+        return {
+            pid: {
+                name: hits / max(1, hits + misses)
+                for name, (hits, misses) in memos.items()
+            }
+            for pid, memos in self.memos.items()
+        }
+
+    def write_chrome_trace(self, path: str) -> None:
+        """
+        Writing recorded events as a Chrome trace (chrome://tracing, Perfetto)
+        :param path: JSON file
+        """
+        origin = min((event[3] for event in self.events), default=0)
+        trace = [
+            {
+                "name": stage,
+                "cat": stage.split(".")[0],
+                "ph": "X",
+                "ts": (start - origin) / 1e3,
+                "dur": duration / 1e3,
+                "pid": pid,
+                "tid": tid,
+            }
+            for pid, tid, stage, start, duration in self.events
+        ]
+        trace += [
+            {"name": counter, "ph": "C", "ts": 0, "pid": 0,
+             "args": {counter: amount}}
+            for counter, amount in self.counters.items()
+        ]
+        with open(path, "w") as handle:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, handle)
@@ -0,0 +1,159 @@
+"""
+Batched samplers shared by the simulation engines
+"""
+import numpy as np
+from typing import Any, List
+from exceptions import InvalidParametersException
+from utils.dtypes import index_dtype
+np.seterr(divide='ignore', invalid='ignore')
+
+
+def sample_without_replacement(
+    prob_dist: np.ndarray, size: int, num_samples: int
+) -> np.ndarray:
+    """
+    Drawing many independent samples without replacement at once (Gumbel
+    top-k), equivalent to num_samples calls of
+    np.random.choice(len(prob_dist), size, p=prob_dist, replace=False)
+    :param prob_dist: np.ndarray of (not necessarily normalized) weights
+    :param size: indexes per sample, capped at the number of non-zero weights
+    :param num_samples: number of independent samples
+    :return: num_samples,size np.ndarray of indexes, in order of selection, in
+        the smallest unsigned dtype indexing prob_dist
+    """
+    prob_dist = np.nan_to_num(prob_dist)
+    size = int(min(size, np.count_nonzero(prob_dist > 0)))
+    if size == 0:
+        return np.empty((num_samples, 0), dtype=index_dtype(len(prob_dist)))
+
+    shape = (num_samples, len(prob_dist))
+    if prob_dist.dtype == np.float32:
+        # float32 keys halve the samples x files matrix, drawn from a generator
+        # seeded off the global state so np.random.seed still applies
+        rng = np.random.default_rng(np.random.randint(2**63 - 1))
+        keys = rng.random(shape, dtype=np.float32)
+        # u may be 0, whose key would be -inf, so it is clamped to the smallest
+        # normal float32. Standard Gumbel keys, -log(-log(u)), computed in place
+        np.maximum(keys, np.finfo(np.float32).tiny, out=keys)
+        np.log(keys, out=keys)
+        np.negative(keys, out=keys)
+        np.log(keys, out=keys)
+        np.negative(keys, out=keys)
+        keys += np.log(prob_dist)
+    else:
+        keys = np.log(prob_dist) + np.random.gumbel(size=shape)
+    chosen = np.argpartition(-keys, size - 1, axis=1)[:, :size]
+    order = np.argsort(-np.take_along_axis(keys, chosen, axis=1), axis=1)
+    return np.take_along_axis(chosen, order, axis=1).astype(
+        index_dtype(len(prob_dist)), copy=False
+    )
+
+
+def membership_mask(indexes: np.ndarray, length: int) -> np.ndarray:
+    """
+    :param indexes: num_samples,size np.ndarray of indexes
+    :param length: number of possible indexes
+    :return: num_samples,length boolean np.ndarray, True where sampled
+    """
+    mask = np.zeros((len(indexes), length), dtype=bool)
+    np.put_along_axis(mask, indexes, True, axis=1)
+    return mask
+
+
+class AliasTable(object):
+    """
+    Walker/Vose alias table, drawing i.i.d. indexes (with replacement) in O(1)
+    per draw, where np.random.choice rebuilds a cumulative distribution and
+    searches it on every call. Built once per distribution, picklable.
+    """
+
+    def __init__(self, prob_dist: np.ndarray) -> None:
+        """
+        :param prob_dist: np.ndarray of (not necessarily normalized) weights
+        """
+        weights = np.asarray(prob_dist, dtype=np.float64)
+        # NaN and negative weights are never drawn
+        scaled = np.where(weights > 0, weights, 0.0)
+        length = len(scaled)
+        total = scaled.sum()
+        # every column holds its own index with probability threshold[i], and
+        # alias[i] otherwise
+        self.threshold = np.ones(length)
+        self.alias = np.arange(length, dtype=index_dtype(length))
+        if not total > 0:
+            raise InvalidParametersException(
+                "Alias table of a distribution without support"
+            )
+        scaled *= length / total
+
+        small = np.flatnonzero(scaled < 1)
+        large = np.flatnonzero(scaled >= 1)
+        while len(small) > 1024 and len(large):
+            # Vose's pairing in bulk: the deficits of the small columns are
+            # laid end to end and taken from the surpluses of the large ones,
+            # each small column going to the large one its deficit starts in.
+            # A large column can give at most one deficit more than its
+            # surplus, and becomes a small one (never negative) when it does.
+            values = scaled[small]
+            deficits = 1 - values
+            starts = np.cumsum(deficits) - deficits
+            surpluses = np.cumsum(scaled[large] - 1)
+            # donor of each small column: the number of surpluses ending at or
+            # before its start, searched for the (fewer) surpluses
+            ends = np.searchsorted(starts, surpluses, side="left")
+            donors = np.minimum(
+                np.cumsum(np.bincount(ends, minlength=len(small) + 1)[:len(small)]),
+                len(large) - 1,
+            )
+            self.threshold[small] = values
+            self.alias[small] = large[donors]
+            given = scaled[large] - np.bincount(donors, deficits, minlength=len(large))
+            scaled[large] = np.maximum(given, 0)
+            small, large = large[given < 1], large[given >= 1]
+        # once small columns are scarce, bulk rounds only settle a few each, so
+        # the remaining ones are paired one at a time
+        remaining = dict(zip(
+            np.concatenate([small, large]).tolist(),
+            np.concatenate([scaled[small], scaled[large]]).tolist(),
+        ))
+        small_stack: List[int] = small.tolist()
+        large_stack: List[int] = large.tolist()
+        settled: List[int] = []
+        settled_donors: List[int] = []
+        while small_stack and large_stack:
+            less, more = small_stack.pop(), large_stack[-1]
+            settled.append(less)
+            settled_donors.append(more)
+            remaining[more] -= 1 - remaining[less]
+            if remaining[more] < 1:
+                small_stack.append(large_stack.pop())
+        self.threshold[settled] = [remaining[index] for index in settled]
+        self.alias[settled] = settled_donors
+        # leftovers are only off by rounding, they keep their own index
+
+    def __len__(self) -> int:
+        return len(self.threshold)
+
+    def sample(self, size: Any) -> np.ndarray:
+        """
+        :param size: number (or shape) of i.i.d. indexes drawn
+        :return: np.ndarray of indexes, in the smallest unsigned dtype indexing
+            the distribution
+        """
+        # a generator seeded off the global state, so np.random.seed applies
+        rng = np.random.default_rng(np.random.randint(2**63 - 1))
+        columns = rng.integers(len(self.threshold), size=size)
+        aliased = rng.random(size) >= self.threshold[columns]
+        return np.where(aliased, self.alias[columns], columns).astype(
+            self.alias.dtype, copy=False
+        )
+
+    def probabilities(self) -> np.ndarray:
+        """
+        :return: np.ndarray of the probability of every index, as drawn
+        """
+        length = len(self.threshold)
+        return (
+            self.threshold
+            + np.bincount(self.alias, 1 - self.threshold, minlength=length)
+        ) / length
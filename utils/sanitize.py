@@ -0,0 +1,90 @@
+"""
+Sanitizing caching distributions once, before any user is sampled
+
+Formulas evaluated over a whole sweep produce NaN, infinite or negative
+weights in degenerate regions (e.g. alpha near 0, where every weight
+underflows). Each distribution is cleaned, normalized and its support counted
+in a single vectorized pass, so samplers never have to recover from
+np.random.choice errors per user, and degenerate cells are recognized by
+their status rather than by exception messages.
+"""
+import numpy as np
+
+from utils.dtypes import safe_normalize
+
+# sampled as usual
+HEALTHY: str = "healthy"
+# no finite positive weight, nothing can be cached
+EMPTY: str = "empty"
+# no more files with a positive weight than cache slots, all of them cached
+SATURATED: str = "saturated"
+STATUSES = [HEALTHY, EMPTY, SATURATED]
+
+
+class SanitizedDistribution(object):
+    """
+    Normalized, finite and non-negative probabilities, with their support
+    """
+
+    def __init__(self, probabilities: np.ndarray, support: int, repaired: int) -> None:
+        """
+        :param probabilities: np.ndarray summing to one, or all zeros
+        :param support: number of non-zero probabilities
+        :param repaired: number of NaN, infinite or negative weights replaced
+        """
+        self.probabilities = probabilities
+        self.support = support
+        self.repaired = repaired
+
+    def __len__(self) -> int:
+        return len(self.probabilities)
+
+    @property
+    def empty(self) -> bool:
+        return self.support == 0
+
+    def status(self, size: int) -> str:
+        """
+        :param size: files sampled
+        :return: one of STATUSES
+        """
+        if self.empty:
+            return EMPTY
+        return SATURATED if self.support <= size else HEALTHY
+
+    def sample(self, size: int) -> np.ndarray:
+        """
+        Choosing files without replacement, never raising for lack of support
+        :param size: files chosen, capped at the support
+        :return: np.ndarray of chosen indexes
+        """
+        if self.support <= size:
+            # every supported file is chosen, nothing to sample
+            return np.flatnonzero(self.probabilities)
+        return np.random.choice(
+            len(self.probabilities), size, p=self.probabilities, replace=False
+        )
+
+
+def sanitize(weights: np.ndarray) -> SanitizedDistribution:
+    """
+    :param weights: np.ndarray of (not necessarily normalized) weights
+    :return: SanitizedDistribution of the weights, NaN and negative weights
+        dropped, and positive infinite weights taken as the limit (uniform over
+        them)
+    """
+    weights = np.asarray(weights)
+    dtype = weights.dtype if weights.dtype.kind == "f" else np.dtype(np.float64)
+    valid = np.isfinite(weights)
+    infinite = np.isposinf(weights)
+    if infinite.any():
+        probabilities = infinite.astype(dtype)
+    else:
+        probabilities = np.where(valid & (weights > 0), weights, 0).astype(
+            dtype, copy=False
+        )
+    repaired = len(weights) - int(np.count_nonzero(valid & (weights >= 0)))
+    support = int(np.count_nonzero(probabilities))
+    if support:
+        safe_normalize(probabilities)
+    return SanitizedDistribution(probabilities, support, repaired)
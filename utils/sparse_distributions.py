@@ -0,0 +1,426 @@
+"""
+Compact distributions over very large catalogs
+
+A head-tail distribution keeps the per-item weights of the most popular ranks
+in a dense array, and represents the remaining ranks by geometric buckets.
+Within a bucket, weights follow a power law between the weights at the
+bucket's edges, which is exact for a Zipf tail and close for any smooth
+tail. Memory depends on the head size and the number of buckets, and not on
+the catalog size. Sampling and inclusion probabilities work directly on this
+representation.
+"""
+import numpy as np
+from typing import Callable, Optional, Tuple
+
+from config import DEFAULT_HEAD_SIZE, DEFAULT_TAIL_BUCKETS, DEFAULT_ZIPF
+from exceptions import InvalidParametersException
+
+# below this distance from 1, power-law exponents are integrated as 1
+_UNIT_EXPONENT_TOLERANCE: float = 1e-9
+# rounds of draws without a new rank before sampling gives up
+MAX_STALLED_ROUNDS: int = 64
+
+
+def tail_edges(length: int, head_size: int, num_buckets: int) -> np.ndarray:
+    """
+    :param length: catalog size
+    :param head_size: ranks stored densely
+    :param num_buckets: desired number of tail buckets
+    :return: np.ndarray of geometric bucket edges, from head_size to length
+    """
+    if length <= head_size:
+        return np.array([length], dtype=np.int64)
+    edges = np.geomspace(head_size, length, num_buckets + 1).astype(np.int64)
+    edges[0], edges[-1] = head_size, length
+    return np.unique(edges)
+
+
+class HeadTailDistribution(object):
+    """
+    Unnormalized weights by rank, dense head and power-law tail buckets
+    """
+
+    def __init__(
+        self, head: np.ndarray, edges: np.ndarray, edge_weights: np.ndarray
+    ) -> None:
+        """
+        :param head: np.ndarray of the weights of ranks 0..len(head)-1
+        :param edges: np.ndarray of tail bucket edges, edges[0] == len(head) and
+            edges[-1] is the catalog size
+        :param edge_weights: np.ndarray per-item weight at each edge
+        """
+        if edges[0] != len(head) or len(edges) != len(edge_weights):
+            raise InvalidParametersException("Tail edges do not follow the head")
+        self.head = np.asarray(head, dtype=np.float64)
+        self.edges = np.asarray(edges, dtype=np.int64)
+        self.edge_weights = np.asarray(edge_weights, dtype=np.float64)
+
+        low, high = self.edge_weights[:-1], self.edge_weights[1:]
+        ratio = self.edges[1:] / self.edges[:-1]
+        # a bucket with a zero edge weight is uniform at its mean weight
+        self._power_law = (low > 0) & (high > 0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.exponents = np.where(
+                self._power_law, -np.log(high / low) / np.log(ratio), 0.0
+            )
+        self.masses = np.where(
+            self._power_law,
+            low * self.edges[:-1] * _power_integral(ratio, self.exponents),
+            (low + high) / 2 * (self.edges[1:] - self.edges[:-1]),
+        )
+        self._cumulative = np.cumsum(np.concatenate([self.head, self.masses]))
+
+    @classmethod
+    def zipf(
+        cls,
+        length: int,
+        a: float = DEFAULT_ZIPF,
+        head_size: int = DEFAULT_HEAD_SIZE,
+        num_buckets: int = DEFAULT_TAIL_BUCKETS,
+    ) -> "HeadTailDistribution":
+        """
+        Counterpart of generate_distribution_curve(length, automatic=True, a=a),
+        with weight m^-a divided by its running sum
+        :param length: catalog size, e.g. 10^9
+        :param a: Zipf exponent
+        :param head_size: ranks stored densely
+        :param num_buckets: desired number of tail buckets
+        :return: HeadTailDistribution
+        """
+        head_size = min(head_size, length)
+        with np.errstate(divide="ignore"):
+            numerator = 1 / np.arange(head_size, dtype=np.float64) ** a
+        numerator[:1] = 1
+        running = np.cumsum(numerator)
+        edges = tail_edges(length, head_size, num_buckets)
+
+        # running sum past the head, sum of n^-a over [head_size, m] taken as
+        # the integral over [head_size - 1/2, m + 1/2]
+        start, stop = head_size - 0.5, edges + 0.5
+        if abs(a - 1) < _UNIT_EXPONENT_TOLERANCE:
+            tail_sum = np.log(stop / start)
+        else:
+            tail_sum = (stop ** (1 - a) - start ** (1 - a)) / (1 - a)
+        head_sum = running[-1] if head_size else 0.0
+        edge_weights = edges.astype(np.float64) ** -a / (head_sum + tail_sum)
+        return cls(numerator / running, edges, edge_weights)
+
+    @classmethod
+    def from_dense(
+        cls,
+        dist: np.ndarray,
+        head_size: int = DEFAULT_HEAD_SIZE,
+        num_buckets: int = DEFAULT_TAIL_BUCKETS,
+    ) -> "HeadTailDistribution":
+        """
+        :param dist: np.ndarray of weights by rank
+        :param head_size: ranks stored densely
+        :param num_buckets: desired number of tail buckets
+        :return: HeadTailDistribution approximating dist
+        """
+        head_size = min(head_size, len(dist))
+        edges = tail_edges(len(dist), head_size, num_buckets)
+        return cls(dist[:head_size], edges, dist[np.minimum(edges, len(dist) - 1)])
+
+    def __len__(self) -> int:
+        return int(self.edges[-1])
+
+    @property
+    def total(self) -> float:
+        return float(self._cumulative[-1])
+
+    @property
+    def nbytes(self) -> int:
+        return sum(
+            array.nbytes for array in (
+                self.head, self.edges, self.edge_weights, self.exponents,
+                self.masses, self._cumulative,
+            )
+        )
+
+    def weights(self, ranks: np.ndarray) -> np.ndarray:
+        """
+        :param ranks: np.ndarray of ranks
+        :return: np.ndarray of the weight of each rank
+        """
+        ranks = np.asarray(ranks, dtype=np.int64)
+        weights = np.empty(ranks.shape)
+        in_head = ranks < len(self.head)
+        weights[in_head] = self.head[ranks[in_head]]
+        tail = ranks[~in_head]
+        bucket = np.clip(
+            np.searchsorted(self.edges, tail, side="right") - 1, 0,
+            len(self.masses) - 1,
+        )
+        low = self.edge_weights[bucket]
+        weights[~in_head] = np.where(
+            self._power_law[bucket],
+            low * (tail / self.edges[bucket]) ** -self.exponents[bucket],
+            (low + self.edge_weights[bucket + 1]) / 2,
+        )
+        return weights
+
+    def to_dense(self) -> np.ndarray:
+        """
+        :return: np.ndarray of every weight, for catalogs that fit in memory
+        """
+        return self.weights(np.arange(len(self)))
+
+    def _point_cumulative(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :return: running sums of the weights at each head rank and at each
+            tail edge, including the rank itself
+        """
+        edge_cumulative = (
+            np.concatenate([[self._cumulative[len(self.head) - 1]
+                             if len(self.head) else 0.0],
+                            self._cumulative[len(self.head):]])
+            + self.edge_weights
+        )
+        return self._cumulative[:len(self.head)], edge_cumulative
+
+    def map(
+        self,
+        func: Callable[..., np.ndarray],
+        *running: "HeadTailDistribution",
+    ) -> "HeadTailDistribution":
+        """
+        Applying a formula to every rank, like modify_distribution_curve
+        :param func: vectorized f(m, v, r, *sums) of rank, cumulative
+            probability and probability of the rank
+        :param running: distributions sharing this one's head and edges, whose
+            running sums at each rank are passed to func after r, e.g. lowered
+            \\sum_{n=1}^{m} terms of a formula
+        :return: HeadTailDistribution of the formula's (unnormalized) weights
+        """
+        total = self.total
+        head_ranks = np.arange(len(self.head))
+        head_cumulative, edge_cumulative = self._point_cumulative()
+        sums = [distribution._point_cumulative() for distribution in running]
+
+        def evaluate(
+            m: np.ndarray, v: np.ndarray, r: np.ndarray, point: int
+        ) -> np.ndarray:
+            values = np.broadcast_to(
+                func(m, v / total, r / total, *[found[point] for found in sums]),
+                m.shape,
+            )
+            return np.clip(np.nan_to_num(values, posinf=0.0), 0.0, None)
+
+        return HeadTailDistribution(
+            evaluate(head_ranks, head_cumulative, self.head, 0),
+            self.edges,
+            evaluate(self.edges, edge_cumulative, self.edge_weights, 1),
+        )
+
+    @property
+    def support(self) -> int:
+        """
+        :return: number of ranks with a non-zero weight
+        """
+        widths = np.diff(self.edges)
+        return int(np.count_nonzero(self.head > 0) + widths[self.masses > 0].sum())
+
+    def _draw(
+        self, shape: Tuple[int, int], removed: Optional[np.ndarray] = None
+    ) -> np.ndarray:
+        """
+        Independent draws with replacement, by rank
+        :param shape: (num_samples, draws per sample)
+        :param removed: num_samples,k np.ndarray of ranks excluded from each
+            sample's draws, only head ranks are excluded, -1 for none
+        :return: np.ndarray of ranks
+        """
+        target = np.random.random(shape)
+        if removed is None:
+            component = np.searchsorted(
+                self._cumulative, target * self.total, side="right"
+            )
+        else:
+            # draw over the weights left in each sample, summed directly:
+            # subtracting the removed weights from the total cancels to
+            # nothing when a few head ranks hold nearly all of it
+            weights = np.tile(
+                np.concatenate([self.head, self.masses, [0.0]]), (len(removed), 1)
+            )
+            # removed tail ranks (and -1) point at the trailing zero
+            removed = np.where(
+                (removed >= 0) & (removed < len(self.head)),
+                removed,
+                weights.shape[1] - 1,
+            )
+            np.put_along_axis(weights, removed, 0.0, axis=1)
+            cumulative = np.cumsum(weights[:, :-1], axis=1)
+            component = np.empty(shape, dtype=np.int64)
+            for row in range(len(removed)):
+                component[row] = np.searchsorted(
+                    cumulative[row], target[row] * cumulative[row, -1], side="right"
+                )
+        component = np.minimum(component, len(self._cumulative) - 1)
+        ranks = component.copy()
+        in_tail = component >= len(self.head)
+        bucket = component[in_tail] - len(self.head)
+
+        low = self.edges[bucket].astype(np.float64)
+        high = self.edges[bucket + 1].astype(np.float64)
+        exponent = self.exponents[bucket]
+        u = np.random.random(len(bucket))
+        # inverse of the power-law CDF over [low, high)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            power = (
+                low ** (1 - exponent)
+                + u * (high ** (1 - exponent) - low ** (1 - exponent))
+            ) ** (1 / (1 - exponent))
+        unit = np.abs(exponent - 1) < _UNIT_EXPONENT_TOLERANCE
+        position = np.where(unit, low * (high / low) ** u, power)
+        ranks[in_tail] = np.clip(np.floor(position), low, high - 1)
+        return ranks
+
+    def sample(
+        self, size: int, num_samples: int = 1, replace: bool = False
+    ) -> np.ndarray:
+        """
+        Drawing ranks proportionally to their weights. Without replacement,
+        head ranks already chosen are removed from a sample's next round of
+        draws, and repeated tail ranks are rejected. This is exactly successive
+        sampling of the remaining weights, and a dominant head cannot stall it.
+        :param size: ranks per sample, capped at the number of ranks that can be
+            drawn (support)
+        :param num_samples: number of independent samples
+        :param replace: sample with replacement
+        :return: num_samples,size np.ndarray of ranks, in order of selection
+        """
+        if replace:
+            return self._draw((num_samples, size))
+        size = min(size, self.support)
+        chosen = np.full((num_samples, size), -1, dtype=np.int64)
+        if size == 0:
+            return chosen
+
+        counts = np.zeros(num_samples, dtype=np.int64)
+        rows = np.arange(num_samples)
+        stalled = 0
+        while len(rows):
+            previous = counts[rows].sum()
+            chosen[rows], counts[rows] = _merge_draws(
+                chosen[rows], self._draw((len(rows), size + 16), chosen[rows])
+            )
+            stalled = 0 if counts[rows].sum() > previous else stalled + 1
+            if stalled > MAX_STALLED_ROUNDS:
+                raise InvalidParametersException(
+                    f"Sampling {size} ranks without replacement stalled at "
+                    f"{counts[rows].min()}, remaining weights are out of reach"
+                )
+            rows = rows[counts[rows] < size]
+        return chosen
+
+    def inclusion_probabilities(
+        self, size: int, iterations: int = 100
+    ) -> "HeadTailDistribution":
+        """
+        Probability of each rank appearing in a sample of size ranks without
+        replacement, under the Poisson approximation 1 - exp(-l w) with l set
+        so that the probabilities sum to size
+        :param size: ranks per sample
+        :param iterations: bisection steps
+        :return: HeadTailDistribution of inclusion probabilities
+        """
+        size = min(size, len(self))
+        weights = np.concatenate([self.head, self.edge_weights])
+        # trapezoid over the tail, each edge standing for half of the ranks of
+        # both buckets it bounds
+        widths = np.diff(self.edges)
+        counts = np.concatenate([
+            np.ones(len(self.head)),
+            (np.concatenate([[0], widths]) + np.concatenate([widths, [0]])) / 2,
+        ])
+
+        def expected(scale: float) -> float:
+            return float(np.dot(counts, -np.expm1(-scale * weights)))
+
+        low, high = 0.0, 1.0
+        while expected(high) < size and high < 1e300:
+            high *= 2
+        for _ in range(iterations):
+            middle = (low + high) / 2
+            low, high = (middle, high) if expected(middle) < size else (low, middle)
+        scale = (low + high) / 2
+        return HeadTailDistribution(
+            -np.expm1(-scale * self.head),
+            self.edges,
+            -np.expm1(-scale * self.edge_weights),
+        )
+
+    def combine(
+        self,
+        other: "HeadTailDistribution",
+        func: Callable[[np.ndarray, np.ndarray], np.ndarray],
+    ) -> "HeadTailDistribution":
+        """
+        :param other: HeadTailDistribution with the same head and edges
+        :param func: vectorized element-wise function of both weights
+        :return: HeadTailDistribution of func(self, other)
+        """
+        if len(self.head) != len(other.head) or not np.array_equal(
+            self.edges, other.edges
+        ):
+            raise InvalidParametersException("Distributions differ in layout")
+        return HeadTailDistribution(
+            func(self.head, other.head),
+            self.edges,
+            func(self.edge_weights, other.edge_weights),
+        )
+
+
+def _merge_draws(
+    chosen: np.ndarray, draws: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Appending draws to partial samples, keeping the first occurrence of each
+    rank in order of selection
+    :param chosen: num_samples,size np.ndarray of ranks, -1 where unfilled
+    :param draws: num_samples,n np.ndarray of new draws
+    :return: updated chosen and the number of ranks filled per sample
+    """
+    size = chosen.shape[1]
+    combined = np.concatenate([chosen, draws], axis=1)
+    order = np.argsort(combined, axis=1, kind="stable")
+    ordered = np.take_along_axis(combined, order, axis=1)
+    first = np.ones(ordered.shape, dtype=bool)
+    first[:, 1:] = ordered[:, 1:] != ordered[:, :-1]
+    keep = np.empty(ordered.shape, dtype=bool)
+    np.put_along_axis(keep, order, first & (ordered >= 0), axis=1)
+
+    counts = np.minimum(keep.sum(axis=1), size)
+    kept = np.argsort(~keep, axis=1, kind="stable")[:, :size]
+    chosen = np.take_along_axis(combined, kept, axis=1)
+    chosen[np.arange(size) >= counts[:, None]] = -1
+    return chosen, counts
+
+
+def _power_integral(ratio: np.ndarray, exponent: np.ndarray) -> np.ndarray:
+    # integral of x^-s over [1, ratio]
+    unit = np.abs(exponent - 1) < _UNIT_EXPONENT_TOLERANCE
+    with np.errstate(divide="ignore", invalid="ignore"):
+        general = np.expm1((1 - exponent) * np.log(ratio)) / (1 - exponent)
+    return np.where(unit, np.log(ratio), general)
+
+
+def expected_misses(
+    request: HeadTailDistribution,
+    caching: HeadTailDistribution,
+    cache_size: int,
+    num_of_requests: int,
+) -> float:
+    """
+    Expected misses of one user without sampling, requested ranks and cached
+    ranks being independent samples without replacement
+    :param request: request distribution
+    :param caching: caching distribution with the same layout
+    :param cache_size: files cached
+    :param num_of_requests: files requested
+    :return: expected number of requested files missing the cache
+    """
+    requested = request.inclusion_probabilities(num_of_requests)
+    cached = caching.inclusion_probabilities(cache_size)
+    return requested.combine(cached, lambda r, c: r * (1 - c)).total
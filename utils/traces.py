@@ -0,0 +1,202 @@
+"""
+Building request distributions from recorded access logs
+
+Logs are streamed in chunks, object IDs are mapped to dense indexes and
+popularity is counted in bulk, so memory is bounded by the catalog size rather
+than by the length of the log.
+"""
+import itertools
+import numpy as np
+from typing import Any, Iterator, List, Optional, Tuple
+
+from config import TRACE_CHUNK_SIZE
+from exceptions import InvalidParametersException
+
+# default binary record, one little-endian unsigned 64 bit object ID
+DEFAULT_TRACE_RECORD: np.dtype = np.dtype([("id", "<u8")])
+# default binary record of per-user logs, user ID then object ID
+DEFAULT_USER_TRACE_RECORD: np.dtype = np.dtype([("user", "<u8"), ("id", "<u8")])
+
+
+def _iter_columns(
+    path: str,
+    trace_format: str,
+    chunk_size: int,
+    columns: List[int],
+    fields: List[str],
+    delimiter: str,
+    skip_header: bool,
+    dtypes: List[Any],
+    record_dtype: np.dtype,
+) -> Iterator[List[np.ndarray]]:
+    if trace_format == "binary":
+        records = np.memmap(path, dtype=record_dtype, mode="r")
+        for start in range(0, len(records), chunk_size):
+            chunk = records[start:start + chunk_size]
+            # copy out of the map so the chunk outlives the page cache
+            yield [np.array(chunk[field]) for field in fields]
+    elif trace_format == "csv":
+        with open(path) as log:
+            if skip_header:
+                next(log, None)
+            while True:
+                lines = list(itertools.islice(log, chunk_size))
+                if not lines:
+                    break
+                yield [
+                    np.atleast_1d(
+                        np.loadtxt(
+                            lines, delimiter=delimiter, usecols=column, dtype=dtype
+                        )
+                    )
+                    for column, dtype in zip(columns, dtypes)
+                ]
+    else:
+        raise InvalidParametersException(f"Unknown trace format '{trace_format}'")
+
+
+def iter_trace_chunks(
+    path: str,
+    trace_format: str = "csv",
+    chunk_size: int = TRACE_CHUNK_SIZE,
+    column: int = 0,
+    delimiter: str = ",",
+    skip_header: bool = False,
+    id_dtype: Any = np.int64,
+    record_dtype: np.dtype = DEFAULT_TRACE_RECORD,
+    id_field: str = "id",
+) -> Iterator[np.ndarray]:
+    """
+    Streaming object IDs from an access log
+    :param path: log file
+    :param trace_format: "csv" or "binary" (fixed-width records)
+    :param chunk_size: number of requests per chunk
+    :param column: csv column holding the object ID
+    :param delimiter: csv delimiter
+    :param skip_header: skip the first csv line
+    :param id_dtype: dtype of csv object IDs, str for non-numeric IDs
+    :param record_dtype: structured dtype of a binary record
+    :param id_field: field of record_dtype holding the object ID
+    :return: iterator of np.ndarray chunks of object IDs, in log order
+    """
+    for (ids,) in _iter_columns(
+        path, trace_format, chunk_size, [column], [id_field], delimiter,
+        skip_header, [id_dtype], record_dtype,
+    ):
+        yield ids
+
+
+def iter_user_trace_chunks(
+    path: str,
+    trace_format: str = "csv",
+    chunk_size: int = TRACE_CHUNK_SIZE,
+    user_column: int = 0,
+    column: int = 1,
+    delimiter: str = ",",
+    skip_header: bool = False,
+    user_dtype: Any = np.int64,
+    id_dtype: Any = np.int64,
+    record_dtype: np.dtype = DEFAULT_USER_TRACE_RECORD,
+    user_field: str = "user",
+    id_field: str = "id",
+) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Streaming (user ID, object ID) pairs from an access log, see
+    iter_trace_chunks for the shared arguments
+    :param user_column: csv column holding the user ID
+    :param user_dtype: dtype of csv user IDs
+    :param user_field: field of record_dtype holding the user ID
+    :return: iterator of (user IDs, object IDs) chunks, in log order
+    """
+    for users, ids in _iter_columns(
+        path, trace_format, chunk_size, [user_column, column],
+        [user_field, id_field], delimiter, skip_header, [user_dtype, id_dtype],
+        record_dtype,
+    ):
+        yield users, ids
+
+
+class DenseIdIndex(object):
+    """
+    Mapping of arbitrary object IDs to dense indexes 0..n-1 in order of first
+    appearance, kept as one sorted key array so lookups are vectorized
+    """
+
+    def __init__(self) -> None:
+        self._keys: Optional[np.ndarray] = None
+        self._dense: np.ndarray = np.array([], dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self._dense)
+
+    def index(self, ids: np.ndarray) -> np.ndarray:
+        """
+        Looking up IDs, inserting those not seen before
+        :param ids: np.ndarray of object IDs
+        :return: np.ndarray of dense indexes, one per ID
+        """
+        unique_ids, inverse = np.unique(ids, return_inverse=True)
+        if self._keys is None:
+            self._keys = unique_ids[:0]
+
+        positions = np.searchsorted(self._keys, unique_ids)
+        found = positions < len(self._keys)
+        found[found] = self._keys[positions[found]] == unique_ids[found]
+
+        dense = np.empty(len(unique_ids), dtype=np.int64)
+        dense[found] = self._dense[positions[found]]
+        new_ids = unique_ids[~found]
+        if len(new_ids):
+            new_dense = np.arange(len(self), len(self) + len(new_ids))
+            dense[~found] = new_dense
+            # unique_ids is sorted, so insertion points stay sorted
+            self._keys = np.insert(self._keys, positions[~found], new_ids)
+            self._dense = np.insert(self._dense, positions[~found], new_dense)
+
+        return dense[inverse.reshape(-1)]
+
+    def ids(self) -> np.ndarray:
+        """
+        :return: np.ndarray of object IDs ordered by dense index
+        """
+        if self._keys is None:
+            return np.array([])
+        ordered = np.empty_like(self._keys)
+        ordered[self._dense] = self._keys
+        return ordered
+
+
+def popularity_histogram(
+    path: str, *args, **kwargs
+) -> Tuple[np.ndarray, DenseIdIndex]:
+    """
+    Counting requests per object over a whole log
+    :param path: log file
+    :param args: passed to iter_trace_chunks
+    :param kwargs: passed to iter_trace_chunks
+    :return: np.ndarray of request counts by dense index, and the index
+    """
+    index = DenseIdIndex()
+    counts = np.zeros(0, dtype=np.int64)
+    for chunk in iter_trace_chunks(path, *args, **kwargs):
+        chunk_counts = np.bincount(index.index(chunk), minlength=len(index))
+        counts = np.pad(counts, (0, len(chunk_counts) - len(counts)))
+        counts += chunk_counts
+    return counts, index
+
+
+def trace_request_distribution(
+    path: str, *args, **kwargs
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Request distribution of a log, ranked like generate_distribution_curve
+    :param path: log file
+    :param args: passed to iter_trace_chunks
+    :param kwargs: passed to iter_trace_chunks
+    :return: np.ndarray p_r in descending order, and the object ID of each rank
+    """
+    counts, index = popularity_histogram(path, *args, **kwargs)
+    if not counts.sum():
+        raise InvalidParametersException(f"No requests found in '{path}'")
+    ranking = np.argsort(-counts, kind="stable")
+    return counts[ranking] / counts.sum(), index.ids()[ranking]